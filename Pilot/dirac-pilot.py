@@ -21,9 +21,13 @@ But, as said, all the actions are actually configurable.
 
 from __future__ import absolute_import, division, print_function
 
+import time
+
+importStartTime = time.time()
+
+import atexit
 import os
 import sys
-import time
 
 ############################
 # python 2 -> 3 "hacks"
@@ -35,28 +39,51 @@ except ImportError:
 
 try:
     from Pilot.pilotTools import (
+        CommandCheckpoints,
+        CommandScheduler,
         Logger,
+        PilotDaemon,
         PilotParams,
         RemoteLogger,
-        getCommand,
+        drainLogs,
         pythonPathCheck,
+        reuseDaemonSetup,
+        tracer,
     )
 except ImportError:
     from pilotTools import (
+        CommandCheckpoints,
+        CommandScheduler,
         Logger,
+        PilotDaemon,
         PilotParams,
         RemoteLogger,
-        getCommand,
+        drainLogs,
         pythonPathCheck,
+        reuseDaemonSetup,
+        tracer,
     )
 ############################
 
+importEndTime = time.time()
+
 if __name__ == "__main__":
     pilotStartTime = int(time.time())
+    paramsStartTime = tracer.now()
 
     sys.stdout, oldstdout = StringIO(), sys.stdout
     # so PilotParams are writing to a StingIO buffer now.
+    # (with --profile, PilotParams dumps the profile of its resolution in PilotParams.pstats)
     pilotParams = PilotParams()
+    if pilotParams.traceFile:
+        tracer.start(pilotParams.traceFile)
+        atexit.register(tracer.stop)
+        tracer.complete("imports", "startup", int(importStartTime * 1000000), int(importEndTime * 1000000))
+        tracer.complete("PilotParams", "startup", paramsStartTime, tracer.now())
+        for phase, startTime, endTime in pilotParams.startupTimes:
+            tracer.complete(phase, "startup", startTime, endTime)
+    # the PilotParams messages still queued (asynchronous logging) go to the StringIO buffer too
+    drainLogs()
     sys.stdout, buffer = oldstdout, sys.stdout
     bufContent = buffer.getvalue()
     buffer.close()
@@ -79,6 +106,7 @@ if __name__ == "__main__":
             wnVO=pilotParams.wnVO,
         )
         log.info("Remote logger activated")
+        drainLogs()
         log.buffer.write(receivedContent)
         log.buffer.flush()
         log.buffer.write(bufContent)
@@ -98,6 +126,14 @@ if __name__ == "__main__":
     pilotParams.pilotScript = os.path.realpath(sys.argv[0])
     pilotParams.pilotScriptName = os.path.basename(pilotParams.pilotScript)
     log.debug("PARAMETER [%s]" % ", ".join(map(str, pilotParams.optList)))
+    log.debug(
+        "Startup times (ms): imports %.1f, %s, total %.1f"
+        % (
+            (importEndTime - importStartTime) * 1000,
+            ", ".join("%s %.1f" % (phase, (end - start) / 1000.0) for phase, start, end in pilotParams.startupTimes),
+            (time.time() - importStartTime) * 1000,
+        )
+    )
 
     if pilotParams.commandExtensions:
         log.info("Requested command extensions: %s" % str(pilotParams.commandExtensions))
@@ -110,17 +146,25 @@ if __name__ == "__main__":
         try:
             log.buffer.cancelTimer()
             log.debug("Timer canceled")
+            drainLogs()
             log.buffer.flush()
         except Exception as exc:
             log.error(str(exc))
-    for commandName in pilotParams.commands:
-        command, module = getCommand(pilotParams, commandName)
-        if command is not None:
-            command.log.info("Command %s instantiated from %s" % (commandName, module))
-            command.execute()
-        else:
-            log.error("Command %s could not be instantiated" % commandName)
-            # send the last message and abandon ship.
-            if remote:
-                log.buffer.flush()
-            sys.exit(-1)
+    checkpoints = CommandCheckpoints(pilotParams, log) if pilotParams.checkpoint else None
+    scheduler = CommandScheduler(
+        pilotParams, log, maxWorkers=pilotParams.maxParallelCommands, checkpoints=checkpoints
+    )
+    commands = scheduler.resolveCommands()
+    if commands is None:
+        # send the last message and abandon ship.
+        if remote:
+            drainLogs()
+            log.buffer.flush()
+        sys.exit(-1)
+    if pilotParams.daemon:
+        daemon = PilotDaemon(pilotParams, log)
+        daemon.setup(scheduler, commands)
+        daemon.serve(pilotParams.daemon)
+    if pilotParams.daemonSocket:
+        commands = reuseDaemonSetup(pilotParams, log, commands)
+    scheduler.run(commands)
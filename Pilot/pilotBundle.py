@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Build a single-file, executable bundle (a zipapp) of the pilot, to be used instead of the loose files.
+
+The bundle contains dirac-pilot.py (as __main__), the pilot modules and the command extensions,
+with their bytecode compiled in advance by the Python interpreter that will run the pilot:
+the pilot is then a single download, and nothing is compiled on the worker node.
+For other interpreters, the sources in the bundle are used.
+
+Usage:
+
+    python pilotBundle.py [--python python3.9] [--output dirac-pilot.pyz] [LHCbPilotCommands.py ...]
+
+pilot.json is not part of the bundle: it is still downloaded next to it (see pilot_wrapper.sh).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+PILOT_DIR = os.path.dirname(os.path.abspath(__file__))
+PILOT_MODULES = ["pilotTools.py", "pilotCommands.py", "proxyTools.py"]
+
+# Executed by the target interpreter: compile each source into a legacy (sourceless) .pyc,
+# the layout zipimport looks for. Hash-based pycs, when available, are used without checking the sources.
+COMPILE_SCRIPT = """
+import py_compile, sys
+kwargs = {}
+if hasattr(py_compile, "PycInvalidationMode"):
+    kwargs["invalidation_mode"] = py_compile.PycInvalidationMode.UNCHECKED_HASH
+for source, target, name in zip(sys.argv[1::3], sys.argv[2::3], sys.argv[3::3]):
+    py_compile.compile(source, target, name, True, **kwargs)
+"""
+
+
+def getSources(extensions):
+    """Files of the bundle
+
+    :param list extensions: paths of the extension modules, e.g. LHCbPilotCommands.py
+    :return: list of (source path, name in the bundle)
+    """
+    sources = [(os.path.join(PILOT_DIR, "dirac-pilot.py"), "__main__.py")]
+    sources += [(os.path.join(PILOT_DIR, name), name) for name in PILOT_MODULES]
+    sources += [(path, os.path.basename(path)) for path in extensions]
+    return sources
+
+
+def compileSources(python, sources, buildDir):
+    """Compile the sources with the target interpreter
+
+    :param str python: the target interpreter
+    :param list sources: as returned by getSources
+    :param str buildDir: where the .pyc are written
+    :return: list of (.pyc path, name in the bundle)
+    """
+    arguments = []
+    compiled = []
+    for path, name in sources:
+        pycName = name[: -len(".py")] + ".pyc"
+        arguments += [path, os.path.join(buildDir, pycName), name]
+        compiled.append((os.path.join(buildDir, pycName), pycName))
+    subprocess.check_call([python, "-c", COMPILE_SCRIPT] + arguments)
+    return compiled
+
+
+def buildBundle(output, python, extensions):
+    """Write the bundle
+
+    :param str output: the bundle file
+    :param str python: the interpreter running the pilot, used for the shebang and to compile the bytecode
+    :param list extensions: paths of the extension modules
+    """
+    sources = getSources(extensions)
+    buildDir = tempfile.mkdtemp()
+    try:
+        compiled = compileSources(python, sources, buildDir)
+        with open(output, "wb") as fd:
+            fd.write(("#!/usr/bin/env %s\n" % os.path.basename(python)).encode("utf-8"))
+            with zipfile.ZipFile(fd, "w", zipfile.ZIP_DEFLATED) as bundle:
+                for path, name in sources + compiled:
+                    # the timestamp of the sources is the one compared with the timestamp-based .pyc
+                    info = zipfile.ZipInfo(name, time.localtime(os.stat(path).st_mtime)[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info.external_attr = 0o644 << 16
+                    with open(path, "rb") as fp:
+                        bundle.writestr(info, fp.read())
+        os.chmod(output, 0o755)
+    finally:
+        shutil.rmtree(buildDir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a single-file bundle of the pilot")
+    parser.add_argument("--output", "-o", default="dirac-pilot.pyz", help="bundle file (default: %(default)s)")
+    parser.add_argument(
+        "--python", default="python3", help="interpreter running the pilot on the worker nodes (default: %(default)s)"
+    )
+    parser.add_argument("extensions", nargs="*", help="extension modules, e.g. LHCbPilotCommands.py")
+    args = parser.parse_args()
+
+    buildBundle(args.output, args.python, args.extensions)
+    print("Pilot bundle written in %s" % args.output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -47,17 +47,25 @@ except ImportError:
 
 try:
     from Pilot.pilotTools import (
+        DIRACOS_INSTALL_SOURCE,
         CommandBase,
+        directoryProber,
+        drainLogs,
         getSubmitterInfo,
         retrieveUrlTimeout,
+        runProfiled,
         safe_listdir,
         sendMessage,
     )
 except ImportError:
     from pilotTools import (
+        DIRACOS_INSTALL_SOURCE,
         CommandBase,
+        directoryProber,
+        drainLogs,
         getSubmitterInfo,
         retrieveUrlTimeout,
+        runProfiled,
         safe_listdir,
         sendMessage,
     )
@@ -69,6 +77,7 @@ def logFinalizer(func):
     PilotCommand decorator. It marks a log file as final so no more messages should be written to it.
     Finalising is triggered by a return statement or any sys.exit() call, so a file might be incomplete
     if a command throws SystemExit exception with a code =! 0.
+    It is not finalised when the CommandScheduler executes the command again (see CommandBase.retryDelay).
 
     :param func: method to be decorated
     :type func: method object
@@ -79,19 +88,29 @@ def logFinalizer(func):
     def wrapper(self):
         if not self.log.isPilotLoggerOn:
             self.log.debug("Remote logger is not active, no log flushing performed")
-            return func(self)
+            try:
+                return runProfiled(self, func)
+            finally:
+                drainLogs()
 
         try:
-            ret = func(self)
+            ret = runProfiled(self, func)
+            drainLogs()
             self.log.buffer.flush()
             return ret
 
         except SystemExit as exCode:  # or Exception ?
             # controlled exit
+            if self.retryDelay(exCode.code) is not None:
+                # not the last attempt: the logs are finalised by the next one
+                drainLogs()
+                self.log.buffer.flush()
+                raise
             pRef = self.pp.pilotReference
             self.log.info(
                 "Flushing the remote logger buffer for pilot on sys.exit(): %s (exit code:%s)" % (pRef, str(exCode))
             )
+            drainLogs()
             self.log.buffer.flush()  # flush the buffer unconditionally (on sys.exit()).
             try:
                 sendMessage(self.log.url, self.log.pilotUUID, self.log.wnVO, "finaliseLogs", {"retCode": str(exCode)})
@@ -104,6 +123,7 @@ def logFinalizer(func):
             self.log.error(traceback.format_exc())
             raise
         finally:
+            drainLogs()
             self.log.buffer.cancelTimer()
 
     return wrapper
@@ -112,6 +132,9 @@ def logFinalizer(func):
 class GetPilotVersion(CommandBase):
     """Now just returns what was obtained by pilotTools.py"""
 
+    needs = ()
+    produces = ()
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(GetPilotVersion, self).__init__(pilotParams)
@@ -125,6 +148,9 @@ class GetPilotVersion(CommandBase):
 class CheckWorkerNode(CommandBase):
     """Executes some basic checks"""
 
+    needs = ()
+    produces = ()
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(CheckWorkerNode, self).__init__(pilotParams)
@@ -210,6 +236,10 @@ class CheckWorkerNode(CommandBase):
 class InstallDIRAC(CommandBase):
     """Source from CVMFS, or install locally"""
 
+    needs = ()
+    produces = ("installEnv",)
+    reusable = True
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(InstallDIRAC, self).__init__(pilotParams)
@@ -257,18 +287,20 @@ class InstallDIRAC(CommandBase):
 
         preinstalledEnvScript = self.pp.preinstalledEnv
         if not preinstalledEnvScript and self.pp.preinstalledEnvPrefix:
-            version = self.pp.releaseVersion or "pro"
-            arch = platform.system() + "-" + platform.machine()
-            preinstalledEnvScript = os.path.join(self.pp.preinstalledEnvPrefix, version, arch, "diracosrc")
+            preinstalledEnvScript = self.pp.getPreinstalledEnvCandidates()[0]
+
+        # maybe found by a previous pilot of the node
+        discovery = self.pp.discoveryCache
+        if not preinstalledEnvScript and self.pp.CVMFS_locations and discovery:
+            preinstalledEnvScript = discovery.get(self.pp.preinstalledEnvKey(), directoryProber.isFile)
 
         if not preinstalledEnvScript and self.pp.CVMFS_locations:
-            for CVMFS_location in self.pp.CVMFS_locations:
-                version = self.pp.releaseVersion or "pro"
-                arch = platform.system() + "-" + platform.machine()
-                preinstalledEnvScript = os.path.join(
-                    CVMFS_location, self.pp.releaseProject.lower() + "dirac", version, arch, "diracosrc"
-                )
-                if os.path.isfile(preinstalledEnvScript):
+            for preinstalledEnvScript in self.pp.getPreinstalledEnvCandidates():
+                # the directory may still be loading (see PilotParams.prewarmCVMFS)
+                directoryProber.waitPrewarm(os.path.dirname(preinstalledEnvScript))
+                if directoryProber.isFile(preinstalledEnvScript):
+                    if discovery:
+                        discovery.set(self.pp.preinstalledEnvKey(), preinstalledEnvScript)
                     break
 
         self.log.debug("preinstalledEnvScript = %s" % preinstalledEnvScript)
@@ -308,9 +340,8 @@ class InstallDIRAC(CommandBase):
         if os.path.exists("diracos"):
             shutil.rmtree("diracos")
 
-        retCode, _ = self.executeAndGetOutput(
-            "bash /cvmfs/dirac.egi.eu/installSource/%s 2>&1" % installerName, installEnv
-        )
+        directoryProber.waitPrewarm(DIRACOS_INSTALL_SOURCE)
+        retCode, _ = self.executeAndGetOutput("bash %s/%s 2>&1" % (DIRACOS_INSTALL_SOURCE, installerName), installEnv)
         if retCode:
             self.log.warn("Could not install DIRACOS from CVMFS [ERROR %d]" % retCode)
 
@@ -378,7 +409,7 @@ class InstallDIRAC(CommandBase):
                 pipInstalling += "[pilot]"
 
                 # pipInstalling = "pip install %s%s@%s#egg=%s[pilot]" % (prefix, url, branch, project)
-                retCode, output = self.executeAndGetOutput(pipInstalling, self.pp.installEnv)
+                retCode, output = self.executeWithRetries(pipInstalling, self.pp.installEnv)
                 if retCode:
                     self.log.error("Could not %s [ERROR %d]" % (pipInstalling, retCode))
                     self.exitWithError(retCode)
@@ -388,7 +419,7 @@ class InstallDIRAC(CommandBase):
                 cmd = "%s %sDIRAC[pilot]" % (pipInstalling, self.pp.releaseProject)
             else:
                 cmd = "%s %sDIRAC[pilot]==%s" % (pipInstalling, self.pp.releaseProject, self.releaseVersion)
-            retCode, output = self.executeAndGetOutput(cmd, self.pp.installEnv)
+            retCode, output = self.executeWithRetries(cmd, self.pp.installEnv)
             if retCode:
                 self.log.error("Could not pip install %s [ERROR %d]" % (self.releaseVersion, retCode))
                 self.exitWithError(retCode)
@@ -453,6 +484,9 @@ class ConfigureBasics(CommandBase):
                "-O %s %s" % ( self.pp.localConfigFile, self.pp.localConfigFile )
     """
 
+    needs = ("installEnv",)
+    produces = ("pilot.cfg", "pilotReference")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(ConfigureBasics, self).__init__(pilotParams)
@@ -481,7 +515,7 @@ class ConfigureBasics(CommandBase):
 
         configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
 
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+        retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
 
         if retCode:
             self.log.error("Could not configure DIRAC basics [ERROR %d]" % retCode)
@@ -539,6 +573,10 @@ class ConfigureBasics(CommandBase):
 class RegisterPilot(CommandBase):
     """The Pilot self-announce its own presence"""
 
+    needs = ("installEnv", "pilot.cfg", "pilotReference")
+    produces = ()
+    optional = True
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(RegisterPilot, self).__init__(pilotParams)
@@ -567,7 +605,7 @@ class RegisterPilot(CommandBase):
             self.pilotStamp,
             " ".join(self.cfg),
         )
-        retCode, _ = self.executeAndGetOutput(checkCmd, self.pp.installEnv)
+        retCode, _ = self.executeWithRetries(checkCmd, self.pp.installEnv)
         if retCode:
             self.log.error("Could not get execute dirac-admin-add-pilot [ERROR %d]" % retCode)
 
@@ -575,6 +613,9 @@ class RegisterPilot(CommandBase):
 class CheckCECapabilities(CommandBase):
     """Used to get CE tags and other relevant parameters."""
 
+    needs = ("installEnv", "pilot.cfg")
+    produces = ("pilot.cfg", "tags")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(CheckCECapabilities, self).__init__(pilotParams)
@@ -599,7 +640,7 @@ class CheckCECapabilities(CommandBase):
             self.pp.queueName,
             " ".join(self.cfg),
         )
-        retCode, resourceDict = self.executeAndGetOutput(checkCmd, self.pp.installEnv)
+        retCode, resourceDict = self.executeWithRetries(checkCmd, self.pp.installEnv)
         if retCode:
             self.log.error("Could not get resource parameters [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -637,7 +678,7 @@ class CheckCECapabilities(CommandBase):
                 self.cfg.append("-ddd")
 
             configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
-            retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+            retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
             if retCode:
                 self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
                 self.exitWithError(retCode)
@@ -651,6 +692,9 @@ class CheckWNCapabilities(CommandBase):
     after the CheckCECapabilities command
     """
 
+    needs = ("installEnv", "pilot.cfg", "tags")
+    produces = ("pilot.cfg", "tags", "pilotProcessors")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(CheckWNCapabilities, self).__init__(pilotParams)
@@ -671,7 +715,7 @@ class CheckWNCapabilities(CommandBase):
             self.pp.queueName,
             " ".join(self.cfg),
         )
-        retCode, result = self.executeAndGetOutput(checkCmd, self.pp.installEnv)
+        retCode, result = self.executeWithRetries(checkCmd, self.pp.installEnv)
         if retCode:
             self.log.error("Could not get resource parameters [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -735,7 +779,7 @@ class CheckWNCapabilities(CommandBase):
             self.cfg.append("-FDMH")
 
             configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
-            retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+            retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
             if retCode:
                 self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
                 self.exitWithError(retCode)
@@ -744,6 +788,9 @@ class CheckWNCapabilities(CommandBase):
 class ConfigureSite(CommandBase):
     """Command to configure DIRAC sites using the pilot options"""
 
+    needs = ("installEnv", "pilot.cfg", "pilotReference")
+    produces = ("pilot.cfg",)
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(ConfigureSite, self).__init__(pilotParams)
@@ -804,7 +851,7 @@ class ConfigureSite(CommandBase):
 
         configureCmd = "%s %s" % (self.pp.configureScript, " ".join(self.cfg))
 
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+        retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
 
         if retCode:
             self.log.error("Could not configure DIRAC [ERROR %d]" % retCode)
@@ -816,6 +863,9 @@ class ConfigureArchitecture(CommandBase):
     Separated from the ConfigureDIRAC command for easier extensibility.
     """
 
+    needs = ("installEnv", "pilot.cfg")
+    produces = ("pilot.cfg",)
+
     @logFinalizer
     def execute(self):
         """This is a simple command to call the dirac-platform utility to get the platform,
@@ -864,7 +914,7 @@ class ConfigureArchitecture(CommandBase):
         cfg.append("-o /LocalSite/Platform=%s" % platform.machine())
 
         configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+        retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
         if retCode:
             self.log.error("Configuration error [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -875,6 +925,10 @@ class ConfigureArchitectureWithoutCLI(CommandBase):
     """This command determines the platform.
     Separated from the ConfigureDIRAC command for easier extensibility.
     """
+
+    needs = ("installEnv", "pilot.cfg")
+    produces = ("pilot.cfg",)
+
     def getPlatformString(self):
         # Modified to return our desired platform string, R. Graciani
         platformTuple = (platform.system(), platform.machine())
@@ -921,7 +975,7 @@ class ConfigureArchitectureWithoutCLI(CommandBase):
         cfg.append("-o /LocalSite/Platform=%s" % platform.machine())
 
         configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+        retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
         if retCode:
             self.log.error("Configuration error [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -932,6 +986,9 @@ class ConfigureArchitectureWithoutCLI(CommandBase):
 class ConfigureCPURequirements(CommandBase):
     """This command determines the CPU requirements. Needs to be executed after ConfigureSite"""
 
+    needs = ("installEnv", "pilot.cfg")
+    produces = ("pilot.cfg", "jobCPUReq")
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(ConfigureCPURequirements, self).__init__(pilotParams)
@@ -945,7 +1002,7 @@ class ConfigureCPURequirements(CommandBase):
             configFileArg = "-o /DIRAC/Security/UseServerCertificate=yes"
         if self.pp.localConfigFile:
             configFileArg = "%s -R %s --cfg %s" % (configFileArg, self.pp.localConfigFile, self.pp.localConfigFile)
-        retCode, cpuNormalizationFactorOutput = self.executeAndGetOutput(
+        retCode, cpuNormalizationFactorOutput = self.executeWithRetries(
             "dirac-wms-cpu-normalization -U %s -d" % configFileArg, self.pp.installEnv
         )
         if retCode:
@@ -967,7 +1024,7 @@ class ConfigureCPURequirements(CommandBase):
         if self.pp.useServerCertificate:
             configFileArg = "-o /DIRAC/Security/UseServerCertificate=yes"
         cfgFile = "--cfg %s" % self.pp.localConfigFile
-        retCode, cpuTimeOutput = self.executeAndGetOutput(
+        retCode, cpuTimeOutput = self.executeWithRetries(
             "dirac-wms-get-queue-cpu-time --CPUNormalizationFactor=%f %s %s -d"
             % (cpuNormalizationFactor, configFileArg, cfgFile),
             self.pp.installEnv,
@@ -1001,7 +1058,7 @@ class ConfigureCPURequirements(CommandBase):
         cfg.append("-o /LocalSite/CPUTimeLeft=%s" % str(int(self.pp.jobCPUReq)))  # the only real option
 
         configureCmd = "%s %s" % (self.pp.configureScript, " ".join(cfg))
-        retCode, _configureOutData = self.executeAndGetOutput(configureCmd, self.pp.installEnv)
+        retCode, _configureOutData = self.executeWithRetries(configureCmd, self.pp.installEnv)
         if retCode:
             self.log.error("Failed to update CFG file for CPUTimeLeft [ERROR %d]" % retCode)
             self.exitWithError(retCode)
@@ -1129,6 +1186,10 @@ class NagiosProbes(CommandBase):
     The results are reported through the Pilot Logger.
     """
 
+    needs = ()
+    produces = ()
+    optional = True
+
     def __init__(self, pilotParams):
         """c'tor"""
         super(NagiosProbes, self).__init__(pilotParams)
@@ -1138,25 +1199,12 @@ class NagiosProbes(CommandBase):
     def _setNagiosOptions(self):
         """Setup list of Nagios probes and optional PUT URL from pilot.json"""
 
-        try:
-            self.nagiosProbes = [
-                str(pv).strip() for pv in self.pp.pilotJSON["Setups"][self.pp.setup]["NagiosProbes"].split(",")
-            ]
-        except KeyError:
-            try:
-                self.nagiosProbes = [
-                    str(pv).strip() for pv in self.pp.pilotJSON["Setups"]["Defaults"]["NagiosProbes"].split(",")
-                ]
-            except KeyError:
-                pass
-
-        try:
-            self.nagiosPutURL = str(self.pp.pilotJSON["Setups"][self.pp.setup]["NagiosPutURL"])
-        except KeyError:
-            try:
-                self.nagiosPutURL = str(self.pp.pilotJSON["Setups"]["Defaults"]["NagiosPutURL"])
-            except KeyError:
-                pass
+        setupPaths = ["/Setups/%s/%%s" % self.pp.setup, "/Setups/Defaults/%s"]
+        options = self.pp.optionResolver
+        self.nagiosProbes = options.firstList([path % "NagiosProbes" for path in setupPaths], self.nagiosProbes)
+        nagiosPutURL = options.first([path % "NagiosPutURL" for path in setupPaths])
+        if nagiosPutURL is not None:
+            self.nagiosPutURL = str(nagiosPutURL)
 
         self.log.debug("NAGIOS PROBES [%s]" % ", ".join(self.nagiosProbes))
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Split the pilot JSON file in small shards, one per CE, to be used with the --pilotShards option of the pilot.
+
+The pilot JSON file describes all the CEs of the grid, while a pilot only reads the section of its own CE.
+Each shard is a pilot JSON file (legacy "Setups" schema or VO schema, as the input) with a single CE
+and the other sections unchanged, so that the parameters a pilot resolves from it are the ones it would
+resolve from the whole file. The VO and setup sections are kept: the VO of a pilot is only known on
+the worker node (from its proxy).
+
+Usage:
+
+    python pilotShards.py [--output pilotShards] pilot.json
+
+The output directory contains:
+
+    index.json       the CEs and the name of their shard
+    default.json     the shard of the pilots running on a CE which is not in the file
+    CEs/<CE>.json    the shard of each CE
+
+The shards which did not change keep their modification time, so that the caches in front of
+the web server, and the node caches of the pilots, stay valid.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import sys
+
+try:
+    from Pilot.pilotTools import SHARDS_DEFAULT, SHARDS_INDEX, getShardName
+except ImportError:
+    from pilotTools import SHARDS_DEFAULT, SHARDS_INDEX, getShardName
+
+
+def getShards(pilotJSON):
+    """Content of the shards
+
+    :param dict pilotJSON: content of the pilot JSON file
+    :return: dict of shard name -> shard content, and the index
+    """
+    common = dict((key, value) for key, value in pilotJSON.items() if key != "CEs")
+    shards = {SHARDS_DEFAULT: dict(common, CEs={})}
+    index = {"CEs": {}, "Default": SHARDS_DEFAULT}
+    if "timestamp" in pilotJSON:
+        index["timestamp"] = pilotJSON["timestamp"]
+    for ceName, ceDict in pilotJSON.get("CEs", {}).items():
+        shardName = getShardName(ceName)
+        shards[shardName] = dict(common, CEs={ceName: ceDict})
+        index["CEs"][ceName] = shardName
+    return shards, index
+
+
+def writeFile(fileName, content):
+    """Write a JSON file, unless its content did not change
+
+    :return: True if the file was written
+    """
+    data = json.dumps(content, sort_keys=True, separators=(",", ":"))
+    try:
+        with open(fileName, "r") as fp:
+            if fp.read() == data:
+                return False
+    except IOError:
+        pass
+    # written in a temporary file then renamed: the web server never serves a partial file
+    tmpFile = "%s.%d" % (fileName, os.getpid())
+    with open(tmpFile, "w") as fp:
+        fp.write(data)
+    os.rename(tmpFile, fileName)
+    return True
+
+
+def writeShards(pilotJSON, output):
+    """Write the shards and the index in the output directory, and remove the shards of the CEs which are gone
+
+    :param dict pilotJSON: content of the pilot JSON file
+    :param str output: the output directory
+    :return: number of shards written
+    """
+    shards, index = getShards(pilotJSON)
+    ceDir = os.path.join(output, "CEs")
+    if not os.path.isdir(ceDir):
+        os.makedirs(ceDir)
+    written = 0
+    for shardName, content in shards.items():
+        written += writeFile(os.path.join(output, shardName), content)
+    for fileName in os.listdir(ceDir):
+        if "CEs/%s" % fileName not in shards:
+            os.remove(os.path.join(ceDir, fileName))
+    writeFile(os.path.join(output, SHARDS_INDEX), index)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split the pilot JSON file in per-CE shards")
+    parser.add_argument("--output", "-o", default="pilotShards", help="output directory (default: %(default)s)")
+    parser.add_argument("pilotJSON", help="the pilot JSON file")
+    args = parser.parse_args()
+
+    with open(args.pilotJSON, "r") as fp:
+        pilotJSON = json.load(fp)
+    written = writeShards(pilotJSON, args.output)
+    print("%d pilot JSON shards written in %s" % (written, args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
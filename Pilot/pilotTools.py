@@ -2,32 +2,42 @@
 
 from __future__ import absolute_import, division, print_function
 
+import atexit
 import fcntl
-import getopt
-import json
 import os
+import platform
 import re
-import select
 import signal
-import ssl
 import subprocess
 import sys
 import threading
+import time
 import warnings
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import partial, wraps
 from threading import RLock
 
 ############################
 # python 2 -> 3 "hacks"
-try:
-    from urllib.error import HTTPError, URLError
-    from urllib.parse import urlencode
-    from urllib.request import urlopen
-except ImportError:
-    from urllib import urlencode
 
-    from urllib2 import HTTPError, URLError, urlopen
+
+def importUrllib():
+    """Import the urllib functions, only when needed: they are slow to import and only used for downloads
+    and remote logging, not by every pilot.
+
+    :return: urlopen, urlencode, HTTPError, URLError
+    """
+    try:
+        from urllib.error import HTTPError, URLError
+        from urllib.parse import urlencode
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib import urlencode
+
+        from urllib2 import HTTPError, URLError, urlopen
+    return urlopen, urlencode, HTTPError, URLError
+
 
 try:
     import importlib.util
@@ -39,6 +49,9 @@ try:
         spec.loader.exec_module(module)
         return module
 
+    def import_submodule(parentModule, module_name):
+        return import_module("%s.%s" % (parentModule.__name__, module_name))
+
 except ImportError:
 
     def import_module(module):
@@ -57,6 +70,16 @@ except ImportError:
             if fp:
                 fp.close()
 
+    def import_submodule(parentModule, module_name):
+        import imp
+
+        fp, pathname, description = imp.find_module(module_name, parentModule.__path__)
+        try:
+            return imp.load_module("%s.%s" % (parentModule.__name__, module_name), fp, pathname, description)
+        finally:
+            if fp:
+                fp.close()
+
 
 try:
     from cStringIO import StringIO
@@ -64,14 +87,19 @@ except ImportError:
     from io import StringIO
 
 try:
-    basestring  # pylint: disable=used-before-assignment
-except NameError:
-    basestring = str
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
-    from Pilot.proxyTools import getVO
+    from collections.abc import Mapping, MutableMapping
 except ImportError:
-    from proxyTools import getVO
+    from collections import Mapping, MutableMapping
+
+try:
+    basestring  # pylint: disable=used-before-assignment
+except NameError:
+    basestring = str
 
 try:
     FileNotFoundError  # pylint: disable=used-before-assignment
@@ -147,10 +175,85 @@ def alarmTimeoutHandler(*args):
     raise Exception("Timeout")
 
 
-def retrieveUrlTimeout(url, fileName, log, timeout=0):
+class RetryPolicy(object):
+    """When to retry a failed operation, and how long to wait before: exponential backoff with jitter"""
+
+    # Messages of transient failures (e.g. a DIRAC service or a web server that can't be reached)
+    TRANSIENT_PATTERNS = (
+        r"[Tt]imed? ?out",
+        r"Connection (refused|reset|aborted)",
+        r"Could not connect",
+        r"Temporary failure in name resolution",
+        r"Service Unavailable",
+        r"Bad Gateway",
+        r"Gateway Time-?out",
+        r"Cannot get URL for",
+        r"Failed to establish a new connection",
+    )
+
+    def __init__(self, attempts=3, backoff=10, maxBackoff=300, jitter=0.5, retryableCodes=(), retryablePatterns=None):
+        """c'tor
+
+        :param int attempts: maximum number of attempts, 1 means no retry
+        :param float backoff: delay before the first retry, in seconds, doubled at each attempt
+        :param float maxBackoff: maximum delay
+        :param float jitter: relative random variation of the delay, so that pilots don't retry all together
+        :param list retryableCodes: return codes always worth a retry
+        :param list retryablePatterns: regular expressions matching the output of transient failures
+        """
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.jitter = jitter
+        self.retryableCodes = retryableCodes
+        if retryablePatterns is None:
+            retryablePatterns = self.TRANSIENT_PATTERNS
+        self.retryablePatterns = [re.compile(pattern) for pattern in retryablePatterns]
+
+    def delay(self, attempt):
+        """Delay (seconds) before the next attempt, after `attempt` attempts failed"""
+        import random
+
+        delay = min(self.maxBackoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def isRetryable(self, retCode, output=""):
+        """Whether a failure (return code and output of a command) is transient"""
+        if retCode == 0:
+            return False
+        if retCode in self.retryableCodes:
+            return True
+        return any(pattern.search(output) for pattern in self.retryablePatterns)
+
+
+def retrieveUrlTimeout(url, fileName, log, timeout=0, retryPolicy=None):
     """
-    Retrieve remote url to local file, with timeout wrapper
+    Retrieve remote url to local file, with timeout wrapper.
+    Server errors (HTTP 5xx) are retried according to retryPolicy.
     """
+    HTTPError = importUrllib()[2]
+    if retryPolicy is None:
+        retryPolicy = RetryPolicy()
+    attempt = 1
+    while True:
+        try:
+            return _retrieveUrlTimeout(url, fileName, log, timeout)
+        except HTTPError as x:
+            if x.code < 500 or attempt >= retryPolicy.attempts:
+                log.error("URL retrieve: %s failed [HTTP %d]" % (url, x.code))
+                return False
+            delay = retryPolicy.delay(attempt)
+            log.warn(
+                "URL retrieve: %s failed [HTTP %d] (attempt %d/%d), retrying in %.0f s"
+                % (url, x.code, attempt, retryPolicy.attempts, delay)
+            )
+            time.sleep(delay)
+            attempt += 1
+
+
+def _retrieveUrlTimeout(url, fileName, log, timeout=0):
+    """Single attempt of retrieveUrlTimeout: HTTP errors other than 404 are raised"""
+    urlopen, _, HTTPError, URLError = importUrllib()
     urlData = ""
     if timeout:
         signal.signal(signal.SIGALRM, alarmTimeoutHandler)
@@ -182,11 +285,12 @@ def retrieveUrlTimeout(url, fileName, log, timeout=0):
         return urlData
 
     except HTTPError as x:
+        if timeout:
+            signal.alarm(0)
         if x.code == 404:
             log.error("URL retrieve: %s does not exist" % url)
-            if timeout:
-                signal.alarm(0)
             return False
+        raise
     except URLError:
         log.error('Timeout after %s seconds on transfer request for "%s"' % (str(timeout), url))
         return False
@@ -198,6 +302,289 @@ def retrieveUrlTimeout(url, fileName, log, timeout=0):
         raise x
 
 
+def getJobFeature(name, timeout=10):
+    """Value of a Machine/Job Features key, if available
+
+    JOBFEATURES is usually a local directory: the file is then read directly,
+    and only an URL requires a (time limited) remote access.
+
+    :param str name: the key, e.g. "allocated_cpu"
+    :param int timeout: timeout of the remote access, in seconds
+    :return: the value as a string, None if it can't be found
+    """
+    jobFeatures = os.environ.get("JOBFEATURES")
+    if not jobFeatures:
+        return None
+    try:
+        if "://" not in jobFeatures:
+            with open(os.path.join(jobFeatures, name)) as fp:
+                return fp.read().strip()
+        urlopen = importUrllib()[0]
+        return urlopen(jobFeatures.rstrip("/") + "/" + name, timeout=timeout).read().decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def getAllocatedProcessors(timeout=10):
+    """Number of processors allocated to the job, from Machine/Job Features if available
+
+    :param int timeout: timeout of the remote access, in seconds
+    :return: the number of processors, 1 if it can't be found
+    """
+    try:
+        return int(getJobFeature("allocated_cpu", timeout))
+    except (TypeError, ValueError):
+        return 1
+
+
+def getSlotDeadline(timeout=10):
+    """End of the batch slot (seconds since epoch), from Machine/Job Features if available
+
+    :param int timeout: timeout of the remote access, in seconds
+    :return: the deadline, None if it can't be found
+    """
+    try:
+        return int(getJobFeature("jobstart_secs", timeout)) + int(getJobFeature("wall_limit_secs", timeout))
+    except (TypeError, ValueError):
+        return None
+
+
+def _listdir(directory):
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        print("%s not found" % directory)
+        return []
+
+
+class DirectoryProbe(object):
+    """Listing of a directory, done by a DirectoryProber"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.contents = None
+        self.done = threading.Event()
+
+    def result(self, timeout):
+        """The listing of the directory, None if it did not complete within the timeout
+
+        :param float timeout: in seconds
+        """
+        self.done.wait(max(0, timeout))
+        return self.contents
+
+
+class DirectoryProber(object):
+    """Lists directories of lazily-loaded File Systems like CVMFS, which may hang.
+
+    The directories are listed by a bounded pool of daemon threads, shared by all the probes of the pilot,
+    so that several candidate directories can be probed at once.
+    A listing that does not complete within its timeout leaves a thread stuck: a new thread can replace it,
+    up to maxStuck stuck threads, and the mount point of the directory is not probed again (negative cache).
+    Directories can be pre-warmed: the first probe of such a directory then only waits for the end of
+    the listing started in advance (which triggers the mount, and the download of the CVMFS catalogs).
+    """
+
+    def __init__(self, maxWorkers=8, maxStuck=4):
+        """c'tor
+
+        :param int maxWorkers: number of threads listing directories
+        :param int maxStuck: maximum number of threads stuck on a listing that timed out
+        """
+        self.maxWorkers = maxWorkers
+        self.maxStuck = maxStuck
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+        self._stuck = set()
+        self._deadMountPoints = set()
+        self._prewarmed = {}
+
+    @staticmethod
+    def getMountPoint(directory):
+        """The CVMFS repository of a directory (/cvmfs/<repository>), or the directory itself"""
+        parts = os.path.abspath(directory).split(os.sep)
+        if len(parts) > 2 and parts[1] == "cvmfs":
+            return os.sep.join(parts[:3])
+        return directory
+
+    def probe(self, directory):
+        """Start listing a directory
+
+        :param str directory: directory to list
+        :return: DirectoryProbe
+        """
+        with self._lock:
+            if directory in self._prewarmed:
+                return self._prewarmed.pop(directory)
+        return self._probe(directory)
+
+    def _probe(self, directory):
+        probe = DirectoryProbe(directory)
+        with self._lock:
+            if self.getMountPoint(directory) in self._deadMountPoints or len(self._stuck) >= self.maxStuck:
+                probe.done.set()
+                return probe
+            self._tasks.put(probe)
+            if self._idle < self._tasks.qsize() and self._threads - len(self._stuck) < self.maxWorkers:
+                self._threads += 1
+                worker = threading.Thread(target=self._worker, name="DirectoryProber")
+                worker.daemon = True  # don't delay program's exit
+                worker.start()
+        return probe
+
+    def prewarm(self, directories):
+        """Start listing directories in the background, for the probes to come
+
+        :param list directories: directories to list
+        """
+        with self._lock:
+            directories = [directory for directory in directories if directory not in self._prewarmed]
+        for directory in directories:
+            probe = self._probe(directory)
+            with self._lock:
+                self._prewarmed.setdefault(directory, probe)
+
+    def waitPrewarm(self, directory, timeout=60):
+        """Wait for the end of the pre-warming of a directory, if it is still in progress
+
+        :return: False if the pre-warming did not complete within the timeout
+        """
+        with self._lock:
+            probe = self._prewarmed.get(directory)
+        if probe is None:
+            return True
+        return self.wait(probe, timeout) is not None
+
+    def _worker(self):
+        """Thread target: list the directories of the queue"""
+        while True:
+            with self._lock:
+                self._idle += 1
+            probe = self._tasks.get()
+            with self._lock:
+                self._idle -= 1
+            try:
+                probe.contents = _listdir(probe.directory)
+            except Exception:
+                probe.contents = []
+            probe.done.set()
+            with self._lock:
+                self._stuck.discard(probe)
+
+    def wait(self, probe, timeout):
+        """The listing of the probe, None if it did not complete within the timeout
+
+        :param DirectoryProbe probe: as returned by probe()
+        :param float timeout: in seconds
+        """
+        contents = probe.result(timeout)
+        if contents is None:
+            with self._lock:
+                if not probe.done.is_set():
+                    self._stuck.add(probe)
+                self._deadMountPoints.add(self.getMountPoint(probe.directory))
+        return contents
+
+    def listdir(self, directory, timeout=60):
+        """List a directory, with a timeout
+
+        :return: the list of entries, None if the listing did not complete within the timeout
+        """
+        return self.wait(self.probe(directory), timeout)
+
+    def isFile(self, path, timeout=60):
+        """Check that a file exists, listing its directory with a timeout (unlike os.path.isfile)"""
+        contents = self.listdir(os.path.dirname(path), timeout)
+        return bool(contents) and os.path.basename(path) in contents
+
+    def firstValid(self, probes, timeout=60):
+        """The first probe, in priority order, which lists a non-empty directory
+
+        :param list probes: probes (see probe()), by decreasing priority
+        :param float timeout: total timeout, in seconds
+        :return: DirectoryProbe, None if no directory is valid
+        """
+        deadline = time.time() + timeout
+        for probe in probes:
+            if self.wait(probe, deadline - time.time()):
+                return probe
+        return None
+
+
+directoryProber = DirectoryProber()
+
+# where InstallDIRAC finds the DIRACOS installers
+DIRACOS_INSTALL_SOURCE = "/cvmfs/dirac.egi.eu/installSource"
+
+DISCOVERY_TTL = 3600
+
+
+class NodeDiscoveryCache(object):
+    """Facts discovered by a pilot on the node (e.g. the CVMFS location of the security dirs),
+    shared with the next pilots of the node through a file of the node cache directory.
+
+    An entry is used for `ttl` seconds, if it still passes the check given by the caller (a stat of the path).
+    The file is updated under a lock, and written atomically: the readers never lock it.
+    """
+
+    def __init__(self, cacheDir, ttl=DISCOVERY_TTL, fileName="discovery.json"):
+        """c'tor
+
+        :param str cacheDir: the node cache directory
+        :param int ttl: lifetime of the entries, in seconds
+        :param str fileName: name of the cache file in cacheDir
+        """
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.cacheFile = os.path.join(cacheDir, fileName)
+        self._entries = None
+
+    def __read(self):
+        import json
+
+        try:
+            with open(self.cacheFile, "r") as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key, check=None):
+        """The value of a fresh entry
+
+        :param str key: the entry, including the inputs of the discovery
+        :param check: optional function, called with the value: the entry is ignored if it returns False
+        :return: the value, None if there is no valid entry
+        """
+        if self._entries is None:
+            self._entries = self.__read()
+        entry = self._entries.get(key)
+        if not entry or time.time() - entry["time"] > self.ttl:
+            return None
+        if check is not None and not check(entry["value"]):
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        """Record an entry, for the next pilots"""
+        import json
+
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir, 0o700)
+            with open(self.cacheFile + ".lock", "a") as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                self._entries = self.__read()
+                self._entries[key] = {"value": value, "time": time.time()}
+                tmpFile = "%s.%d" % (self.cacheFile, os.getpid())
+                with open(tmpFile, "w") as fp:
+                    json.dump(self._entries, fp)
+                os.rename(tmpFile, self.cacheFile)
+        except (IOError, OSError):
+            pass
+
+
 def safe_listdir(directory, timeout=60):
     """This is a "safe" list directory,
     for lazily-loaded File Systems like CVMFS.
@@ -210,22 +597,7 @@ def safe_listdir(directory, timeout=60):
     :param str directory: directory to list
     :param int timeout: optional timeout, in seconds. Defaults to 60.
     """
-
-    def listdir(directory):
-        try:
-            return os.listdir(directory)
-        except FileNotFoundError:
-            print("%s not found" % directory)
-            return []
-
-    contents = []
-    t = threading.Thread(target=lambda: contents.extend(listdir(directory)))
-    t.daemon = True  # don't delay program's exit
-    t.start()
-    t.join(timeout)
-    if t.is_alive():
-        return None  # timeout
-    return contents
+    return directoryProber.listdir(directory, timeout)
 
 
 def getSubmitterInfo(ceName):
@@ -364,96 +736,1596 @@ def getFlavour(ceName):
     return flavour, pilotReference
 
 
+# Pilot JSON files from this size (in bytes) are decoded lazily (see LazyJSONObject)
+LAZY_JSON_MIN_SIZE = 256 * 1024
+
+
+class LazyJSONObject(MutableMapping):
+    """A JSON object whose members are decoded only when accessed.
+
+    The object is indexed in a single pass on the text: for each member, only the position of its value is kept.
+    The values are skipped by a scanner which only matches the strings and the brackets, without building any
+    Python object, and a value is decoded by the json module (so at C speed) when it is first read.
+    Members which are objects are indexed the same way, up to `depth` levels: a pilot thus only builds its own CE,
+    and the sections it looks for, from a JSON file describing the whole grid. The text itself can be a memory map
+    of the file, so that the memory used does not grow with the size of the document.
+    """
+
+    _WHITESPACE = re.compile(br"\s*")
+    _STRING = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+    # what matters when skipping an array or an object: the brackets, and the strings which may contain some
+    _STRUCTURE = re.compile(br'["{}\[\]]')
+    # numbers, true, false and null
+    _SCALAR = re.compile(br"[^\s,:\]}]+")
+
+    def __init__(self, text, start=0, depth=1):
+        """c'tor
+
+        :param bytes text: the JSON document, UTF-8 encoded (bytes or mmap)
+        :param int start: offset of the object in text
+        :param int depth: number of levels of nested objects also indexed
+        """
+        self._text = text
+        # key -> (start, end) of the raw value, None for the values already decoded
+        self._spans = OrderedDict()
+        self._values = {}
+        self._end = self.__index(start, depth)
+
+    def __skipWhitespace(self, pos):
+        return self._WHITESPACE.match(self._text, pos).end()
+
+    def __expect(self, pos, chars):
+        char = self._text[pos : pos + 1]
+        if not char or char not in chars:
+            raise ValueError("Expecting one of '%s' at offset %d" % (chars.decode(), pos))
+
+    def __matchString(self, pos):
+        match = self._STRING.match(self._text, pos)
+        if not match:
+            raise ValueError("Unterminated string at offset %d" % pos)
+        return match
+
+    def __skipValue(self, start):
+        """Find the end of the value starting at start, without decoding it
+
+        :return: the offset of the end of the value
+        """
+        char = self._text[start : start + 1]
+        if char == b'"':
+            return self.__matchString(start).end()
+        if char not in (b"{", b"["):
+            match = self._SCALAR.match(self._text, start)
+            if not match:
+                raise ValueError("Expecting a value at offset %d" % start)
+            return match.end()
+        pos = start
+        nesting = 0
+        while True:
+            match = self._STRUCTURE.search(self._text, pos)
+            if not match:
+                raise ValueError("Unterminated value at offset %d" % start)
+            char = match.group()
+            if char == b'"':
+                pos = self.__matchString(match.start()).end()
+                continue
+            pos = match.end()
+            nesting += 1 if char in (b"{", b"[") else -1
+            if nesting == 0:
+                return pos
+
+    def __index(self, pos, depth):
+        """Find the position of the values of the object starting at pos
+
+        :return: the offset of the end of the object
+        """
+        import json
+
+        pos = self.__skipWhitespace(pos)
+        self.__expect(pos, b"{")
+        pos = self.__skipWhitespace(pos + 1)
+        if self._text[pos : pos + 1] == b"}":
+            return pos + 1
+        while True:
+            match = self._STRING.match(self._text, pos)
+            if not match:
+                raise ValueError("Expecting a key at offset %d" % pos)
+            key = json.loads(match.group().decode("utf-8"))
+            pos = self.__skipWhitespace(match.end())
+            self.__expect(pos, b":")
+            start = self.__skipWhitespace(pos + 1)
+            if depth > 0 and self._text[start : start + 1] == b"{":
+                self._values[key] = LazyJSONObject(self._text, start, depth - 1)
+                self._spans[key] = None
+                end = self._values[key]._end
+            else:
+                end = self.__skipValue(start)
+                self._spans[key] = (start, end)
+            pos = self.__skipWhitespace(end)
+            self.__expect(pos, b",}")
+            if self._text[pos : pos + 1] == b"}":
+                return pos + 1
+            pos = self.__skipWhitespace(pos + 1)
+
+    def __getitem__(self, key):
+        import json
+
+        if key not in self._values:
+            start, end = self._spans[key]
+            self._values[key] = json.loads(self._text[start:end].decode("utf-8"))
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._spans
+
+    def __setitem__(self, key, value):
+        self._spans[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._spans[key]
+        self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+
+class JSONOptionResolver(object):
+    """Read-only lookups of options in the pilot JSON content, by path ("/Setups/Defaults/Version").
+
+    Options are looked for in several paths, by order of precedence. The paths are split once,
+    and the sections and the values found are memoized, so that repeated lookups cost a dictionary access.
+    The JSON content is never modified: missing sections are just skipped.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, document):
+        """c'tor
+
+        :param dict document: the JSON content (not copied: it should not change once the resolver is used)
+        """
+        self.document = document
+        self._sections = {}
+        self._first = {}
+        self._merged = {}
+
+    def section(self, path):
+        """The section, or the value, at a path
+
+        :param path: str like "/Setups/Defaults", or tuple of keys
+        :return: the value found, None if the path does not exist
+        """
+        try:
+            return self._sections[path]
+        except KeyError:
+            pass
+        target = self.document
+        for elem in path.strip("/").split("/") if isinstance(path, basestring) else path:
+            if not isinstance(target, Mapping) or elem not in target:
+                target = None
+                break
+            target = target[elem]
+        self._sections[path] = target
+        return target
+
+    def first(self, paths, default=None):
+        """The value of the first path found
+
+        :param list paths: paths by decreasing order of precedence
+        :param default: returned if none of the paths exists
+        """
+        paths = tuple(paths)
+        value = self._first.get(paths, self._MISSING)
+        if value is self._MISSING:
+            value = None
+            for path in paths:
+                value = self.section(path)
+                if value is not None:
+                    break
+            self._first[paths] = value
+        return default if value is None else value
+
+    def firstList(self, paths, default=None):
+        """The value of the first path found, as a list: a comma-separated string is split
+
+        :param list paths: paths by decreasing order of precedence
+        :param default: returned if none of the paths exists
+        :return: list of str
+        """
+        value = self.first(paths)
+        if value is None:
+            return default
+        if isinstance(value, basestring):
+            value = value.split(",")
+        return [str(pv).strip() for pv in value]
+
+    def merged(self, paths):
+        """The options of several sections: the options of a section override the ones of the previous sections
+
+        :param list paths: paths of the sections, by increasing order of precedence
+        :return: dict (a copy, that can be modified)
+        """
+        paths = tuple(paths)
+        if paths not in self._merged:
+            options = {}
+            for path in paths:
+                section = self.section(path)
+                if isinstance(section, Mapping):
+                    options.update(section)
+            self._merged[paths] = options
+        return dict(self._merged[paths])
+
+
+SHARDS_INDEX = "index.json"
+SHARDS_DEFAULT = "default.json"
+SHARD_FILE = "pilot-shard.json"
+
+
+def getShardName(ceName):
+    """Name of the pilot JSON shard of a CE (see pilotShards.py), relative to the shards location
+
+    :param str ceName: the CE name, None or empty for the shard of the pilots without a known CE
+    :return: str
+    """
+    import hashlib
+
+    if not ceName:
+        return SHARDS_DEFAULT
+    if not re.match(r"^[A-Za-z0-9][A-Za-z0-9._-]*$", ceName):
+        # CE names are host names: anything else is not usable as it is in a file name or a URL
+        ceName = hashlib.sha1(ceName.encode("utf-8")).hexdigest()
+    return "CEs/%s.json" % ceName
+
+
+class Tracer(object):
+    """Timeline of the pilot execution, in the Trace Event Format, which can be loaded in Perfetto
+    or chrome://tracing. There's one span per command, and one per subprocess executed by the commands.
+
+    Events are appended to the file as they happen (the closing bracket is optional in this format),
+    so the trace is usable even if the pilot is killed, and forked processes can add their own events.
+    """
+
+    def __init__(self):
+        self.fd = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.fd is not None
+
+    @staticmethod
+    def now():
+        """Current time, in microseconds as expected in the trace events"""
+        return int(time.time() * 1000000)
+
+    def start(self, fileName):
+        """Start writing events into fileName
+
+        :param str fileName: the trace file, overwritten if it exists
+        """
+        import json
+
+        self.fd = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self._pid = os.getpid()
+        metadata = {"name": "process_name", "ph": "M", "pid": self._pid, "tid": 0, "args": {"name": "dirac-pilot"}}
+        os.write(self.fd, ("[" + json.dumps(metadata) + "\n").encode("utf-8"))
+
+    def stop(self):
+        """Close the events list. Only the process which started the trace can do it."""
+        if self.fd is None or os.getpid() != self._pid:
+            return
+        os.write(self.fd, b"]\n")
+        os.close(self.fd)
+        self.fd = None
+
+    def _write(self, event):
+        import json
+
+        # A single write on a file opened with O_APPEND: no need to lock between threads or processes
+        event["pid"] = os.getpid()
+        event["tid"] = threading.current_thread().ident
+        os.write(self.fd, ("," + json.dumps(event) + "\n").encode("utf-8"))
+
+    def complete(self, name, category, startTime, endTime, args=None):
+        """Add a span (times are in microseconds, see now())"""
+        if self.fd is None:
+            return
+        event = {"name": name, "cat": category, "ph": "X", "ts": startTime, "dur": endTime - startTime}
+        if args:
+            event["args"] = args
+        self._write(event)
+
+    def instant(self, name, category, **args):
+        """Add a marker"""
+        if self.fd is None:
+            return
+        self._write({"name": name, "cat": category, "ph": "i", "s": "t", "ts": self.now(), "args": args})
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Context manager adding a span for its body.
+        It yields the span arguments, which can be completed in the body (e.g. with a return code).
+        """
+        startTime = self.now()
+        try:
+            yield args
+        finally:
+            self.complete(name, category, startTime, self.now(), args)
+
+
+# The tracer used by the pilot: it does nothing until started (see the --trace option)
+tracer = Tracer()
+
+
+def _traceName(cmd):
+    """Short name of a shell command for the trace spans, e.g. "dirac-configure" """
+    words = cmd.split()
+    return os.path.basename(words[0]) if words else cmd
+
+
+# Number of functions and allocation sites reported by the profiling mode
+PROFILE_TOP = 25
+
+
+# Profiling is serialised: the profilers of concurrent commands would measure each other (see runProfiled)
+_profileLock = RLock()
+
+
+def runProfiled(command, func):
+    """Run func(command). If requested in the pilot parameters (--profile, --profileMemory) the call is
+    profiled with cProfile, and optionally tracemalloc.
+
+    The profile is dumped in <CommandName>.pstats in the working directory, the top allocations in
+    <CommandName>.malloc.txt, and a summary of both is logged. With the remote logger, the .pstats file is
+    also sent, compressed and base64 encoded, so that it can be analysed with the remote logs.
+    With --maxParallelCommands, the profiled commands are executed one at a time.
+    """
+    pp = command.pp
+    if not pp.profile and not pp.profileMemory:
+        return func(command)
+
+    import cProfile
+
+    tracemalloc = None
+    if pp.profileMemory:
+        try:
+            import tracemalloc
+        except ImportError:
+            command.log.warn("tracemalloc is not available: memory is not profiled")
+
+    with _profileLock:
+        # started once for the process: the allocations of each command are the difference of two snapshots
+        startSnapshot = None
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            startSnapshot = tracemalloc.take_snapshot()
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as exc:
+            # e.g. another profiler is active (Python >= 3.12)
+            command.log.warn("Could not profile %s: %s" % (command.__class__.__name__, str(exc)))
+            return func(command)
+        try:
+            return func(command)
+        finally:
+            profiler.disable()
+            try:
+                _reportProfile(command, profiler, tracemalloc, startSnapshot)
+            except Exception as exc:
+                command.log.error("Could not report the profile of %s: %s" % (command.__class__.__name__, str(exc)))
+
+
+def _reportProfile(command, profiler, tracemalloc=None, startSnapshot=None):
+    """Dump, log and send the results of runProfiled"""
+    import base64
+    import pstats
+    import zlib
+
+    name = command.__class__.__name__
+    profileFile = os.path.join(command.pp.workingDir, "%s.pstats" % name)
+    profiler.dump_stats(profileFile)
+    summary = StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    command.log.info("Profile of %s (full profile in %s):\n%s" % (name, profileFile, summary.getvalue()))
+    if getattr(command.log, "isPilotLoggerOn", False):
+        with open(profileFile, "rb") as fp:
+            encoded = base64.b64encode(zlib.compress(fp.read())).decode("ascii")
+        lines = [encoded[i : i + 76] for i in range(0, len(encoded), 76)]
+        command.log.sendMessage(
+            "BEGIN %s (zlib, base64)\n%s\nEND" % (os.path.basename(profileFile), "\n".join(lines))
+        )
+
+    if tracemalloc is None:
+        return
+    statistics = tracemalloc.take_snapshot().compare_to(startSnapshot, "lineno")[:PROFILE_TOP]
+    report = "\n".join(str(stat) for stat in statistics)
+    with open(os.path.join(command.pp.workingDir, "%s.malloc.txt" % name), "w") as fp:
+        fp.write(report + "\n")
+    command.log.info("Top %d allocations of %s:\n%s" % (PROFILE_TOP, name, report))
+
+
 class ObjectLoader(object):
     """Simplified class for loading objects from a DIRAC installation.
 
-    Example:
+    Example:
+
+    ```py
+    ol = ObjectLoader()
+    object, modulePath = ol.loadObject( 'pilot', 'LaunchAgent' )
+    ```
+    """
+
+    def __init__(self, baseModules, log):
+        """init"""
+        self.__rootModules = baseModules
+        self.log = log
+        # import time (in seconds) and failure reason of the modules imported by the loader, by full name
+        self.importTimes = {}
+        self.importErrors = {}
+        # results of loadObject
+        self.__objects = {}
+
+    def loadModule(self, modName, hideExceptions=False):
+        """Auto search which root module has to be used"""
+        for rootModule in self.__rootModules:
+            impName = modName
+            if rootModule:
+                impName = "%s.%s" % (rootModule, impName)
+            self.log.debug("Trying to load %s" % impName)
+            module, parentPath = self.__recurseImport(impName, hideExceptions=hideExceptions)
+            # Error. Something cannot be imported. Return error
+            if module is None:
+                return None, None
+            # Huge success!
+            return module, parentPath
+            # Nothing found, continue
+        # Return nothing found
+        return None, None
+
+    def __recurseImport(self, modName, parentModule=None, hideExceptions=False):
+        """Internal function to load modules.
+        Modules already in sys.modules are not executed again, and the ones loaded here are added to it.
+        Failed imports are not tried again.
+        """
+        if isinstance(modName, basestring):
+            modName = modName.split(".")
+        fullName = "%s.%s" % (parentModule.__name__, modName[0]) if parentModule else modName[0]
+        impModule = sys.modules.get(fullName)
+        if impModule is None:
+            if fullName in self.importErrors:
+                return None, None
+            startTime = time.time()
+            try:
+                if parentModule:
+                    impModule = import_submodule(parentModule, modName[0])
+                else:
+                    impModule = import_module(modName[0])
+            except ImportError as excp:
+                self.importErrors[fullName] = str(excp)
+                if "No module named" in str(excp) and modName[0] in str(excp):
+                    return None, None
+                if not hideExceptions:
+                    import traceback
+
+                    self.log.error("Can't load %s: %s" % (".".join(modName), str(excp)))
+                    self.log.error(traceback.format_exc())
+                return None, None
+            finally:
+                self.importTimes[fullName] = time.time() - startTime
+        if len(modName) == 1:
+            return impModule, parentModule.__path__[0]
+        return self.__recurseImport(modName[1:], impModule, hideExceptions=hideExceptions)
+
+    def loadObject(self, package, moduleName, command):
+        """Load an object from inside a module. The results are cached."""
+        key = (package, moduleName, command)
+        if key not in self.__objects:
+            self.__objects[key] = self.__loadObject(package, moduleName, command)
+        return self.__objects[key]
+
+    def __loadObject(self, package, moduleName, command):
+        loadModuleName = "%s.%s" % (package, moduleName)
+        module, parentPath = self.loadModule(loadModuleName)
+        if module is None:
+            return None, None
+        try:
+            commandObj = getattr(module, command)
+            return commandObj, os.path.join(parentPath, moduleName)
+        except AttributeError as e:
+            self.log.error("Exception: %s" % str(e))
+            return None, None
+
+
+class CommandRegistry(object):
+    """Map of the command names to the classes implementing them, built once per pilot.
+
+    Commands are looked for in the following modules, in this order:
+
+    1. `<CommandExtension>Commands`
+    2. `pilotCommands`
+
+    A module is imported only when a requested command was not found in the previous ones,
+    and all its command classes (classes with an `execute` method) are registered at once.
+    Commands redefined by a later module are reported, and so are the modules failing to import.
+    """
+
+    def __init__(self, extensions, log):
+        """c'tor
+
+        :param list extensions: the command extensions, e.g. ["LHCbPilot"]
+        :param log: logger
+        """
+        self.log = log
+        self.modules = [m + "Commands" for m in extensions + ["pilot"]]
+        # command name -> (class, module name)
+        self.commands = {}
+        # module name -> error message
+        self.importErrors = {}
+        self.__nextModule = 0
+
+    def __loadNextModule(self):
+        """Import the next module and register its commands"""
+        moduleName = self.modules[self.__nextModule]
+        self.__nextModule += 1
+        try:
+            module = import_module(moduleName)
+        except ImportError as exc:
+            self.importErrors[moduleName] = str(exc)
+            if "No module named" in str(exc) and moduleName in str(exc):
+                self.log.debug("No commands module %s" % moduleName)
+            else:
+                import traceback
+
+                self.log.error("Could not import %s: %s" % (moduleName, str(exc)))
+                self.log.error(traceback.format_exc())
+            return
+        except Exception as exc:
+            self.importErrors[moduleName] = str(exc)
+            import traceback
+
+            self.log.error("Could not import %s: %s" % (moduleName, str(exc)))
+            self.log.error(traceback.format_exc())
+            return
+
+        for name, obj in vars(module).items():
+            if not isinstance(obj, type) or not hasattr(obj, "execute"):
+                continue
+            if name not in self.commands:
+                self.commands[name] = (obj, moduleName)
+            elif obj.__module__ == module.__name__ and obj is not self.commands[name][0]:
+                self.log.warn("Command %s of %s is shadowed by %s" % (name, moduleName, self.commands[name][1]))
+
+    def get(self, commandName):
+        """Get the class implementing a command
+
+        :return: tuple (command class, module name), or (None, None) if the command can't be found
+        """
+        while commandName not in self.commands and self.__nextModule < len(self.modules):
+            self.__loadNextModule()
+        return self.commands.get(commandName, (None, None))
+
+
+# CommandRegistry for each list of command extensions
+_commandRegistries = {}
+
+
+def getCommandClass(params, commandName):
+    """Get the class implementing a command, without instantiating it.
+    See CommandRegistry for the modules where commands are looked for.
+
+    :return: tuple (command class, module name), or (None, None) if the command can't be found
+    """
+    extensions = tuple(params.commandExtensions)
+    if extensions not in _commandRegistries:
+        _commandRegistries[extensions] = CommandRegistry(list(extensions), params.log)
+    return _commandRegistries[extensions].get(commandName)
+
+
+def getCommand(params, commandName):
+    """Get an instantiated command object for execution.
+    See getCommandClass for the modules where commands are looked for.
+    """
+    commandClass, module = getCommandClass(params, commandName)
+    if commandClass is None:
+        # No command could be instantiated
+        return None, None
+    return commandClass(params), module
+
+
+def getCommandDependencies(commands):
+    """Compute, for each command, the commands that have to be completed before it can start.
+
+    A command depends on an earlier one (in the configured order) if it needs it (by name of the command
+    or of any of its base classes), if it needs a resource the other one produces, if both produce
+    the same resource, or if it produces a resource the other one needs. Commands not declaring
+    what they need (``needs = None``) depend on all the earlier commands, and all the later commands depend on them.
+
+    :param list commands: list of (command name, command class) tuples, in the configured order
+    :return: list of sets of indexes (in commands) of the dependencies of each command
+    """
+    dependencies = []
+    for index, (_name, commandClass) in enumerate(commands):
+        needs = getattr(commandClass, "needs", None)
+        produces = set(getattr(commandClass, "produces", ()))
+        commandDependencies = set()
+        for otherIndex in range(index):
+            otherName, otherClass = commands[otherIndex]
+            otherNeeds = getattr(otherClass, "needs", None)
+            if needs is None or otherNeeds is None:
+                commandDependencies.add(otherIndex)
+                continue
+            otherNames = set([otherName] + [cls.__name__ for cls in otherClass.__mro__])
+            otherProduces = set(getattr(otherClass, "produces", ()))
+            if (
+                otherNames.intersection(needs)
+                or otherProduces.intersection(needs)
+                or otherProduces.intersection(produces)
+                or produces.intersection(otherNeeds)
+            ):
+                commandDependencies.add(otherIndex)
+        dependencies.append(commandDependencies)
+    return dependencies
+
+
+# Default walltime (seconds) kept for the payload: optional commands are skipped, or cut short, to preserve it
+# (see the --optionalCommandsReserve option, and OptionalCommandsReserve in the JSON file)
+OPTIONAL_COMMANDS_RESERVE = 3600
+
+
+# PilotParams attributes that commands may set, and that are saved with each checkpoint
+CHECKPOINT_FIELDS = (
+    "rootPath",
+    "preinstalledEnv",
+    "flavour",
+    "pilotReference",
+    "batchSystemInfo",
+    "tags",
+    "reqtags",
+    "queueParameters",
+    "pilotProcessors",
+    "jobCPUReq",
+)
+
+
+def fileHash(fileName):
+    """sha1 of the content of a file, or None if it does not exist"""
+    import hashlib
+
+    try:
+        with open(fileName, "rb") as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def snapshotParams(pilotParams):
+    """The results of the commands: CHECKPOINT_FIELDS of the PilotParams and installEnv, as a JSON serializable dict"""
+    return {
+        "params": dict((field, getattr(pilotParams, field)) for field in CHECKPOINT_FIELDS),
+        "installEnv": dict(pilotParams.installEnv),
+    }
+
+
+# PilotParams attributes the PilotDaemon serves to the pilots: the installation only, the other ones
+# (rootPath, pilotReference, pilotProcessors, batchSystemInfo...) are specific to each pilot
+DAEMON_FIELDS = ("preinstalledEnv",)
+
+
+def restoreParams(pilotParams, snapshot):
+    """Restore the results of commands saved with snapshotParams"""
+    for field, value in snapshot["params"].items():
+        setattr(pilotParams, field, value)
+    pilotParams.installEnv.update(snapshot["installEnv"])
+
+
+class CommandCheckpoints(object):
+    """Journal of the commands completed by the pilots run in the working directory.
+
+    After each successful command, a line is appended with the command name, the CHECKPOINT_FIELDS of the
+    PilotParams, the installEnv and a hash of the local configuration file.
+    A pilot restarted in the same directory (e.g. requeued by the batch system) with the same arguments
+    and commands can then skip the commands already completed, after restoring their results.
+    """
+
+    def __init__(self, pilotParams, log, fileName="pilot.checkpoints"):
+        """c'tor
+
+        :param pilotParams: the PilotParams object of the pilot
+        :param log: logger
+        :param str fileName: journal file
+        """
+        import hashlib
+        import json
+
+        self.pp = pilotParams
+        self.log = log
+        self.fileName = fileName
+        self._lock = RLock()
+        self.signature = hashlib.sha1(json.dumps([sys.argv[1:], self.pp.commands]).encode("utf-8")).hexdigest()
+
+    def resume(self, commandNames):
+        """Restore the state left by the commands completed by a previous pilot.
+
+        Only the first commands in the list can be skipped: the ones before the first command not completed.
+        The journal is ignored if it was written for other arguments or commands,
+        or if the configuration file was modified after the last checkpoint.
+
+        :param list commandNames: the commands to execute, in order
+        :return: the number of commands (at the beginning of commandNames) that can be skipped
+        """
+        import json
+
+        entries = []
+        try:
+            with open(self.fileName, "r") as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # e.g. the pilot was killed while writing
+                        continue
+                    if entry.get("signature") == self.signature:
+                        entries.append(entry)
+        except IOError:
+            return 0
+
+        if not entries:
+            self.log.info("No valid checkpoint found in %s" % self.fileName)
+            self.__reset()
+            return 0
+        if entries[-1]["cfgHash"] != fileHash(self.pp.localConfigFile):
+            self.log.warn("%s was modified after the last checkpoint, not resuming" % self.pp.localConfigFile)
+            self.__reset()
+            return 0
+
+        completed = set(entry["command"] for entry in entries)
+        skipped = 0
+        for commandName in commandNames:
+            if commandName not in completed:
+                break
+            skipped += 1
+        skippedNames = set(commandNames[:skipped])
+        for entry in entries:
+            if entry["command"] in skippedNames:
+                restoreParams(self.pp, entry)
+        if skipped:
+            self.log.info("Resuming from checkpoints: skipping %s" % ", ".join(commandNames[:skipped]))
+        return skipped
+
+    def record(self, commandName):
+        """Write a checkpoint for a successfully completed command"""
+        import json
+
+        entry = snapshotParams(self.pp)
+        entry.update({"signature": self.signature, "command": commandName, "cfgHash": fileHash(self.pp.localConfigFile)})
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            with open(self.fileName, "a") as fp:
+                fp.write(line)
+
+    def __reset(self):
+        """Remove a journal that can't be used"""
+        try:
+            os.remove(self.fileName)
+        except OSError:
+            pass
+
+
+def daemonKey(pilotParams):
+    """What must be identical for a pilot to reuse the setup done by a PilotDaemon"""
+    import hashlib
+    import json
+
+    key = [
+        pilotParams.commands,
+        pilotParams.commandExtensions,
+        pilotParams.releaseVersion,
+        pilotParams.releaseProject,
+        pilotParams.modules,
+        pilotParams.setup,
+        pilotParams.ceName,
+        pilotParams.queueName,
+        pilotParams.localConfigFile,
+    ]
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+class PilotDaemon(object):
+    """Long-lived process, one per worker node, sharing the setup of DIRAC with the pilots of the node.
+
+    The daemon executes the setup commands (the ones before the first command which must run alone,
+    normally LaunchAgent), then serves their results on a Unix socket.
+    A pilot started with --daemonSocket gets them, and skips the commands marked as reusable (the installation):
+    only the commands specific to each pilot are executed again. Only the DAEMON_FIELDS of the PilotParams,
+    and the environment set by the installation, are served.
+
+    The protocol is one JSON line per request ({"key": <daemonKey>}) and per reply ({"state": ...} or {"error": ...}).
+    """
+
+    def __init__(self, pilotParams, log):
+        """c'tor
+
+        :param pilotParams: the PilotParams object of the daemon
+        :param log: logger
+        """
+        self.pp = pilotParams
+        self.log = log
+        self.key = daemonKey(pilotParams)
+        self.state = None
+
+    def setup(self, scheduler, commands):
+        """Execute the setup commands and keep their results
+
+        :param CommandScheduler scheduler: scheduler executing the commands
+        :param list commands: as returned by CommandScheduler.resolveCommands
+        """
+        setupCommands = []
+        for command in commands:
+            if command[1].needs is None:
+                break
+            setupCommands.append(command)
+        initialEnv = dict(os.environ)
+        scheduler.run(setupCommands)
+
+        self.state = {
+            "params": dict((field, getattr(self.pp, field)) for field in DAEMON_FIELDS),
+            # only what the commands changed: the pilots have their own proxy, working directory...
+            "installEnv": dict(
+                (name, value) for name, value in self.pp.installEnv.items() if initialEnv.get(name) != value
+            ),
+            "commands": [name for name, commandClass, _ in setupCommands if commandClass.reusable],
+        }
+        self.log.info("Pilot daemon ready, reusable commands: %s" % ", ".join(self.state["commands"]))
+
+    def isValid(self):
+        """Check that the installation is still usable, e.g. that it was not cleaned"""
+        for path in (self.state["params"]["preinstalledEnv"], self.state["installEnv"].get("DIRAC_RC_PATH")):
+            if path and not os.path.exists(path):
+                self.log.error("%s does not exist anymore" % path)
+                return False
+        return True
+
+    def handle(self, connection):
+        """Reply to a request"""
+        import json
+
+        request = json.loads(connection.makefile("rb").readline().decode("utf-8"))
+        if request.get("key") != self.key:
+            reply = {"error": "the daemon was set up for another pilot configuration"}
+        elif not self.isValid():
+            reply = {"error": "the daemon setup is not valid anymore"}
+        else:
+            reply = {"state": self.state}
+        connection.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+
+    def serve(self, socketPath):
+        """Serve the setup on socketPath, until the daemon is killed"""
+        import socket
+
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # the socket is created readable by the owner only: no window where other users can connect
+            oldUmask = os.umask(0o177)
+            try:
+                server.bind(socketPath)
+            finally:
+                os.umask(oldUmask)
+            server.listen(16)
+            self.log.info("Pilot daemon listening on %s" % socketPath)
+            while True:
+                connection, _ = server.accept()
+                try:
+                    self.handle(connection)
+                except Exception as exc:
+                    self.log.error("Could not reply to a pilot: %s" % str(exc))
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            if os.path.exists(socketPath):
+                os.remove(socketPath)
+
+
+def reuseDaemonSetup(pilotParams, log, commands, timeout=30):
+    """Get the setup done by the PilotDaemon of the node, if it matches this pilot
+
+    :param pilotParams: the PilotParams object of the pilot, updated with the results of the daemon commands
+    :param log: logger
+    :param list commands: as returned by CommandScheduler.resolveCommands
+    :param int timeout: timeout of the exchange with the daemon, in seconds
+    :return: the commands that must still be executed by the pilot
+    """
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(pilotParams.daemonSocket)
+        client.sendall((json.dumps({"key": daemonKey(pilotParams)}) + "\n").encode("utf-8"))
+        reply = json.loads(client.makefile("rb").readline().decode("utf-8"))
+    except (socket.error, ValueError) as exc:
+        log.warn("Pilot daemon not available on %s: %s" % (pilotParams.daemonSocket, str(exc)))
+        return commands
+    finally:
+        client.close()
+    if "error" in reply:
+        log.warn("Not using the pilot daemon: %s" % reply["error"])
+        return commands
+
+    state = reply["state"]
+    restoreParams(pilotParams, state)
+    log.info("Reusing from the pilot daemon: %s" % ", ".join(state["commands"]))
+    return [command for command in commands if command[0] not in state["commands"]]
+
+
+class CommandScheduler(object):
+    """Executes the pilot commands, in the configured order.
+
+    With more than one worker, a command is started as soon as the commands it depends on are completed
+    (see getCommandDependencies), so that independent commands run concurrently.
+    Commands that do not declare their dependencies are always run alone, in the main thread.
+    If a command fails, no new command is started, the running ones are waited for,
+    and the failure (usually a SystemExit) is re-raised.
+    With checkpoints, the commands completed by a previous pilot are skipped, and each completed command is recorded.
+    """
+
+    def __init__(self, pilotParams, log, maxWorkers=1, checkpoints=None):
+        """c'tor
+
+        :param pilotParams: the PilotParams object given to each command
+        :param log: logger
+        :param int maxWorkers: maximum number of commands executed concurrently
+        :param CommandCheckpoints checkpoints: optional checkpoints journal
+        """
+        self.pp = pilotParams
+        self.log = log
+        self.maxWorkers = max(1, maxWorkers)
+        self.checkpoints = checkpoints
+
+    def resolveCommands(self):
+        """Find the classes of all the commands to execute.
+
+        :return: list of (command name, command class, module) tuples, or None if a command can't be found
+        """
+        commands = []
+        for commandName in self.pp.commands:
+            commandClass, module = getCommandClass(self.pp, commandName)
+            if commandClass is None:
+                self.log.error("Command %s could not be instantiated" % commandName)
+                return None
+            commands.append((commandName, commandClass, module))
+        return commands
+
+    def run(self, commands):
+        """Execute the commands
+
+        :param list commands: as returned by resolveCommands
+        """
+        if self.checkpoints is not None:
+            commands = commands[self.checkpoints.resume([command[0] for command in commands]) :]
+
+        if self.maxWorkers == 1:
+            for commandName, commandClass, module in commands:
+                self._execute(commandName, commandClass, module)
+            return
+
+        dependencies = getCommandDependencies([(name, commandClass) for name, commandClass, _ in commands])
+        pending = list(range(len(commands)))
+        running = set()
+        done = set()
+        finished = {}
+        failure = None
+        condition = threading.Condition()
+
+        while running or (pending and failure is None):
+            with condition:
+                for index, error in list(finished.items()):
+                    del finished[index]
+                    running.discard(index)
+                    if error is None:
+                        done.add(index)
+                    elif failure is None:
+                        failure = error
+                if not pending and not running:
+                    continue
+                if failure is not None:
+                    if running:
+                        condition.wait()
+                    continue
+
+                ready = [index for index in pending if dependencies[index].issubset(done)]
+                if not ready or len(running) >= self.maxWorkers:
+                    condition.wait()
+                    continue
+                index = ready[0]
+                commandName, commandClass, module = commands[index]
+                isBarrier = getattr(commandClass, "needs", None) is None
+                if isBarrier and running:
+                    condition.wait()
+                    continue
+                pending.remove(index)
+                if not isBarrier:
+                    running.add(index)
+                    worker = threading.Thread(
+                        target=self._worker, args=(index, commands[index], finished, condition), name=commandName
+                    )
+                    worker.daemon = True
+                    worker.start()
+                    continue
+
+            # Commands with undeclared dependencies run alone, in the main thread
+            self._execute(commandName, commandClass, module)
+            done.add(index)
+
+        if failure is not None:
+            raise failure
+
+    def _worker(self, index, command, finished, condition):
+        """Thread target: execute a command and report its outcome"""
+        error = None
+        try:
+            self._execute(*command)
+        except SystemExit as exc:
+            error = exc
+        except BaseException as exc:
+            import traceback
+
+            self.log.error("Command %s failed: %s" % (command[0], str(exc)))
+            self.log.error(traceback.format_exc())
+            error = exc
+        with condition:
+            finished[index] = error
+            condition.notify()
+
+    def getDeadline(self, commandName, commandClass):
+        """Time (seconds since epoch) at which the command must be stopped, None if there is no limit
+
+        It is the earliest of the command time limit (CommandTimeouts in the JSON file) and the end of the slot,
+        minus the optionalCommandsReserve for optional commands.
+        """
+        deadlines = []
+        timeout = self.pp.commandTimeouts.get(commandName)
+        if timeout:
+            deadlines.append(time.time() + timeout)
+        if self.pp.slotDeadline:
+            deadlines.append(self.pp.slotDeadline - (self.pp.optionalCommandsReserve if commandClass.optional else 0))
+        return min(deadlines) if deadlines else None
+
+    def _execute(self, commandName, commandClass, module):
+        """Instantiate and execute a single command, again if it fails and CommandRetries allows it"""
+        deadline = self.getDeadline(commandName, commandClass)
+        if commandClass.optional and deadline is not None and deadline <= time.time():
+            self.log.warn("Skipping the optional command %s: not enough walltime left" % commandName)
+            return
+        retryPolicy = RetryPolicy(attempts=self.pp.commandRetries.get(commandName, 0) + 1)
+        attempt = 1
+        while True:
+            command = None
+            try:
+                with tracer.span(commandName, "command", module=module, attempt=attempt):
+                    command = commandClass(self.pp)
+                    command.deadline = deadline
+                    command.commandRetryPolicy = retryPolicy
+                    command.attempt = attempt
+                    command.log.info("Command %s instantiated from %s" % (commandName, module))
+                    command.execute()
+                break
+            except SystemExit as exc:
+                # the same decision as logFinalizer, which finalised the remote logs if it is None
+                delay = command.retryDelay(exc.code) if command is not None else None
+                if delay is None:
+                    raise
+                self.log.warn(
+                    "Command %s failed [ERROR %s] (attempt %d/%d), retrying in %.0f s"
+                    % (commandName, exc.code, attempt, retryPolicy.attempts, delay)
+                )
+                time.sleep(delay)
+                attempt += 1
+                deadline = self.getDeadline(commandName, commandClass)
+        if self.checkpoints is not None:
+            self.checkpoints.record(commandName)
+
+
+_timestampCache = (None, "")
+_timestampPrefixCache = (None, "")
+
+
+def utcTimestamp(now=None):
+    """Timestamp in ISO-8601 format (UTC), at millisecond resolution, e.g. 2024-05-12T10:20:30.123000Z
+    (the microseconds field of the previous format is kept, for the parsers of the logs).
+    The timestamp is formatted once per millisecond, and the date and time once per second.
+
+    :param float now: seconds since the epoch (default: now)
+    :return: str
+    """
+    global _timestampCache, _timestampPrefixCache
+    if now is None:
+        now = time.time()
+    millisecond = int(now * 1000)
+    cachedMillisecond, timestamp = _timestampCache
+    if cachedMillisecond != millisecond:
+        second = millisecond // 1000
+        cachedSecond, prefix = _timestampPrefixCache
+        if cachedSecond != second:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            _timestampPrefixCache = (second, prefix)
+        timestamp = "%s.%03d000Z" % (prefix, millisecond % 1000)
+        _timestampCache = (millisecond, timestamp)
+    return timestamp
+
+
+LOG_FLUSH_POLICIES = ("message", "interval", "exit")
+
+
+LOG_FORMATS = ("classic", "json", "both")
+# version of the fields of the JSON log records, to be increased when they change
+LOG_SCHEMA_VERSION = 1
+JSON_LOG_SUFFIX = ".jsonl"
+
+# per thread: the subprocess run by executeAndGetOutput, recorded in the JSON log records
+_logContext = threading.local()
+
+
+def getLogRecord(level, name, message):
+    """A log record, as written in the JSON log file
+
+    :param str level: DEBUG, INFO, WARN or ERROR
+    :param str name: name of the logger (the command)
+    :param str message: the message, possibly multi-line
+    :return: dict
+    """
+    return {
+        "schema": LOG_SCHEMA_VERSION,
+        "timestamp": utcTimestamp(),
+        "level": level,
+        "command": name,
+        "pilotUUID": LogSink.pilotUUID,
+        "pid": os.getpid(),
+        "subprocess": getattr(_logContext, "subprocess", None),
+        "message": message,
+    }
+
+
+ERRORS_LOG_SUFFIX = ".errors"
+
+
+def getLogSegments(fileName):
+    """The rotated segments of a log file (see LogFile), oldest first
+
+    :param str fileName: the log file
+    :return: list of (segment number, path)
+    """
+    dirName, baseName = os.path.split(os.path.abspath(fileName))
+    pattern = re.compile(re.escape(baseName) + r"\.(\d+)(\.gz)?$")
+    segments = []
+    try:
+        names = os.listdir(dirName)
+    except OSError:
+        names = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(dirName, name)))
+    return sorted(segments)
+
+
+def compressLogSegment(segment, fileName, backupCount):
+    """Compress a rotated segment of a log file, then remove the oldest segments beyond backupCount
+
+    :param str segment: the segment, replaced by segment.gz
+    :param str fileName: the log file
+    :param int backupCount: number of segments kept
+    """
+    import gzip
+    import shutil
+
+    try:
+        # written in a temporary file then renamed: a segment.gz is always complete
+        with open(segment, "rb") as src, gzip.open(segment + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.rename(segment + ".gz.tmp", segment + ".gz")
+        os.remove(segment)
+    except (IOError, OSError):
+        pass
+    segments = getLogSegments(fileName)
+    for _number, path in segments[: max(0, len(segments) - backupCount)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class LogFile(object):
+    """A log file, rotated when it reaches a maximum size.
+
+    The rotated segments are named <file>.<number>, and compressed in a background thread into <file>.<number>.gz.
+    Only the last backupCount segments are kept.
+    """
+
+    def __init__(self, fileName):
+        """c'tor
+
+        :param str fileName: the log file
+        """
+        self.fileName = fileName
+        self._file = open(fileName, "a")
+        self._size = os.path.getsize(fileName)
+        self._segment = None
+        self._compressors = []
+
+    def write(self, text, maxSize=0, backupCount=0):
+        """Write text, and rotate the file if it reaches maxSize
+
+        :param str text: complete lines
+        :param int maxSize: in bytes, 0 for no rotation
+        :param int backupCount: number of rotated segments kept
+        """
+        self._file.write(text)
+        self._size += len(text)
+        if maxSize and self._size >= maxSize:
+            self.rotate(backupCount)
+
+    def rotate(self, backupCount):
+        """Move the file to its next segment, compressed in the background, and start a new one"""
+        if self._segment is None:
+            # a pilot restarted in the same directory continues the numbering
+            segments = getLogSegments(self.fileName)
+            self._segment = segments[-1][0] if segments else 0
+        self._segment += 1
+        segment = "%s.%d" % (self.fileName, self._segment)
+        # a failed rotation (e.g. the file was removed) must not fail the logging: the current file is kept,
+        # and the rotation tried again after another maxSize bytes
+        self._size = 0
+        try:
+            os.rename(self.fileName, segment)
+            newFile = open(self.fileName, "a")
+        except (IOError, OSError):
+            return
+        self._file.close()
+        self._file = newFile
+        compressor = threading.Thread(target=compressLogSegment, args=(segment, self.fileName, backupCount))
+        compressor.daemon = True
+        compressor.start()
+        self._compressors = [thread for thread in self._compressors if thread.is_alive()] + [compressor]
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """Close the file, and wait for the compression of the rotated segments"""
+        self._file.close()
+        for compressor in self._compressors:
+            compressor.join()
+        self._compressors = []
+
+
+class LogSink(object):
+    """Local output of the loggers: a log file, and stdout.
+
+    There is one sink per process and per log file (see getLogSink), shared by all the Logger objects:
+    the file is opened once. The file and stdout are flushed according to the flush policy (see configureLogging):
+    after each message, at most every flushInterval seconds, or only at exit. Errors are always flushed right away.
+
+    According to the log format, the log file has the classic "{datestamp} {level} [{name}] {message}" lines,
+    and/or a JSON object per message (see getLogRecord) is written in the log file name + JSON_LOG_SUFFIX
+    (e.g. pilot.out.jsonl). stdout always has the classic lines.
+
+    The log files are rotated when they reach maxSize bytes (see LogFile). The errors, and the messages logged
+    within keptLogs(), are then also written in the log file name + ERRORS_LOG_SUFFIX, which is never rotated.
+    """
+
+    flushPolicy = "message"
+    flushInterval = 1.0
+    logFormat = "classic"
+    pilotUUID = "unknown"
+    maxSize = 0
+    backupCount = 5
+
+    def __init__(self, fileName):
+        """c'tor
+
+        :param str fileName: the log file
+        """
+        self.fileName = fileName
+        self._file = None
+        self._jsonFile = None
+        self._errorsFile = None
+        self._lock = RLock()
+        self._lastFlush = time.time()
+
+    def log(self, record, header=True, keep=False):
+        """Write a log record (see getLogRecord) in the format of the sink
+
+        :param dict record: the log record
+        :param bool header: whether the classic lines start with the timestamp, level and logger name
+        :param bool keep: write it in the errors file too, when the log files are rotated
+        """
+        import json
+
+        lines = record["message"].split("\n")
+        if header:
+            prefix = "%s %s [%s] " % (record["timestamp"], record["level"], record["command"])
+            lines = [prefix + _line for _line in lines]
+        text = "\n".join(lines) + "\n"
+        with self._lock:
+            if self.logFormat != "classic":
+                if self._jsonFile is None:
+                    self._jsonFile = LogFile(self.fileName + JSON_LOG_SUFFIX)
+                self._jsonFile.write(json.dumps(record, separators=(",", ":")) + "\n", self.maxSize, self.backupCount)
+            if self.maxSize and (keep or record["level"] == "ERROR"):
+                self.keep(text)
+            self.write(text, urgent=record["level"] == "ERROR", toFile=self.logFormat != "json")
+
+    def write(self, text, urgent=False, toFile=True):
+        """Write complete lines
+
+        :param str text: the lines, each ending with a newline
+        :param bool urgent: flush whatever the policy (e.g. for errors)
+        :param bool toFile: write them in the log file too, not only on stdout
+        """
+        with self._lock:
+            if toFile:
+                if self._file is None:
+                    self._file = LogFile(self.fileName)
+                self._file.write(text, self.maxSize, self.backupCount)
+            sys.stdout.write(text)
+            if urgent or self.flushPolicy == "message":
+                self.flush()
+            elif self.flushPolicy == "interval" and time.time() - self._lastFlush >= self.flushInterval:
+                self.flush()
+
+    def keep(self, text):
+        """Write complete lines in the errors file, flushed right away"""
+        with self._lock:
+            if self._errorsFile is None:
+                self._errorsFile = LogFile(self.fileName + ERRORS_LOG_SUFFIX)
+            self._errorsFile.write(text)
+            self._errorsFile.flush()
+
+    def flush(self):
+        with self._lock:
+            for fp in (self._file, self._jsonFile, self._errorsFile):
+                if fp is not None:
+                    fp.flush()
+            sys.stdout.flush()
+            self._lastFlush = time.time()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            for fp in (self._file, self._jsonFile, self._errorsFile):
+                if fp is not None:
+                    fp.close()
+
+
+LOG_OVERFLOW_POLICIES = ("block", "drop")
+
+
+def writeStream(stream, text):
+    """Write text to a stream (stdout, stderr), and flush it"""
+    stream.write(text)
+    stream.flush()
+
+
+class LogWriter(object):
+    """Executes the writes of the loggers (to the log sinks, stdout, and the remote logger buffer).
+
+    By default the writes are done right away, by the caller. In asynchronous mode (see configureLogging),
+    they are queued, in order, and done by a single background thread: the callers never wait for the log I/O,
+    except if the queue is full and the overflow policy is "block" (with "drop", the write is dropped).
 
-    ```py
-    ol = ObjectLoader()
-    object, modulePath = ol.loadObject( 'pilot', 'LaunchAgent' )
-    ```
+    A forked child (e.g. CommandBase.forkAndExecute) does not have the writer thread: it writes synchronously.
+    So does the writer thread itself, when a write logs a message.
     """
 
-    def __init__(self, baseModules, log):
-        """init"""
-        self.__rootModules = baseModules
-        self.log = log
-
-    def loadModule(self, modName, hideExceptions=False):
-        """Auto search which root module has to be used"""
-        for rootModule in self.__rootModules:
-            impName = modName
-            if rootModule:
-                impName = "%s.%s" % (rootModule, impName)
-            self.log.debug("Trying to load %s" % impName)
-            module, parentPath = self.__recurseImport(impName, hideExceptions=hideExceptions)
-            # Error. Something cannot be imported. Return error
-            if module is None:
-                return None, None
-            # Huge success!
-            return module, parentPath
-            # Nothing found, continue
-        # Return nothing found
-        return None, None
+    def __init__(self):
+        self.overflow = "block"
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
 
-    def __recurseImport(self, modName, parentModule=None, hideExceptions=False):
-        """Internal function to load modules"""
-        if isinstance(modName, basestring):
-            modName = modName.split(".")
+    @property
+    def isAsync(self):
+        return self.__pending() is not None
+
+    def __pending(self):
+        """The queue, if the writer thread runs in this process"""
+        if self._queue is not None and self._pid != os.getpid():
+            self.afterFork()
+        return self._queue
+
+    def afterFork(self):
+        """In a forked child: switch back to the synchronous mode, the writer thread was not forked"""
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def start(self, queueSize=10000, overflow="block"):
+        """Switch to the asynchronous mode
+
+        :param int queueSize: maximum number of pending writes
+        :param str overflow: one of LOG_OVERFLOW_POLICIES, what to do with a write when the queue is full
+        """
+        if overflow not in LOG_OVERFLOW_POLICIES:
+            raise ValueError("Unknown log overflow policy %s" % overflow)
+        self.overflow = overflow
+        with self._lock:
+            if self.__pending() is not None:
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(queueSize)
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name="LogWriter")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Write the pending messages, and switch back to the synchronous mode"""
+        self.__pending()
+        with self._lock:
+            pending, self._queue = self._queue, None
+            thread, self._thread = self._thread, None
+        if pending is not None:
+            pending.put((None, ()))
+            thread.join()
+            self.__reportDropped()
+
+    def submit(self, func, *args):
+        """Execute (or queue) a write
+
+        :param func: the function doing the write
+        :param args: its arguments
+        """
+        pending = self.__pending()
+        if pending is None or threading.current_thread() is self._thread:
+            # the writes submitted by a write (e.g. the errors of RemoteLogger._bufferMessage) are done right away:
+            # the writer thread must never wait for its own queue
+            func(*args)
+            return
         try:
-            if parentModule:
-                impModule = load_module_from_path(modName[0], parentModule.__path__)
-            else:
-                impModule = import_module(modName[0])
-        except ImportError as excp:
-            if str(excp).find("No module named %s" % modName[0]) == 0:
-                return None, None
-            errMsg = "Can't load %s in %s" % (".".join(modName), parentModule.__path__[0])
-            if not hideExceptions:
-                self.log.exception(errMsg)
-            return None, None
-        if len(modName) == 1:
-            return impModule, parentModule.__path__[0]
-        return self.__recurseImport(modName[1:], impModule, hideExceptions=hideExceptions)
+            pending.put((func, args), block=self.overflow == "block")
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def drain(self):
+        """Wait until the queued writes are done"""
+        pending = self.__pending()
+        if pending is not None and threading.current_thread() is not self._thread:
+            pending.join()
+        self.__reportDropped()
+
+    def __reportDropped(self):
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            writeStream(sys.stderr, "WARNING: %d log messages dropped (log queue full)\n" % dropped)
 
-    def loadObject(self, package, moduleName, command):
-        """Load an object from inside a module"""
-        loadModuleName = "%s.%s" % (package, moduleName)
-        module, parentPath = self.loadModule(loadModuleName)
-        if module is None:
-            return None, None
-        try:
-            commandObj = getattr(module, command)
-            return commandObj, os.path.join(parentPath, moduleName)
-        except AttributeError as e:
-            self.log.error("Exception: %s" % str(e))
-            return None, None
+    @staticmethod
+    def _run(pending):
+        """Thread target: do the writes of the queue"""
+        while True:
+            func, args = pending.get()
+            try:
+                if func is None:
+                    return
+                func(*args)
+            except Exception as exc:
+                writeStream(sys.stderr, "WARNING: could not write a log message: %s\n" % str(exc))
+            finally:
+                pending.task_done()
 
 
-def getCommand(params, commandName):
-    """Get an instantiated command object for execution.
-    Commands are looked in the following modules in the order:
+logWriter = LogWriter()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=logWriter.afterFork)
 
-    1. `<CommandExtension>PilotCommands`
-    2. `PilotCommands`
-    """
-    extensions = params.commandExtensions
-    modules = [m + "Commands" for m in extensions + ["pilot"]]
-    commandObject = None
 
-    # Look for commands in the modules in the current directory first
-    for module in modules:
-        try:
-            commandModule = import_module(module)
-            commandObject = getattr(commandModule, commandName)
-        except Exception:
-            pass
-        if commandObject:
-            return commandObject(params), module
+def drainLogs():
+    """Wait until all the log messages are written (see LogWriter)"""
+    logWriter.drain()
+
 
-    # No command could be instantiated
-    return None, None
+_logSinks = {}
+_logSinksLock = RLock()
+
+
+def getLogSink(fileName):
+    """The LogSink of a log file, for this process
+
+    :param str fileName: the log file
+    :return: LogSink
+    """
+    key = (os.getpid(), os.path.abspath(fileName))
+    with _logSinksLock:
+        if key not in _logSinks:
+            if not _logSinks:
+                atexit.register(closeLogSinks)
+            _logSinks[key] = LogSink(fileName)
+        return _logSinks[key]
+
+
+def flushLogSinks():
+    """Flush the log files and stdout"""
+    with _logSinksLock:
+        for (pid, _), sink in _logSinks.items():
+            if pid == os.getpid():
+                sink.flush()
+
+
+def closeLogSinks():
+    """Write the pending messages, flush and close the log files: the next messages open them again"""
+    logWriter.drain()
+    with _logSinksLock:
+        for (pid, _), sink in list(_logSinks.items()):
+            if pid == os.getpid():
+                sink.close()
+        _logSinks.clear()
+
+
+@contextmanager
+def keptLogs():
+    """Context manager: the messages logged by this thread are kept in the errors file (see LogSink)"""
+    _logContext.keep = True
+    try:
+        yield
+    finally:
+        _logContext.keep = False
+
+
+def configureLogging(
+    flushPolicy=None,
+    flushInterval=None,
+    queueSize=None,
+    overflow="block",
+    logFormat=None,
+    pilotUUID=None,
+    maxSize=None,
+    backupCount=None,
+):
+    """Configure the output of all the loggers
+
+    :param str flushPolicy: one of LOG_FLUSH_POLICIES: "message" (flush after each message),
+                            "interval" (flush at most every flushInterval seconds) or "exit" (flush at exit)
+    :param float flushInterval: in seconds, for the "interval" policy
+    :param int queueSize: size of the queue of the asynchronous mode (see LogWriter), 0 for the synchronous mode
+    :param str overflow: one of LOG_OVERFLOW_POLICIES, for the asynchronous mode
+    :param str logFormat: one of LOG_FORMATS: the classic lines, JSON records, or both (see LogSink)
+    :param str pilotUUID: pilot UUID, in the JSON records
+    :param int maxSize: size in bytes at which the log files are rotated, 0 for no rotation
+    :param int backupCount: number of rotated segments kept for each log file
+    """
+    if flushPolicy is not None:
+        if flushPolicy not in LOG_FLUSH_POLICIES:
+            raise ValueError("Unknown log flush policy %s" % flushPolicy)
+        LogSink.flushPolicy = flushPolicy
+    if flushInterval is not None:
+        LogSink.flushInterval = flushInterval
+    if logFormat is not None:
+        if logFormat not in LOG_FORMATS:
+            raise ValueError("Unknown log format %s" % logFormat)
+        LogSink.logFormat = logFormat
+    if pilotUUID is not None:
+        LogSink.pilotUUID = pilotUUID
+    if maxSize is not None:
+        LogSink.maxSize = maxSize
+    if backupCount is not None:
+        LogSink.backupCount = backupCount
+    if queueSize:
+        logWriter.start(queueSize, overflow)
+    elif queueSize is not None:
+        logWriter.stop()
 
 
 class Logger(object):
@@ -473,25 +2345,13 @@ class Logger(object):
         :return: template string
         :rtype: str
         """
-        return self._headerTemplate.format(
-            datestamp=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            name=self.name,
-        )
+        return self._headerTemplate.format(datestamp=utcTimestamp(), name=self.name)
 
     def __outputMessage(self, msg, level, header):
-        if self.out:
-            with open(self.out, "a") as outputFile:
-                for _line in str(msg).split("\n"):
-                    if header:
-                        outLine = self.messageTemplate.format(level=level, message=_line)
-                        print(outLine)
-                        if self.out:
-                            outputFile.write(outLine + "\n")
-                    else:
-                        print(_line)
-                        outputFile.write(_line + "\n")
-
-        sys.stdout.flush()
+        if not self.out:
+            return
+        keep = getattr(_logContext, "keep", False)
+        logWriter.submit(getLogSink(self.out).log, getLogRecord(level, self.name, str(msg)), header, keep)
 
     def setDebug(self):
         self.debugFlag = True
@@ -576,6 +2436,9 @@ class RemoteLogger(Logger):
         :return: None
         :rtype: None
         """
+        logWriter.submit(self._bufferMessage, msg)
+
+    def _bufferMessage(self, msg):
         try:
             self.buffer.write(msg + "\n")
         except Exception as err:
@@ -670,6 +2533,7 @@ class FixedSizeBuffer(object):
         :rtype:  None
         """
         if not self.output.closed and self._nlines > 0:
+            tracer.instant("RemoteLogger flush", "logging", lines=self._nlines)
             self.output.flush()
             buf = self.getValue()
             self.senderFunc(buf)
@@ -687,6 +2551,40 @@ class FixedSizeBuffer(object):
             self._timer.cancel()
 
 
+_sslContexts = {}
+_sslContextsLock = RLock()
+
+
+def getSSLContext(caPath, cert):
+    """SSL context with the CAs and the credentials of the pilot, created again only when the credentials change
+
+    :param str caPath: directory of the CA certificates
+    :param str cert: the proxy, or a directory containing hostcert.pem and hostkey.pem
+    :return: the context, and True if the credentials are the host ones
+    """
+    import ssl
+
+    try:
+        from Pilot.proxyTools import fileIdentity
+    except ImportError:
+        from proxyTools import fileIdentity
+
+    isHost = os.path.isdir(cert)
+    key = (caPath, fileIdentity(os.path.join(cert, "hostcert.pem") if isHost else cert))
+    with _sslContextsLock:
+        if key not in _sslContexts:
+            context = ssl.create_default_context()
+            context.load_verify_locations(capath=caPath)
+            if isHost:
+                context.load_cert_chain(os.path.join(cert, "hostcert.pem"), os.path.join(cert, "hostkey.pem"))
+            else:
+                context.load_cert_chain(cert)  # this is a proxy
+            # the contexts of the previous versions of the credentials are not needed anymore
+            _sslContexts.clear()
+            _sslContexts[key] = (context, isHost)
+        return _sslContexts[key]
+
+
 def sendMessage(url, pilotUUID, wnVO, method, rawMessage):
     """
     Invoke a remote method on a Tornado server and pass a JSON message to it.
@@ -698,20 +2596,16 @@ def sendMessage(url, pilotUUID, wnVO, method, rawMessage):
     :param str rawMessage: a message to be sent, in JSON format
     :return: None.
     """
-    caPath = os.getenv("X509_CERT_DIR")
-    cert = os.getenv("X509_USER_PROXY")
+    import json
 
-    context = ssl.create_default_context()
-    context.load_verify_locations(capath=caPath)
+    urlopen, urlencode, _, _ = importUrllib()
+    context, isHost = getSSLContext(os.getenv("X509_CERT_DIR"), os.getenv("X509_USER_PROXY"))
 
     message = json.dumps((json.dumps(rawMessage), pilotUUID, wnVO))
 
-    try:
-        context.load_cert_chain(cert)  # this is a proxy
-        raw_data = {"method": method, "args": message}
-    except IsADirectoryError:  # assuming it'a dir containing cert and key
-        context.load_cert_chain(os.path.join(cert, "hostcert.pem"), os.path.join(cert, "hostkey.pem"))
-        raw_data = {"method": method, "args": message, "extraCredentials": '"hosts"'}
+    raw_data = {"method": method, "args": message}
+    if isHost:  # a dir containing cert and key
+        raw_data["extraCredentials"] = '"hosts"'
 
     if sys.version_info.major == 3:
         data = urlencode(raw_data).encode("utf-8")  # encode to bytes ! for python3
@@ -726,6 +2620,16 @@ def sendMessage(url, pilotUUID, wnVO, method, rawMessage):
 class CommandBase(object):
     """CommandBase is the base class for every command in the pilot commands toolbox"""
 
+    # What the command needs before it can start: names of commands, or of resources produced by other commands.
+    # None means that the command depends on all the commands configured before it (see getCommandDependencies)
+    needs = None
+    # Resources (e.g. "pilot.cfg") the command writes
+    produces = ()
+    # True if the results of the command are the same for all the pilots of a node (see PilotDaemon)
+    reusable = False
+    # True if the pilot can do without the command, e.g. when the walltime left is short
+    optional = False
+
     def __init__(self, pilotParams):
         """
         Defines the classic pilot logger and the pilot parameters.
@@ -737,6 +2641,16 @@ class CommandBase(object):
         """
 
         self.pp = pilotParams
+        # Time (seconds since epoch) after which the subprocesses are killed, set by the CommandScheduler
+        self.deadline = None
+        # Retries of the transient failures of the subprocesses (see executeWithRetries)
+        self.retryPolicy = RetryPolicy(attempts=pilotParams.retries + 1)
+        # Retries of the whole command (CommandRetries in the JSON file) and attempt, set by the CommandScheduler
+        self.commandRetryPolicy = RetryPolicy(attempts=1)
+        self.attempt = 1
+        # return code and output of the last subprocess that failed, to classify the exit of the command
+        self.lastFailure = None
+        self._retryDelay = None
         self.debugFlag = pilotParams.debugFlag
         loggerURL = pilotParams.loggerURL
         # URL present and the flag is set:
@@ -767,10 +2681,26 @@ class CommandBase(object):
 
     def executeAndGetOutput(self, cmd, environDict=None):
         """Execute a command on the worker node and get the output"""
+        import select
 
         self.log.info("Executing command %s" % cmd)
+        startTime = tracer.now()
+        sessionArgs = {}
+        if self.deadline:
+            # in its own process group, to kill the whole command at the deadline
+            # (preexec_fn is not safe with the threads of the pilot, it is only the Python 2 fallback)
+            if sys.version_info.major == 2:
+                sessionArgs["preexec_fn"] = os.setsid
+            else:
+                sessionArgs["start_new_session"] = True
         _p = subprocess.Popen(
-            cmd, shell=True, env=environDict, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=False
+            cmd,
+            shell=True,
+            env=environDict,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=False,
+            **sessionArgs
         )
 
         # Use non-blocking I/O on the process pipes
@@ -778,64 +2708,131 @@ class CommandBase(object):
             fl = fcntl.fcntl(fd, fcntl.F_GETFL)
             fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
-        outData = ""
-        while True:
-            readfd, _, _ = select.select([_p.stdout, _p.stderr], [], [])
-            dataWasRead = False
-            for stream in readfd:
-                outChunk = stream.read().decode("ascii", "replace")
-                if not outChunk:
-                    continue
-                dataWasRead = True
-                if sys.version_info.major == 2:
-                    # Ensure outChunk is unicode in Python 2
-                    if isinstance(outChunk, str):
-                        outChunk = outChunk.decode("utf-8")
-                    # Strip unicode replacement characters
-                    # Ensure correct type conversion in Python 2
-                    outChunk = str(outChunk.replace(u"\ufffd", ""))
-                    # Avoid potential str() issues in Py2
-                    outChunk = unicode(outChunk)  # pylint: disable=undefined-variable
+        # the messages logged meanwhile are about this subprocess (see getLogRecord)
+        _logContext.subprocess = _p.pid
+        try:
+            outData = ""
+            while True:
+                if self.deadline:
+                    readfd, _, _ = select.select([_p.stdout, _p.stderr], [], [], max(0, self.deadline - time.time()))
+                    if not readfd:
+                        self.log.error("Killing %s: the command deadline is reached" % cmd)
+                        os.killpg(_p.pid, signal.SIGKILL)
+                        break
                 else:
-                    outChunk = str(outChunk.replace("\ufffd", ""))  # Python 3: Ensure it's a string
+                    readfd, _, _ = select.select([_p.stdout, _p.stderr], [], [])
+                dataWasRead = False
+                for stream in readfd:
+                    outChunk = stream.read().decode("ascii", "replace")
+                    if not outChunk:
+                        continue
+                    dataWasRead = True
+                    if sys.version_info.major == 2:
+                        # Ensure outChunk is unicode in Python 2
+                        if isinstance(outChunk, str):
+                            outChunk = outChunk.decode("utf-8")
+                        # Strip unicode replacement characters
+                        # Ensure correct type conversion in Python 2
+                        outChunk = str(outChunk.replace(u"\ufffd", ""))
+                        # Avoid potential str() issues in Py2
+                        outChunk = unicode(outChunk)  # pylint: disable=undefined-variable
+                    else:
+                        outChunk = str(outChunk.replace("\ufffd", ""))  # Python 3: Ensure it's a string
 
-                if stream == _p.stderr:
-                    sys.stderr.write(outChunk)
-                    sys.stderr.flush()
-                else:
-                    sys.stdout.write(outChunk)
-                    sys.stdout.flush()
-                    if hasattr(self.log, "buffer") and self.log.isPilotLoggerOn:
-                        self.log.buffer.write(outChunk)
-                    outData += outChunk
-            # If no data was read on any of the pipes then the process has finished
-            if not dataWasRead:
-                break
+                    # written by the LogWriter, so that the read loop does not wait for the log I/O in asynchronous mode
+                    if stream == _p.stderr:
+                        logWriter.submit(writeStream, sys.stderr, outChunk)
+                    else:
+                        logWriter.submit(writeStream, sys.stdout, outChunk)
+                        if hasattr(self.log, "buffer") and self.log.isPilotLoggerOn:
+                            logWriter.submit(self.log.buffer.write, outChunk)
+                        outData += outChunk
+                # If no data was read on any of the pipes then the process has finished
+                if not dataWasRead:
+                    break
 
-        # Ensure output ends on a newline
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        sys.stderr.write("\n")
-        sys.stderr.flush()
+            # Ensure output ends on a newline
+            logWriter.submit(writeStream, sys.stdout, "\n")
+            logWriter.submit(writeStream, sys.stderr, "\n")
 
-        # return code
-        returnCode = _p.wait()
-        self.log.debug("Return code of %s: %d" % (cmd, returnCode))
+            # return code
+            returnCode = _p.wait()
+            self.log.debug("Return code of %s: %d" % (cmd, returnCode))
+            if returnCode:
+                self.lastFailure = (returnCode, outData)
+        finally:
+            _logContext.subprocess = None
+        tracer.complete(
+            _traceName(cmd), "subprocess", startTime, tracer.now(), {"cmd": cmd, "pid": _p.pid, "returnCode": returnCode}
+        )
 
         return (returnCode, outData)
 
+    def executeWithRetries(self, cmd, environDict=None, retryPolicy=None):
+        """Execute a command like executeAndGetOutput, again if it fails with a transient error
+
+        :param str cmd: the command
+        :param dict environDict: its environment
+        :param RetryPolicy retryPolicy: default is self.retryPolicy
+        :return: return code and output of the last attempt
+        """
+        if retryPolicy is None:
+            retryPolicy = self.retryPolicy
+        attempt = 1
+        while True:
+            retCode, output = self.executeAndGetOutput(cmd, environDict)
+            if attempt >= retryPolicy.attempts or not retryPolicy.isRetryable(retCode, output):
+                if retCode and attempt > 1:
+                    self.log.error("%s failed after %d attempts" % (cmd, attempt))
+                return retCode, output
+            delay = retryPolicy.delay(attempt)
+            if self.deadline and time.time() + delay >= self.deadline:
+                self.log.error("Not retrying %s: the command deadline is too close" % cmd)
+                return retCode, output
+            self.log.warn(
+                "Transient failure of %s [ERROR %d] (attempt %d/%d), retrying in %.0f s"
+                % (cmd, retCode, attempt, retryPolicy.attempts, delay)
+            )
+            time.sleep(delay)
+            attempt += 1
+
+    def retryDelay(self, exitCode):
+        """Delay (seconds) before the command is executed again after it exited with exitCode, None if it is not
+
+        Only transient failures are retried: exitCode must be the return code of the last subprocess that failed,
+        and its output must be classified as transient by commandRetryPolicy.
+        The decision is taken once per attempt, by logFinalizer or by the CommandScheduler.
+        """
+        if self._retryDelay is None:
+            delay = None
+            policy = self.commandRetryPolicy
+            if exitCode and self.attempt < policy.attempts and self.lastFailure is not None:
+                retCode, output = self.lastFailure
+                if retCode == exitCode and policy.isRetryable(retCode, output):
+                    delay = policy.delay(self.attempt)
+                    if self.deadline is not None and time.time() + delay >= self.deadline:
+                        delay = None
+            self._retryDelay = (delay,)
+        return self._retryDelay[0]
+
     def exitWithError(self, errorCode):
         """Wrapper around sys.exit()"""
-        self.log.info("Content of pilot.cfg")
-        with open("pilot.cfg") as f:
-            print(f.read())
-
-        self.log.info("List of child processes of current PID:")
-        retCode, _outData = self.executeAndGetOutput(
-            "ps --forest -o pid,%%cpu,%%mem,tty,stat,time,cmd -g %d" % os.getpid()
-        )
-        if retCode:
-            self.log.error("Failed to issue ps [ERROR %d] " % retCode)
+        # the diagnostics below must run even if the deadline is reached
+        self.deadline = None
+        # and they must survive the rotation of the log files
+        with keptLogs():
+            self.log.info("Content of pilot.cfg")
+            with open("pilot.cfg") as f:
+                self.log.info(f.read(), header=False)
+
+            self.log.info("List of child processes of current PID:")
+            retCode, outData = self.executeAndGetOutput(
+                "ps --forest -o pid,%%cpu,%%mem,tty,stat,time,cmd -g %d" % os.getpid()
+            )
+            if retCode:
+                self.log.error("Failed to issue ps [ERROR %d] " % retCode)
+            elif self.log.out and LogSink.maxSize:
+                logWriter.submit(getLogSink(self.log.out).keep, outData)
         sys.exit(errorCode)
 
     def forkAndExecute(self, cmd, logFile, environDict=None):
@@ -849,6 +2846,7 @@ class CommandBase(object):
             return pid
 
         # The subprocess stdout/stderr will be written to logFile
+        startTime = tracer.now()
         with open(logFile, "a+", 0) as fpLogFile:
             try:
                 _p = subprocess.Popen(
@@ -860,6 +2858,7 @@ class CommandBase(object):
                 self.log.debug("Return code of %s: %d" % (cmd, returnCode))
             except BaseException:
                 returnCode = 99
+        tracer.complete(_traceName(cmd), "subprocess", startTime, tracer.now(), {"cmd": cmd, "returnCode": returnCode})
 
         sys.exit(returnCode)
 
@@ -870,6 +2869,37 @@ class CommandBase(object):
         return parsedVersion.split("==")[1] if "==" in parsedVersion else parsedVersion
 
 
+# Environment variables the pilot parameters depend on (see PilotParams.__snapshotKey)
+SNAPSHOT_ENVIRONMENT = (
+    "X509_CERT_DIR",
+    "X509_VOMS_DIR",
+    "X509_VOMSES",
+    "DIRAC_PILOT_VO",
+    "JOBFEATURES",
+)
+# Command line options specific to each pilot: not in the snapshot key, and not restored from the snapshots
+SNAPSHOT_PILOT_OPTIONS = ("--pilotUUID",)
+# Snapshots not used for this time (seconds) are removed
+SNAPSHOT_MAX_AGE = 24 * 3600
+# Environment variables set by PilotParams to the security directories
+SECURITY_DIRS = ("X509_CERT_DIR", "X509_VOMS_DIR", "X509_VOMSES")
+# PilotParams attributes not saved in the snapshots: objects, data loaded when needed, times of this pilot
+SNAPSHOT_EXCLUDED = (
+    "log",
+    "installEnv",
+    "cmdOpts",
+    "_pilotJSON",
+    "_optionResolver",
+    "_discoveryCache",
+    "_slotDeadline",
+    "startTime",
+    "startupTimes",
+    "optList",
+    "pilotUUID",
+    "_vo",
+)
+
+
 class PilotParams(object):
     """Class that holds the structure with all the parameters to be used across all the commands"""
 
@@ -879,6 +2909,7 @@ class PilotParams(object):
         param names and defaults are defined here
         """
         self.log = Logger(self.__class__.__name__, debugFlag=True)
+        self.startTime = time.time()
         self.rootPath = os.getcwd()
         self.pilotRootPath = os.getcwd()
         self.workingDir = os.getcwd()
@@ -887,7 +2918,9 @@ class PilotParams(object):
         self.keepPythonPath = False
         self.debugFlag = False
         self.local = False
-        self.pilotJSON = None
+        # content of the pilot JSON file (see the pilotJSON property)
+        self._pilotJSON = None
+        self._optionResolver = None
         self.commandExtensions = []
         self.commands = [
             "CheckWorkerNode",
@@ -933,6 +2966,7 @@ class PilotParams(object):
         self.pilotScriptName = ""
         self.genericOption = ""
         self.wnVO = ""  # for binding the resource (WN) to a specific VO
+        self._vo = None  # found by __getVO
         # Some commands can define environment necessary to execute subsequent commands
         self.installEnv = os.environ
         # If DIRAC is preinstalled this file will receive the updates of the local configuration
@@ -956,16 +2990,44 @@ class PilotParams(object):
             "/cvmfs/grid.cern.ch",
             "/cvmfs/dirac.egi.eu",
         ]
+        self.maxParallelCommands = 1
+        self.traceFile = ""
+        self.profile = False
+        self.profileMemory = False
+        self.checkpoint = False
+        self.daemon = ""
+        self.daemonSocket = ""
+        # Node-local cache directory, shared by the pilots of the node (e.g. for the snapshot of these parameters)
+        self.nodeCache = os.environ.get("DIRAC_PILOT_CACHE_DIR", "")
+        # directory or URL of the pilot JSON shards (see pilotShards.py), replacing pilotCFGFile
+        self.pilotShards = ""
+        # see the discoveryCache property
+        self._discoveryCache = None
+        # when the local logs are flushed, and asynchronous logging (see configureLogging)
+        self.logFlush = "message"
+        self.logQueue = 0
+        self.logOverflow = "block"
+        self.logFormat = "classic"
+        self.logMaxSize = 0
+        self.logBackups = 5
 
         # Parameters that can be determined at runtime only
         self.queueParameters = {}  # from CE description
         self.jobCPUReq = 900  # HS06s, here just a random value
 
-        # Set number of allocatable processors from MJF if available
-        try:
-            self.pilotProcessors = int(urlopen(os.path.join(os.environ["JOBFEATURES"], "allocated_cpu")).read())
-        except Exception:
-            self.pilotProcessors = 1
+        # Number of allocatable processors: looked up in MJF only when needed (see the pilotProcessors property)
+        self._pilotProcessors = None
+        # Walltime of the batch slot: from the command line, or looked up in MJF when needed (see slotDeadline)
+        self.walltime = 0
+        self._slotDeadline = None
+        # Time limits of the commands, in seconds, and walltime kept for the payload (see CommandScheduler.getDeadline)
+        self.commandTimeouts = {}
+        self.optionalCommandsReserve = OPTIONAL_COMMANDS_RESERVE
+        # Retries of the transient failures of the DIRAC commands, and of the whole pilot commands
+        self.retries = 2
+        self.commandRetries = {}
+        # (phase, start, end) of the c'tor phases, in microseconds (see Tracer.now())
+        self.startupTimes = []
 
         # Pilot command options
         self.cmdOpts = (
@@ -1021,24 +3083,86 @@ class PilotParams(object):
             ("", "preinstalledEnvPrefix=", "preinstalled pilot environment area prefix"),
             ("", "architectureScript=", "architecture script to use"),
             ("", "CVMFS_locations=", "comma-separated list of CVMS locations"),
+            ("", "maxParallelCommands=", "Maximum number of independent pilot commands to run concurrently"),
+            ("", "trace=", "Write a timeline of the commands and subprocesses in <file> (trace event format)"),
+            ("", "profile", "Profile the resolution of the parameters and each command with cProfile"),
+            ("", "profileMemory", "Report the top memory allocations of each command (tracemalloc)"),
+            ("", "checkpoint", "Skip the commands completed by a previous pilot run in the same directory"),
+            ("", "daemon=", "Run as the pilot daemon of the node, serving the DIRAC setup on the <socket>"),
+            ("", "daemonSocket=", "Reuse the DIRAC setup of the pilot daemon listening on <socket>"),
+            ("", "walltime=", "Walltime of the batch slot, in seconds (default: from Machine/Job Features)"),
+            ("", "retries=", "Number of retries of the DIRAC commands failing with a transient error"),
+            ("", "optionalCommandsReserve=", "Walltime (s) kept for the payload: optional commands are skipped"),
+            ("", "nodeCache=", "Node-local cache directory, shared by the pilots of the node"),
+            ("", "pilotShards=", "Directory or URL of the pilot JSON shards: only the one of this CE is read"),
+            ("", "logFlush=", "When the local logs are flushed: message (default), interval or exit"),
+            ("", "logQueue=", "Write the logs in a background thread, with a queue of <size> messages"),
+            ("", "logOverflow=", "When the log queue is full: block (default) or drop the message"),
+            ("", "logFormat=", "Local log format: classic (default), json (in pilot.out.jsonl) or both"),
+            ("", "logMaxSize=", "Rotate the local log files when they reach <size> MB (default: no rotation)"),
+            ("", "logBackups=", "Number of compressed segments kept by the rotation of the log files (default: 5)"),
         )
 
         # Possibly get Setup and JSON URL/filename from command line
-        self.__initCommandLine1()
+        with self.__startupPhase("commandLine1"):
+            self.__initCommandLine1()
+
+        if self.profile:
+            # the resolution of the parameters is profiled like the commands (see runProfiled)
+            import cProfile
 
-        # Get main options from the JSON file. Load JSON first to determine the format used.
-        self.__loadJSON()
-        if "Setups" in self.pilotJSON:
-            self.__initJSON()
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(self.__resolveParameters)
+            finally:
+                profiler.dump_stats(os.path.join(self.workingDir, "PilotParams.pstats"))
         else:
-            self.__initJSON2()
+            self.__resolveParameters()
+
+    def __resolveParameters(self):
+        """Resolve the parameters from the JSON file, the command line and the environment,
+        or from the snapshot of a previous pilot of the node
+        """
+        # Mounting the CVMFS repositories needed later is started right away, in the background
+        self.prewarmCVMFS()
+
+        if self.pilotShards:
+            with self.__startupPhase("getShard"):
+                self.__getShard()
+
+        # The parameters resolved by a previous pilot of the node with the same inputs can be reused
+        snapshotFile = None
+        if self.nodeCache:
+            with self.__startupPhase("loadSnapshot"):
+                snapshotFile = os.path.join(self.nodeCache, "params-%s.json" % self.__snapshotKey())
+                if self.__loadSnapshot(snapshotFile):
+                    snapshotFile = None
+                    self.prewarmCVMFS()
+
+        if not self.nodeCache or snapshotFile:
+            # Get main options from the JSON file. Load JSON first to determine the format used.
+            with self.__startupPhase("loadJSON"):
+                self.__loadJSON()
+            with self.__startupPhase("initJSON"):
+                if "Setups" in self.pilotJSON:
+                    self.__initJSON()
+                else:
+                    self.__initJSON2()
 
-        # Command line can override options from JSON
-        self.__initCommandLine2()
+            # Command line can override options from JSON
+            with self.__startupPhase("commandLine2"):
+                self.__initCommandLine2()
 
-        self.__checkSecurityDir("X509_CERT_DIR", "certificates")
-        self.__checkSecurityDir("X509_VOMS_DIR", "vomsdir")
-        self.__checkSecurityDir("X509_VOMSES", "vomses")
+            # The directories of the CVMFS locations, and of the release, are now known
+            self.prewarmCVMFS()
+
+            with self.__startupPhase("securityDirs"):
+                self.__checkSecurityDirs()
+
+            if snapshotFile:
+                self.__saveSnapshot(snapshotFile)
+        # whichever way the parameters were resolved (the snapshot skips the command line parsing)
+        configureLogging(pilotUUID=self.pilotUUID)
         # This is needed for the integration tests
         self.installEnv["DIRAC_VOMSES"] = self.installEnv["X509_VOMSES"]
         os.environ["DIRAC_VOMSES"] = os.environ["X509_VOMSES"]
@@ -1047,6 +3171,216 @@ class PilotParams(object):
             self.installEnv["X509_USER_PROXY"] = self.certsLocation
             os.environ["X509_USER_PROXY"] = self.certsLocation
 
+    def getPreinstalledEnvCandidates(self):
+        """Paths where the environment script (diracosrc) of a preinstalled release may be, by order of preference
+
+        :return: list of str
+        """
+        if self.preinstalledEnv:
+            return [self.preinstalledEnv]
+        version = self.releaseVersion or "pro"
+        arch = platform.system() + "-" + platform.machine()
+        if self.preinstalledEnvPrefix:
+            return [os.path.join(self.preinstalledEnvPrefix, version, arch, "diracosrc")]
+        return [
+            os.path.join(location, self.releaseProject.lower() + "dirac", version, arch, "diracosrc")
+            for location in self.CVMFS_locations
+        ]
+
+    def preinstalledEnvKey(self):
+        """Key of the preinstalled environment script in the discovery cache"""
+        return "preinstalledEnv %s" % ",".join(self.getPreinstalledEnvCandidates())
+
+    @property
+    def discoveryCache(self):
+        """The NodeDiscoveryCache of the node cache directory, None without node cache"""
+        if self._discoveryCache is None and self.nodeCache:
+            self._discoveryCache = NodeDiscoveryCache(self.nodeCache)
+        return self._discoveryCache
+
+    def prewarmCVMFS(self):
+        """Start listing, in the background, the CVMFS directories the pilot will need (see DirectoryProber):
+        the security dirs, the preinstalled releases and the DIRACOS installers.
+        """
+        discovery = self.discoveryCache
+        directories = [DIRACOS_INSTALL_SOURCE]
+        for envName, name in zip(SECURITY_DIRS, ("certificates", "vomsdir", "vomses")):
+            # only the directory found by a previous pilot of the node, if any
+            directory = discovery.get(self.__securityDirKey(envName)) if discovery else None
+            if directory:
+                directories.append(directory)
+            else:
+                directories += [os.path.join(location, "etc/grid-security", name) for location in self.CVMFS_locations]
+        script = discovery.get(self.preinstalledEnvKey()) if discovery else None
+        scripts = [script] if script else self.getPreinstalledEnvCandidates()
+        directories += [os.path.dirname(script) for script in scripts]
+        directoryProber.prewarm([directory for directory in directories if directory.startswith("/cvmfs/")])
+
+    def __getShard(self):
+        """Use the JSON shard of this CE as pilot CFG file, or the default shard for an unknown CE.
+        The shards are read from a local directory, or downloaded from a URL.
+        """
+        shardNames = [getShardName(self.ceName), SHARDS_DEFAULT] if self.ceName else [SHARDS_DEFAULT]
+        isURL = re.match(r"^(https?|file)://", self.pilotShards)
+        for shardName in shardNames:
+            location = "%s/%s" % (self.pilotShards.rstrip("/"), shardName)
+            if not isURL:
+                if os.path.isfile(location):
+                    self.pilotCFGFile = location
+                    break
+            elif retrieveUrlTimeout(location, SHARD_FILE, self.log, timeout=60):
+                self.pilotCFGFile = SHARD_FILE
+                break
+            self.log.debug("No pilot JSON shard %s" % location)
+        else:
+            self.log.warn("No pilot JSON shard found in %s, using %s" % (self.pilotShards, self.pilotCFGFile))
+            return
+        self.log.debug("Pilot JSON shard: %s" % self.pilotCFGFile)
+
+    def __snapshotKey(self):
+        """Hash of everything the resolved parameters depend on: the same for all the pilots of a queue"""
+        import hashlib
+        import json
+
+        key = [
+            [(o, v) for o, v in self.optList if o not in SNAPSHOT_PILOT_OPTIONS],
+            fileHash(self.pilotCFGFile),
+            # from the proxy, only its VO matters: each pilot may have a freshly delegated one
+            self.__getVO(),
+            [os.environ.get(name) for name in SNAPSHOT_ENVIRONMENT],
+            # a new version of the pilot may resolve the parameters differently
+            fileHash(__file__),
+        ]
+        return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def __loadSnapshot(self, snapshotFile):
+        """Restore the parameters from a snapshot
+
+        :return: True if the snapshot exists and is still valid
+        """
+        import json
+
+        try:
+            with open(snapshotFile, "r") as fp:
+                snapshot = json.load(fp)
+        except (IOError, ValueError):
+            return False
+        # checked by the DirectoryProber, all at once: the repository may hang
+        probes = [directoryProber.probe(dirLocation) for dirLocation in snapshot["securityDirs"].values()]
+        deadline = time.time() + 60
+        for probe in probes:
+            if not directoryProber.wait(probe, deadline - time.time()):
+                self.log.debug("Snapshot %s is not valid anymore: %s is missing" % (snapshotFile, probe.directory))
+                return False
+
+        oldCwd, cwd = snapshot["workingDir"], os.getcwd()
+        for name, value in snapshot["params"].items():
+            # paths in the working directory of the pilot that wrote the snapshot are moved to this one
+            if isinstance(value, basestring) and (value == oldCwd or value.startswith(oldCwd + "/")):
+                value = cwd + value[len(oldCwd) :]
+            setattr(self, name, value)
+        for envName, dirLocation in snapshot["securityDirs"].items():
+            self.__setSecurityDir(envName, dirLocation)
+        # still in use: not pruned (see __pruneSnapshots)
+        try:
+            os.utime(snapshotFile, None)
+        except OSError:
+            pass
+        self.log.debug("Parameters loaded from the snapshot %s" % snapshotFile)
+        return True
+
+    def __pruneSnapshots(self):
+        """Remove the snapshots not used for SNAPSHOT_MAX_AGE, e.g. of queues or pilot versions gone"""
+        try:
+            fileNames = os.listdir(self.nodeCache)
+        except OSError:
+            return
+        for fileName in fileNames:
+            # also the temporary files of the pilots killed while writing one
+            if not (fileName.startswith("params-") and ".json" in fileName):
+                continue
+            path = os.path.join(self.nodeCache, fileName)
+            try:
+                if time.time() - os.path.getmtime(path) > SNAPSHOT_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def __saveSnapshot(self, snapshotFile):
+        """Save the resolved parameters for the next pilots of the node"""
+        import json
+
+        params = dict(
+            (name, value)
+            for name, value in vars(self).items()
+            if name not in SNAPSHOT_EXCLUDED and not (name == "_pilotProcessors" and value is None)
+        )
+        snapshot = {
+            "workingDir": os.getcwd(),
+            "params": params,
+            "securityDirs": dict((envName, os.environ[envName]) for envName in SECURITY_DIRS),
+        }
+        try:
+            if not os.path.isdir(self.nodeCache):
+                os.makedirs(self.nodeCache, 0o700)
+            # written in a temporary file then renamed: the other pilots never read a partial snapshot
+            tmpFile = "%s.%d" % (snapshotFile, os.getpid())
+            with open(tmpFile, "w") as fp:
+                json.dump(snapshot, fp)
+            os.rename(tmpFile, snapshotFile)
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            self.log.warn("Could not save the parameters snapshot %s: %s" % (snapshotFile, str(exc)))
+        self.__pruneSnapshots()
+
+    @property
+    def pilotJSON(self):
+        """Content of the pilot JSON file, loaded when first needed"""
+        if self._pilotJSON is None:
+            self.__loadJSON()
+        return self._pilotJSON
+
+    @pilotJSON.setter
+    def pilotJSON(self, value):
+        self._pilotJSON = value
+        self._optionResolver = None
+
+    @property
+    def optionResolver(self):
+        """Lookups of options in the pilot JSON content (see JSONOptionResolver)"""
+        if self._optionResolver is None:
+            self._optionResolver = JSONOptionResolver(self.pilotJSON)
+        return self._optionResolver
+
+    @contextmanager
+    def __startupPhase(self, phase):
+        """Record the duration of a phase of the c'tor in startupTimes"""
+        startTime = tracer.now()
+        try:
+            yield
+        finally:
+            self.startupTimes.append((phase, startTime, tracer.now()))
+
+    @property
+    def pilotProcessors(self):
+        """Number of processors allocated to this pilot: from the command line or JSON, else from MJF, else 1"""
+        if self._pilotProcessors is None:
+            self._pilotProcessors = getAllocatedProcessors()
+        return self._pilotProcessors
+
+    @pilotProcessors.setter
+    def pilotProcessors(self, value):
+        self._pilotProcessors = value
+
+    @property
+    def slotDeadline(self):
+        """End of the batch slot (seconds since epoch), None if unknown"""
+        if self._slotDeadline is None:
+            if self.walltime:
+                self._slotDeadline = self.startTime + self.walltime
+            else:
+                self._slotDeadline = getSlotDeadline() or 0
+        return self._slotDeadline or None
+
     def __setSecurityDir(self, envName, dirLocation):
         """Set the environment variable of the `envName`, and add it also to the Pilot Parameters
 
@@ -1058,12 +3392,54 @@ class PilotParams(object):
         self.installEnv[envName] = dirLocation
         os.environ[envName] = dirLocation
 
-    def __checkSecurityDir(self, envName, dirName):
+    def __securityDirKey(self, envName):
+        """Key of a security dir in the discovery cache"""
+        return "%s %s" % (envName, ",".join(self.CVMFS_locations))
+
+    def __checkSecurityDirs(self):
+        """Checks the security dirs (see __checkSecurityDir). All the candidate directories are probed at once,
+        unless a previous pilot of the node found them.
+        """
+        discovery = self.discoveryCache
+        candidates = []
+        for envName, dirName in zip(SECURITY_DIRS, ("certificates", "vomsdir", "vomses")):
+            cached = discovery.get(self.__securityDirKey(envName)) if discovery else None
+            if cached:
+                # checked by the DirectoryProber too: the repository may hang
+                self.log.debug("Directory for %s found by a previous pilot: %s" % (envName, cached))
+                probes = [directoryProber.probe(cached)]
+            else:
+                probes = self.__probeSecurityDirs(envName, dirName)
+            candidates.append((envName, dirName, cached, probes))
+
+        for envName, dirName, cached, probes in candidates:
+            probe = directoryProber.firstValid(probes)
+            if probe is None and cached:
+                self.log.debug("%s is not valid anymore, probing the candidates" % cached)
+                probe = directoryProber.firstValid(self.__probeSecurityDirs(envName, dirName))
+            directory = probe.directory if probe else None
+            if directory and discovery and directory != cached:
+                discovery.set(self.__securityDirKey(envName), directory)
+            self.__checkSecurityDir(envName, directory)
+
+    def __probeSecurityDirs(self, envName, dirName):
+        """Start probing the candidate directories of a security dir, in the CVMFS locations
+
+        :return: list of DirectoryProbe, by decreasing priority
+        """
+        probes = []
+        for candidate in self.CVMFS_locations:
+            candidateDir = os.path.join(candidate, "etc/grid-security", dirName)
+            self.log.debug("Candidate directory for %s is %s" % (envName, candidateDir))
+            probes.append(directoryProber.probe(candidateDir))
+        return probes
+
+    def __checkSecurityDir(self, envName, directory):
         """For a given environment variable (that is not necessarily set in the OS), checks if it exists *and* is not empty.
 
         .. example::
             ```
-            self.__checkSecurityDir("X509_VOMSES", "vomses")
+            self.__checkSecurityDir("X509_VOMSES", directory)
             ```
             It will check if `X509_VOMSES` is set, if not, check if one of the CVMFS_locations with "vomses" is a valid candidate.
             If let's say `/cvmfs/dirac.egi.eu/etc/grid-security/vomses` exists, *and* is not empty, sets the OS environment variable `X509_VOMSES` to `/cvmfs/dirac.egi.eu/etc/grid-security/vomses`.
@@ -1074,25 +3450,19 @@ class PilotParams(object):
 
         Args:
             envName (str): The environment name to try
-            dirName (str): The target folder
+            directory (str): The first candidate which exists *and* is not empty, None if there is none
         """
 
-        # Else, try to find it
-        for candidate in self.CVMFS_locations:
-            candidateDir = os.path.join(candidate, "etc/grid-security", dirName)
-            self.log.debug("Candidate directory for %s is %s" % (envName, candidateDir))
-
-            # Checks if the directory exists *and* isn't empty
-            if safe_listdir(candidateDir):
-                self.log.debug("Setting %s=%s" % (envName, candidateDir))
-                # Set the environment variables to the candidate
-                self.__setSecurityDir(envName, candidateDir)
-                break
-            self.log.debug("%s not found or not a directory" % candidateDir)
+        if directory:
+            self.log.debug("Setting %s=%s" % (envName, directory))
+            # Set the environment variables to the candidate
+            self.__setSecurityDir(envName, directory)
+        else:
+            self.log.debug("No candidate directory found for %s" % envName)
 
-            # Check first if the environment variable is set
-            # If so, just return
-        if envName in os.environ and safe_listdir(os.environ[envName]):
+        # Check if the environment variable is set
+        # If so, just return
+        if envName in os.environ and (directory or safe_listdir(os.environ[envName])):
             self.log.debug(
                 "%s is set in the host environment as %s, aligning installEnv to it" % (envName, os.environ[envName])
             )
@@ -1103,6 +3473,7 @@ class PilotParams(object):
 
     def __initCommandLine1(self):
         """Parses and interpret options on the command line: first pass (essential things)"""
+        import getopt
 
         self.optList, __args__ = getopt.getopt(
             sys.argv[1:], "".join([opt[0] for opt in self.cmdOpts]), [opt[1] for opt in self.cmdOpts]
@@ -1123,12 +3494,58 @@ class PilotParams(object):
                 self.pilotCFGFile = v
             elif o == "--wnVO":
                 self.wnVO = v
+            elif o == "--pilotUUID":
+                self.pilotUUID = v
+                configureLogging(pilotUUID=v)
+            elif o == "--profile":
+                self.profile = True
+            elif o == "--nodeCache":
+                self.nodeCache = v
+            elif o == "--pilotShards":
+                self.pilotShards = v
+            elif o == "--logFlush":
+                if v in LOG_FLUSH_POLICIES:
+                    self.logFlush = v
+                    configureLogging(flushPolicy=v)
+                else:
+                    self.log.warn("Unknown log flush policy %s, using %s" % (v, self.logFlush))
+            elif o == "--logQueue":
+                try:
+                    self.logQueue = int(v)
+                except ValueError:
+                    self.log.warn("Invalid log queue size %s" % v)
+            elif o == "--logOverflow":
+                if v in LOG_OVERFLOW_POLICIES:
+                    self.logOverflow = v
+                else:
+                    self.log.warn("Unknown log overflow policy %s, using %s" % (v, self.logOverflow))
+            elif o == "--logFormat":
+                if v in LOG_FORMATS:
+                    self.logFormat = v
+                    configureLogging(logFormat=v)
+                else:
+                    self.log.warn("Unknown log format %s, using %s" % (v, self.logFormat))
+            elif o == "--logMaxSize":
+                try:
+                    self.logMaxSize = float(v)
+                    configureLogging(maxSize=int(self.logMaxSize * 1024 * 1024))
+                except ValueError:
+                    self.log.warn("Invalid log maximum size %s" % v)
+            elif o == "--logBackups":
+                try:
+                    self.logBackups = int(v)
+                    configureLogging(backupCount=self.logBackups)
+                except ValueError:
+                    self.log.warn("Invalid number of log backups %s" % v)
+        if self.logQueue > 0:
+            configureLogging(queueSize=self.logQueue, overflow=self.logOverflow)
 
     def __initCommandLine2(self):
         """
         Parses and interpret options on the command line: second pass
         (overriding discovered parameters, for tests/debug)
         """
+        import getopt
 
         self.optList, __args__ = getopt.getopt(
             sys.argv[1:], "".join([opt[0] for opt in self.cmdOpts]), [opt[1] for opt in self.cmdOpts]
@@ -1202,8 +3619,6 @@ class PilotParams(object):
                 self.pilotLogging = True
             elif o == "-g" or o == "--loggerURL":
                 self.loggerURL = v
-            elif o == "--pilotUUID":
-                self.pilotUUID = v
             elif o in ("-o", "--option"):
                 self.genericOption = v
             elif o in ("-t", "--tag"):
@@ -1224,6 +3639,38 @@ class PilotParams(object):
                 self.architectureScript = v
             elif o == "--CVMFS_locations":
                 self.CVMFS_locations = v.split(",")
+            elif o == "--retries":
+                try:
+                    self.retries = int(v)
+                except ValueError:
+                    self.log.warn("Invalid number of retries %s, using %d" % (v, self.retries))
+            elif o == "--walltime":
+                try:
+                    self.walltime = int(v)
+                except ValueError:
+                    self.log.warn("Invalid walltime %s, using the one from Machine/Job Features" % v)
+            elif o == "--optionalCommandsReserve":
+                try:
+                    self.optionalCommandsReserve = int(v)
+                except ValueError:
+                    self.log.warn("Invalid optional commands reserve %s, using %d" % (v, self.optionalCommandsReserve))
+            elif o == "--daemon":
+                self.daemon = v
+            elif o == "--daemonSocket":
+                self.daemonSocket = v
+            elif o == "--checkpoint":
+                self.checkpoint = True
+            elif o == "--profile":
+                self.profile = True
+            elif o == "--profileMemory":
+                self.profileMemory = True
+            elif o == "--trace":
+                self.traceFile = v
+            elif o == "--maxParallelCommands":
+                try:
+                    self.maxParallelCommands = int(v)
+                except ValueError:
+                    pass
 
     def __loadJSON(self):
         """
@@ -1231,12 +3678,24 @@ class PilotParams(object):
 
         :return: None
         """
+        import json
 
         self.log.debug("JSON file loaded: %s" % self.pilotCFGFile)
+        if os.path.getsize(self.pilotCFGFile) >= LAZY_JSON_MIN_SIZE:
+            try:
+                import mmap
+
+                # mapped rather than read: the pages of the members not used can be dropped by the kernel
+                # (the pilot files are replaced, never modified in place, see pilot_wrapper.sh)
+                with open(self.pilotCFGFile, "rb") as fp:
+                    self._pilotJSON = LazyJSONObject(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+                return
+            except ValueError as exc:
+                self.log.warn("Could not index %s (%s), decoding it entirely" % (self.pilotCFGFile, str(exc)))
         with open(self.pilotCFGFile, "r") as fp:
             # We save the parsed JSON in case pilot commands need it
             # to read their own options
-            self.pilotJSON = json.load(fp)
+            self._pilotJSON = json.load(fp)
 
     def __initJSON2(self):
         """
@@ -1323,6 +3782,17 @@ class PilotParams(object):
             self.CVMFS_locations = pilotOptions["CVMFS_locations"].replace(" ", "").split(",")
         self.log.debug("CVMFS locations: %s" % self.CVMFS_locations)
 
+        # time limits of the commands (in seconds), keyed by command name
+        for commandName, timeout in pilotOptions.get("CommandTimeouts", {}).items():
+            self.commandTimeouts[commandName] = int(timeout)
+        self.log.debug("Command timeouts: %s" % self.commandTimeouts)
+        if "OptionalCommandsReserve" in pilotOptions:
+            self.optionalCommandsReserve = int(pilotOptions["OptionalCommandsReserve"])
+        # number of times a failed command is executed again, keyed by command name
+        for commandName, retries in pilotOptions.get("CommandRetries", {}).items():
+            self.commandRetries[commandName] = int(retries)
+        self.log.debug("Command retries: %s" % self.commandRetries)
+
     def getPilotOptionsDict(self):
         """
         Get pilot option dictionary by searching paths in a certain order (commands, logging etc.).
@@ -1331,11 +3801,22 @@ class PilotParams(object):
         :rtype: dict
         """
 
-        return self.getOptionForPaths(self.__getSearchPaths(), self.pilotJSON)
+        return self.optionResolver.merged(self.__getSearchPaths())
 
     def __getVO(self):
         """
-        Get the VO for which we are running this pilot.
+        Get the VO for which we are running this pilot, once.
+
+        :return: VO name
+        :rtype: str
+        """
+        if self._vo is None:
+            self._vo = self.__findVO()
+        return self._vo
+
+    def __findVO(self):
+        """
+        Find the VO for which we are running this pilot.
         In case of problems return a value 'unknown", which would get pilot logging
         properties from a Defaults section of the CS.
 
@@ -1355,10 +3836,19 @@ class PilotParams(object):
         cert = os.getenv("X509_USER_PROXY")
         if cert:
             try:
-                with open(cert, "rb") as fp:
-                    return getVO(fp.read())
-            except IOError as err:
+                from Pilot.proxyTools import getProxyInfo
+            except ImportError:
+                from proxyTools import getProxyInfo
+            try:
+                vo = getProxyInfo(cert, self.nodeCache or None)["vo"]
+            except (IOError, OSError) as err:
                 self.log.error("Could not read a proxy, setting vo to 'unknown': %s" % os.strerror(err.errno))
+            except ValueError as err:
+                self.log.error("Could not decode the proxy, setting vo to 'unknown': %s" % str(err))
+            else:
+                if vo:
+                    return vo
+                self.log.error("No VO in the proxy, setting vo to 'unknown'")
         else:
             self.log.error("Could not locate a proxy via X509_USER_PROXY")
 
@@ -1388,7 +3878,7 @@ class PilotParams(object):
     @staticmethod
     def getOptionForPaths(paths, inDict):
         """
-        Get the preferred option from an input dict passed and a path list. It modifies the inDict.
+        Get the preferred option from an input dict passed and a path list. The inDict is not modified.
 
         :param list paths: list of paths to walk through to get a preferred option. An option found in
         a path which comes later has a preference over options found in earlier paths.
@@ -1396,13 +3886,7 @@ class PilotParams(object):
         :return: dict
         """
 
-        outDict = {}
-        for path in paths:
-            target = inDict
-            for elem in path.strip("/").split("/"):
-                target = target.setdefault(elem, {})
-            outDict.update(target)
-        return outDict
+        return JSONOptionResolver(inDict).merged(paths)
 
     def __initJSON(self):
         """Retrieve pilot parameters from the content of json file. The file should be something like:
@@ -1451,148 +3935,50 @@ class PilotParams(object):
         The file must contain at least the Defaults section. Missing values are taken from the Defaults setup."""
 
         self.__ceType()
+        options = self.optionResolver
+        setupPaths = ["/Setups/%s/%%s" % self.setup, "/Setups/Defaults/%s"]
 
         # Commands first
         # FIXME: pilotSynchronizer() should publish these as comma-separated lists. We are ready for that.
-        try:
-            if isinstance(self.pilotJSON["Setups"][self.setup]["Commands"][self.gridCEType], basestring):
-                self.commands = [
-                    str(pv).strip()
-                    for pv in self.pilotJSON["Setups"][self.setup]["Commands"][self.gridCEType].split(",")
-                ]
-            else:
-                self.commands = [
-                    str(pv).strip() for pv in self.pilotJSON["Setups"][self.setup]["Commands"][self.gridCEType]
-                ]
-        except KeyError:
-            try:
-                if isinstance(self.pilotJSON["Setups"][self.setup]["Commands"]["Defaults"], basestring):
-                    self.commands = [
-                        str(pv).strip()
-                        for pv in self.pilotJSON["Setups"][self.setup]["Commands"]["Defaults"].split(",")
-                    ]
-                else:
-                    self.commands = [
-                        str(pv).strip() for pv in self.pilotJSON["Setups"][self.setup]["Commands"]["Defaults"]
-                    ]
-            except KeyError:
-                try:
-                    if isinstance(self.pilotJSON["Setups"]["Defaults"]["Commands"][self.gridCEType], basestring):
-                        self.commands = [
-                            str(pv).strip()
-                            for pv in self.pilotJSON["Setups"]["Defaults"]["Commands"][self.gridCEType].split(",")
-                        ]
-                    else:
-                        self.commands = [
-                            str(pv).strip() for pv in self.pilotJSON["Setups"]["Defaults"]["Commands"][self.gridCEType]
-                        ]
-                except KeyError:
-                    try:
-                        if isinstance(self.pilotJSON["Defaults"]["Commands"]["Defaults"], basestring):
-                            self.commands = [
-                                str(pv).strip() for pv in self.pilotJSON["Defaults"]["Commands"]["Defaults"].split(",")
-                            ]
-                        else:
-                            self.commands = [
-                                str(pv).strip() for pv in self.pilotJSON["Defaults"]["Commands"]["Defaults"]
-                            ]
-                    except KeyError:
-                        pass
+        self.commands = options.firstList(
+            [
+                "/Setups/%s/Commands/%s" % (self.setup, self.gridCEType),
+                "/Setups/%s/Commands/Defaults" % self.setup,
+                "/Setups/Defaults/Commands/%s" % self.gridCEType,
+                "/Defaults/Commands/Defaults",
+            ],
+            self.commands,
+        )
         self.log.debug("Commands: %s" % self.commands)
 
         # CommandExtensions
         # pilotSynchronizer() can publish this as a comma separated list. We are ready for that.
-        try:
-            if isinstance(
-                self.pilotJSON["Setups"][self.setup]["CommandExtensions"], basestring
-            ):  # In the specific setup?
-                self.commandExtensions = [
-                    str(pv).strip() for pv in self.pilotJSON["Setups"][self.setup]["CommandExtensions"].split(",")
-                ]
-            else:
-                self.commandExtensions = [
-                    str(pv).strip() for pv in self.pilotJSON["Setups"][self.setup]["CommandExtensions"]
-                ]
-        except KeyError:
-            try:
-                if isinstance(
-                    self.pilotJSON["Setups"]["Defaults"]["CommandExtensions"], basestring
-                ):  # Or in the defaults section?
-                    self.commandExtensions = [
-                        str(pv).strip() for pv in self.pilotJSON["Setups"]["Defaults"]["CommandExtensions"].split(",")
-                    ]
-                else:
-                    self.commandExtensions = [
-                        str(pv).strip() for pv in self.pilotJSON["Setups"]["Defaults"]["CommandExtensions"]
-                    ]
-            except KeyError:
-                pass
+        self.commandExtensions = options.firstList(
+            [path % "CommandExtensions" for path in setupPaths], self.commandExtensions
+        )
         self.log.debug("Commands extesions: %s" % self.commandExtensions)
 
         # CS URL(s)
-        # pilotSynchronizer() can publish this as a comma separated list. We are ready for that
-        try:
-            if isinstance(
-                self.pilotJSON["ConfigurationServers"], basestring
-            ):  # Generic, there may also be setup-specific ones
-                self.configServer = ",".join(
-                    [str(pv).strip() for pv in self.pilotJSON["ConfigurationServers"].split(",")]
-                )
-            else:  # it's a list, we suppose
-                self.configServer = ",".join([str(pv).strip() for pv in self.pilotJSON["ConfigurationServers"]])
-        except KeyError:
-            pass
-        try:  # now trying to see if there is setup-specific ones
-            if isinstance(
-                self.pilotJSON["Setups"][self.setup]["ConfigurationServer"], basestring
-            ):  # In the specific setup?
-                self.configServer = ",".join(
-                    [str(pv).strip() for pv in self.pilotJSON["Setups"][self.setup]["ConfigurationServer"].split(",")]
-                )
-            else:  # it's a list, we suppose
-                self.configServer = ",".join(
-                    [str(pv).strip() for pv in self.pilotJSON["Setups"][self.setup]["ConfigurationServer"]]
-                )
-        except KeyError:  # and if it doesn't exist
-            try:
-                if isinstance(
-                    self.pilotJSON["Setups"]["Defaults"]["ConfigurationServer"], basestring
-                ):  # Is there one in the defaults section?
-                    self.configServer = ",".join(
-                        [
-                            str(pv).strip()
-                            for pv in self.pilotJSON["Setups"]["Defaults"]["ConfigurationServer"].split(",")
-                        ]
-                    )
-                else:  # it's a list, we suppose
-                    self.configServer = ",".join(
-                        [str(pv).strip() for pv in self.pilotJSON["Setups"]["Defaults"]["ConfigurationServer"]]
-                    )
-            except KeyError:
-                pass
+        # pilotSynchronizer() can publish this as a comma separated list. We are ready for that.
+        # The setup-specific ones, then the ones of the defaults section, then the generic ones
+        configServers = options.firstList(
+            [path % "ConfigurationServer" for path in setupPaths] + ["/ConfigurationServers"]
+        )
+        if configServers is not None:
+            self.configServer = ",".join(configServers)
         self.log.debug("CS list: %s" % self.configServer)
 
         # Version
         # There may be a list of versions specified (in a string, comma separated). We just want the first one.
-        dVersion = None
-        try:
-            dVersion = [dv.strip() for dv in self.pilotJSON["Setups"][self.setup]["Version"].split(",", 1)]
-        except KeyError:
-            try:
-                dVersion = [dv.strip() for dv in self.pilotJSON["Setups"]["Defaults"]["Version"].split(",", 1)]
-            except KeyError:
-                self.log.warn("Could not find a version in the JSON file configuration")
+        dVersion = options.first([path % "Version" for path in setupPaths])
         if dVersion is not None:
+            dVersion = [dv.strip() for dv in dVersion.split(",", 1)]
             self.releaseVersion = str(dVersion[0])
+        else:
+            self.log.warn("Could not find a version in the JSON file configuration")
         self.log.debug("Version: %s -> %s" % (dVersion, self.releaseVersion))
 
-        try:
-            self.releaseProject = str(self.pilotJSON["Setups"][self.setup]["Project"])
-        except KeyError:
-            try:
-                self.releaseProject = str(self.pilotJSON["Setups"]["Defaults"]["Project"])
-            except KeyError:
-                pass
+        self.releaseProject = str(options.first([path % "Project" for path in setupPaths], self.releaseProject))
         self.log.debug("Release project: %s" % self.releaseProject)
 
     def __ceType(self):
@@ -1601,34 +3987,23 @@ class PilotParams(object):
         """
         self.log.debug("CE name: %s" % self.ceName)
         if self.ceName:
+            options = self.optionResolver
             # Try to get the site name and grid CEType from the CE name
             # GridCEType is like "CREAM" or "HTCondorCE" not "InProcess" etc
-            try:
-                self.site = str(self.pilotJSON["CEs"][self.ceName]["Site"])
-            except KeyError:
-                pass
-            try:
-                if not self.gridCEType:
-                    # We don't override a grid CEType given on the command line!
-                    self.gridCEType = str(self.pilotJSON["CEs"][self.ceName]["GridCEType"])
-            except KeyError:
-                pass
+            self.site = str(options.first([("CEs", self.ceName, "Site")], self.site))
+            if not self.gridCEType:
+                # We don't override a grid CEType given on the command line!
+                self.gridCEType = str(options.first([("CEs", self.ceName, "GridCEType")], self.gridCEType))
             # This LocalCEType is like 'InProcess' or 'Pool' or 'Pool/Singularity' etc.
             # It can be in the queue and/or the CE level
-            try:
-                self.ceType = str(self.pilotJSON["CEs"][self.ceName]["LocalCEType"])
-            except KeyError:
-                pass
-            try:
-                self.ceType = str(self.pilotJSON["CEs"][self.ceName][self.queueName]["LocalCEType"])
-            except KeyError:
-                pass
-
-                self.log.debug("Setup: %s" % self.setup)
+            self.ceType = str(
+                options.first(
+                    [("CEs", self.ceName, self.queueName, "LocalCEType"), ("CEs", self.ceName, "LocalCEType")],
+                    self.ceType,
+                )
+            )
+            self.log.debug("Setup: %s" % self.setup)
         self.log.debug("GridCEType: %s" % self.gridCEType)
         if not self.setup:
             # We don't use the default to override an explicit value from command line!
-            try:
-                self.setup = str(self.pilotJSON["DefaultSetup"])
-            except KeyError:
-                pass
+            self.setup = str(self.optionResolver.first(["/DefaultSetup"], self.setup))
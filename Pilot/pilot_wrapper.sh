@@ -10,15 +10,84 @@
 #   * IMMUTABLE!
 #
 # Args:
-#   $1 : URL from where to get the pilot files
+#   $1 : URL from where to get the pilot files,
+#        or URL of a pilot bundle (.pyz, see pilotBundle.py), with pilot.json next to it
 #   $2 : CE name
 #   $3 : queue name
 #
+# Environment:
+#   DIRAC_PILOT_CACHE_DIR : node-local cache of the downloaded files, shared by the pilots of the node
+#                           (default: /tmp/dirac-pilot-cache-<uid>, empty to disable)
+#   DIRAC_PILOT_CACHE_TTL : seconds during which the cached files are used without asking the server (default: 300)
+#
 #-------------------------------------------------------------------------------
 
-if [[ $1 ]]; then
+PILOT_SCRIPT=dirac-pilot.py
+PILOT_CACHE_DIR=${DIRAC_PILOT_CACHE_DIR-/tmp/dirac-pilot-cache-$(id -u)}
+PILOT_CACHE_TTL=${DIRAC_PILOT_CACHE_TTL:-300}
+
+# fetch URL [wget options]
+# Download in the current directory, through the node cache: one directory per URL, updated under a lock
+# by a single pilot at a time, and revalidated with If-Modified-Since (wget --timestamping) once the TTL expired.
+# The revalidation is done on a copy, which replaces the cached files only if the download succeeds.
+fetch() {
+  if [[ -z ${PILOT_CACHE_DIR} ]] || ! command -v flock > /dev/null; then
+    wget "${@:2}" "$1"
+    return
+  fi
+  local cacheEntry
+  cacheEntry="${PILOT_CACHE_DIR}/$(echo -n "$1" | sha1sum | cut -d ' ' -f 1)"
+  # the cache must belong to the pilot user
+  if ! mkdir -p -m 700 "${PILOT_CACHE_DIR}" || [[ ! -O ${PILOT_CACHE_DIR} ]] || ! mkdir -p "${cacheEntry}/files"; then
+    wget "${@:2}" "$1"
+    return
+  fi
+  (
+    flock --exclusive 9
+    if [[ ! -f "${cacheEntry}/stamp" ]] || (( $(date +%s) - $(stat -c %Y "${cacheEntry}/stamp") > PILOT_CACHE_TTL )); then
+      # left by a pilot killed while downloading
+      rm -rf "${cacheEntry}"/download.*
+      local download served
+      download=$(mktemp -d "${cacheEntry}/download.XXXXXX") || exit 1
+      cp -p "${cacheEntry}"/files/* "${download}" 2> /dev/null
+      if (cd "${download}" && wget --timestamping --output-file="${download}.log" "${@:2}" "$1"); then
+        # the files not served anymore are dropped: only the URLs requested by wget are kept
+        served=$(sed -n 's/^--[0-9-]* [0-9:]*--  //p' "${download}.log" | xargs -r -n 1 basename)
+        for file in "${download}"/*; do
+          grep -qxF "$(basename "${file}")" <<< "${served}" || rm -f "${file}"
+        done
+        rm -rf "${cacheEntry}/files.old"
+        mv "${cacheEntry}/files" "${cacheEntry}/files.old" && mv "${download}" "${cacheEntry}/files"
+        rm -rf "${cacheEntry}/files.old"
+        touch "${cacheEntry}/stamp"
+      else
+        rm -rf "${download}"
+        if [[ -z $(ls -A "${cacheEntry}/files") ]]; then
+          cat "${download}.log" >&2
+          rm -f "${download}.log"
+          exit 1
+        fi
+        echo "WARNING: could not revalidate $1, using the cached files"
+      fi
+      rm -f "${download}.log"
+    fi
+    cp -p "${cacheEntry}"/files/* .
+  ) 9> "${cacheEntry}/lock"
+}
+
+if [[ $1 == *'.pyz' ]]; then
+  PILOT_SCRIPT=$(basename "$1")
+  if [[ $1 == 'http'* ]]; then
+    fetch "$1"
+    fetch "${1%/*}/pilot.json"
+  elif [[ $1 == 'file'* ]]; then
+    es=''
+    cp "${1/file:\/\//$es}" .
+    cp "$(dirname "${1/file:\/\//$es}")"/*.json .
+  fi
+elif [[ $1 ]]; then
   if [[ $1 == 'http'* ]]; then
-    wget --no-directories --recursive --no-parent --execute robots=off --reject 'index.html*' "$1"
+    fetch "$1" --no-directories --recursive --no-parent --execute robots=off --reject 'index.html*'
   elif [[ $1 == 'file'* ]]; then
     es=''
     cp "${1/file:\/\//$es}"/*.py .
@@ -32,7 +101,7 @@ fi
 
 # Now run the pilot script
 # X509_USER_PROXY=/scratch/plt/etc/grid-security/hostkey.pem \
-python dirac-pilot.py \
+python "${PILOT_SCRIPT}" \
 --debug \
 --Name "$2" \
 --Queue "$3"
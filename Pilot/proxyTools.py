@@ -2,66 +2,310 @@
 
 from __future__ import absolute_import, division, print_function
 
+import calendar
+import hashlib
+import json
+import os
 import re
-from base64 import b16decode
-from subprocess import PIPE, Popen
+import threading
+import time
+from base64 import b64decode, b64encode
 
 VOMS_FQANS_OID = b"1.3.6.1.4.1.8005.100.100.4"
 VOMS_EXTENSION_OID = b"1.3.6.1.4.1.8005.100.100.5"
 
-RE_OPENSSL_ANS1_FORMAT = re.compile(br"^\s*\d+:d=(\d+)\s+hl=")
+# DER tags
+CONSTRUCTED = 0x20
+OCTET_STRING = 0x04
+OBJECT_IDENTIFIER = 0x06
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
 
+RE_PEM_CERTIFICATE = re.compile(br"-----BEGIN CERTIFICATE-----\n(.+?)\n-----END CERTIFICATE-----", flags=re.DOTALL)
+# the VO is the first element of the FQANs: /<vo>[/<group>...]/Role=<role>/Capability=<capability>
+RE_FQAN_VO = re.compile(br"^/([^/]+)/(?:.*/)?Role=")
 
-def parseASN1(data):
-    cmd = ["openssl", "asn1parse", "-inform", "der"]
-    proc = Popen(cmd, stdin=PIPE, stdout=PIPE)
-    out, _ = proc.communicate(data)
-    if proc.returncode != 0:
-        raise Exception("Error when invoking openssl asn1parse")
-    return out.split(b"\n")
+# proxy-<sha1>.json files of the node cache not used for this long (seconds) are removed
+PROXY_CACHE_MAX_AGE = 24 * 3600
 
 
-def findExtension(oid, lines):
-    for i, line in enumerate(lines):
-        if oid in line:
-            return i
+def encodeOID(oid):
+    """DER encoding of the content of an object identifier
+
+    :param bytes oid: dotted notation, e.g. b"1.3.6.1"
+    :return: bytearray
+    """
+    arcs = [int(arc) for arc in oid.split(b".")]
+    encoded = bytearray()
+    for arc in [40 * arcs[0] + arcs[1]] + arcs[2:]:
+        chunk = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            chunk.insert(0, 0x80 | (arc & 0x7F))
+            arc >>= 7
+        encoded.extend(chunk)
+    return encoded
+
+
+VOMS_FQANS_DER = encodeOID(VOMS_FQANS_OID)
+VOMS_EXTENSION_DER = encodeOID(VOMS_EXTENSION_OID)
+
+
+def readElement(der, pos, end):
+    """Read the header of the DER element at pos
+
+    :param bytearray der: the DER data
+    :param int pos: offset of the element
+    :param int end: offset of the end of the enclosing element
+    :return: tag, offset of the content, offset of the end of the element
+    """
+    try:
+        tag = der[pos]
+        pos += 1
+        if tag & 0x1F == 0x1F:
+            # high tag number: the tag continues while the high bit is set
+            while der[pos] & 0x80:
+                pos += 1
+            pos += 1
+        length = der[pos]
+        pos += 1
+        if length & 0x80:
+            numBytes = length & 0x7F
+            length = 0
+            for byte in der[pos : pos + numBytes]:
+                length = (length << 8) | byte
+            pos += numBytes
+    except IndexError:
+        raise ValueError("Truncated DER element at offset %d" % pos)
+    if pos + length > end:
+        raise ValueError("DER element at offset %d overflows its parent" % pos)
+    return tag, pos, pos + length
+
+
+def iterElements(der, start, end):
+    """The elements of a constructed DER element, without copying them
+
+    :return: generator of (tag, offset of the content, offset of the end)
+    """
+    pos = start
+    while pos < end:
+        element = readElement(der, pos, end)
+        yield element
+        pos = element[2]
+
+
+def findOIDSequence(der, start, end, oid):
+    """Depth-first search of the constructed element (SEQUENCE, SET...) whose first element is an OID
+
+    :param bytearray oid: the DER encoded OID (see encodeOID)
+    :return: list of (tag, offset of the content, offset of the end) of its elements, None if not found
+    """
+    for tag, cStart, cEnd in iterElements(der, start, end):
+        if not tag & CONSTRUCTED:
+            continue
+        elements = list(iterElements(der, cStart, cEnd))
+        if elements and elements[0][0] == OBJECT_IDENTIFIER and der[elements[0][1] : elements[0][2]] == oid:
+            return elements
+        found = findOIDSequence(der, cStart, cEnd, oid)
+        if found is not None:
+            return found
+    return None
+
+
+def iterOctetStrings(der, elements):
+    """The content of the OCTET STRINGs in elements, at any depth"""
+    for tag, cStart, cEnd in elements:
+        if tag == OCTET_STRING:
+            yield bytes(der[cStart:cEnd])
+        elif tag & CONSTRUCTED:
+            for value in iterOctetStrings(der, iterElements(der, cStart, cEnd)):
+                yield value
+
+
+def getFQANs(der):
+    """The FQANs of the VOMS extension of a certificate
+
+    :param bytearray der: the DER certificate
+    :return: list of bytes, None if the certificate has no VOMS extension
+    """
+    extension = findOIDSequence(der, 0, len(der), VOMS_EXTENSION_DER)
+    if extension is None:
+        return None
+    # Extension ::= SEQUENCE { extnID, critical BOOLEAN DEFAULT FALSE, extnValue OCTET STRING }
+    # extnValue contains the attribute certificates, themselves in DER
+    tag, cStart, cEnd = extension[-1]
+    if tag != OCTET_STRING:
+        raise ValueError("Malformed VOMS extension")
+    # Attribute ::= SEQUENCE { type (the FQANs OID), values SET OF IetfAttrSyntax }
+    attribute = findOIDSequence(der, cStart, cEnd, VOMS_FQANS_DER)
+    if attribute is None:
+        return []
+    return list(iterOctetStrings(der, attribute[1:]))
+
+
+def getNotAfter(der):
+    """End of validity of a certificate
+
+    :param bytearray der: the DER certificate
+    :return: int, seconds since the epoch
+    """
+    # Certificate ::= SEQUENCE { tbsCertificate SEQUENCE { [0] version OPTIONAL, serialNumber, signature,
+    #                                                      issuer, validity SEQUENCE { notBefore, notAfter }, ...
+    certificate = readElement(der, 0, len(der))
+    tbsCertificate = next(iterElements(der, certificate[1], certificate[2]))
+    elements = list(iterElements(der, tbsCertificate[1], tbsCertificate[2]))
+    if elements[0][0] == 0xA0:
+        elements = elements[1:]
+    validity = list(iterElements(der, elements[3][1], elements[3][2]))
+    tag, cStart, cEnd = validity[1]
+    value = bytes(der[cStart:cEnd]).decode("ascii")
+    if tag == UTC_TIME:
+        year = int(value[:2])
+        value = ("19" if year >= 50 else "20") + value
+    elif tag != GENERALIZED_TIME:
+        raise ValueError("Invalid certificate validity")
+    timeFields = [int(value[i : i + 2]) for i in range(4, 14, 2)]
+    return calendar.timegm([int(value[:4])] + timeFields + [0, 0, 0])
+
+
+def parseProxy(proxy_data):
+    """Decode a proxy chain
+
+    Args:
+        proxy_data (bytes): Bytes for the proxy chain
+
+    Raises:
+        ValueError: A certificate can not be decoded
+
+    Returns:
+        dict: the VO (None if not found), the FQANs, the end of validity of the chain (notAfter)
+              and the DER certificates (chain)
+    """
+    info = {"vo": None, "fqans": [], "notAfter": None, "chain": []}
+    for pem in RE_PEM_CERTIFICATE.findall(proxy_data):
+        try:
+            der = bytearray(b64decode(pem))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid PEM certificate")
+        info["chain"].append(bytes(der))
+        notAfter = getNotAfter(der)
+        if info["notAfter"] is None or notAfter < info["notAfter"]:
+            info["notAfter"] = notAfter
+        for fqan in getFQANs(der) or []:
+            info["fqans"].append(fqan.decode())
+            # Look for a role, if it exists the VO is the first element
+            match = RE_FQAN_VO.match(fqan)
+            if match and info["vo"] is None:
+                info["vo"] = match.groups()[0].decode()
+    return info
+
+
+def fileIdentity(path):
+    """What identifies a version of a file: its content changes when this changes
+
+    :return: tuple (path, inode, mtime, size)
+    """
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+_proxyInfoCache = {}
+_proxyInfoLock = threading.Lock()
+
+
+def pruneProxyCache(cacheDir, maxAge=PROXY_CACHE_MAX_AGE):
+    """Remove the proxy-<sha1>.json files of the node cache not used for maxAge seconds
+
+    :param str cacheDir: node-local cache directory
+    :param int maxAge: age in seconds of the last use
+    """
+    try:
+        names = os.listdir(cacheDir)
+    except OSError:
+        return
+    oldest = time.time() - maxAge
+    for name in names:
+        if not name.startswith("proxy-"):
+            continue
+        path = os.path.join(cacheDir, name)
+        try:
+            if os.path.getmtime(path) < oldest:
+                os.remove(path)
+        except OSError:
+            # removed by another process of the node
+            pass
+
+
+def getProxyInfo(proxyFile, cacheDir=None):
+    """The information of parseProxy for a proxy file, decoded only when the file changed.
+
+    The results are kept in memory, and in cacheDir if given, for the other processes of the node.
+
+    :param str proxyFile: the proxy file
+    :param str cacheDir: node-local cache directory
+    :return: dict, as parseProxy
+    :raises IOError: the proxy can not be read
+    :raises ValueError: the proxy can not be decoded
+    """
+    identity = fileIdentity(proxyFile)
+    with _proxyInfoLock:
+        if identity in _proxyInfoCache:
+            return _proxyInfoCache[identity]
+
+    cacheFile = None
+    info = None
+    if cacheDir:
+        cacheFile = os.path.join(
+            cacheDir, "proxy-%s.json" % hashlib.sha1(json.dumps(identity).encode("utf-8")).hexdigest()
+        )
+        try:
+            with open(cacheFile, "r") as fp:
+                info = json.load(fp)
+            info["chain"] = [b64decode(der) for der in info["chain"]]
+            # the last use, for pruneProxyCache
+            os.utime(cacheFile, None)
+        except (IOError, OSError, KeyError, TypeError, ValueError):
+            info = None
+
+    if info is None:
+        with open(proxyFile, "rb") as fp:
+            info = parseProxy(fp.read())
+        if cacheFile:
+            try:
+                if not os.path.isdir(cacheDir):
+                    os.makedirs(cacheDir, 0o700)
+                # written in a temporary file then renamed: the other processes never read a partial file
+                tmpFile = "%s.%d" % (cacheFile, os.getpid())
+                cached = dict(info, chain=[b64encode(der).decode("ascii") for der in info["chain"]])
+                with open(tmpFile, "w") as fp:
+                    json.dump(cached, fp)
+                os.rename(tmpFile, cacheFile)
+            except (IOError, OSError):
+                pass
+            pruneProxyCache(cacheDir)
+
+    with _proxyInfoLock:
+        _proxyInfoCache[identity] = info
+    return info
 
 
 def getVO(proxy_data):
     """Fetches the VO in a chain certificate
 
+    The certificates are decoded in memory: no openssl command is needed.
+
     Args:
         proxy_data (bytes): Bytes for the proxy chain
 
     Raises:
-        Exception: Any error related to openssl
+        ValueError: A certificate can not be decoded
         NotImplementedError: Not documented error
 
     Returns:
         str: A VO
     """
 
-    chain = re.findall(br"-----BEGIN CERTIFICATE-----\n.+?\n-----END CERTIFICATE-----", proxy_data, flags=re.DOTALL)
-    for cert in chain:
-        proc = Popen(["openssl", "x509", "-outform", "der"], stdin=PIPE, stdout=PIPE)
-        out, _ = proc.communicate(cert)
-        if proc.returncode != 0:
-            raise Exception("Error when invoking openssl X509")
-        cert_info = parseASN1(out)
-        # Look for the VOMS extension
-        idx_voms_line = findExtension(VOMS_EXTENSION_OID, cert_info)
-        if idx_voms_line is None:
-            continue
-        voms_extension = parseASN1(b16decode(cert_info[idx_voms_line + 1].split(b":")[-1]))
-        # Look for the attribute names
-        idx_fqans = findExtension(VOMS_FQANS_OID, voms_extension)
-        (initial_depth,) = map(int, RE_OPENSSL_ANS1_FORMAT.match(voms_extension[idx_fqans - 1]).groups())
-        for line in voms_extension[idx_fqans:]:
-            (depth,) = map(int, RE_OPENSSL_ANS1_FORMAT.match(line).groups())
-            if depth <= initial_depth:
-                break
-            # Look for a role, if it exists the VO is the first element
-            match = re.search(br"OCTET STRING\s+:/([a-zA-Z0-9]+)/Role=", line)
-            if match:
-                return match.groups()[0].decode()
-    raise NotImplementedError("Something went very wrong")
+    vo = parseProxy(proxy_data)["vo"]
+    if vo is None:
+        raise NotImplementedError("Something went very wrong")
+    return vo
@@ -2,18 +2,45 @@
 
 from __future__ import absolute_import, division, print_function
 
+import base64
 import json
 import os
 import shutil
 import stat
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
 # pylint: disable=protected-access, missing-docstring, invalid-name, line-too-long
 # imports
 import unittest
 
-from Pilot.pilotCommands import CheckWorkerNode, ConfigureSite, NagiosProbes
-from Pilot.pilotTools import PilotParams
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from Pilot.pilotCommands import CheckWorkerNode, ConfigureSite, NagiosProbes, logFinalizer
+from Pilot.pilotTools import (
+    CommandBase,
+    CommandCheckpoints,
+    CommandRegistry,
+    CommandScheduler,
+    LazyJSONObject,
+    Logger,
+    LogSink,
+    NodeDiscoveryCache,
+    ObjectLoader,
+    PilotDaemon,
+    PilotParams,
+    RetryPolicy,
+    configureLogging,
+    directoryProber,
+    getCommandDependencies,
+    reuseDaemonSetup,
+)
 
 
 class PilotTestCase(unittest.TestCase):
@@ -53,6 +80,13 @@ class PilotTestCase(unittest.TestCase):
             "pilot.out",
             "123.txt",
             "testing.tgz",
+            "CheckWorkerNode.pstats",
+            "PilotParams.pstats",
+            "CheckWorkerNode.malloc.txt",
+            "pilot.cfg",
+            "pilot.checkpoints",
+            "pilot-daemon.sock",
+            "firstAttempt",
         ]:
             try:
                 os.remove(fileProd)
@@ -106,6 +140,313 @@ class CommandsTestCase(PilotTestCase):
         cwn = CheckWorkerNode(pp)
         self.assertEqual(cwn.execute(), None)
 
+    def test_profile(self):
+        """Test the profiling of a command"""
+        pp = PilotParams()
+        pp.profile = True
+        pp.profileMemory = True
+        cwn = CheckWorkerNode(pp)
+        self.assertEqual(cwn.execute(), None)
+        self.assertTrue(os.path.isfile("CheckWorkerNode.pstats"))
+        self.assertTrue(os.path.isfile("CheckWorkerNode.malloc.txt"))
+
+        # concurrent commands are profiled one at a time
+        errors = []
+
+        def execute():
+            try:
+                CheckWorkerNode(pp).execute()
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=execute) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # the resolution of the parameters is profiled too, with the options parsed by getopt
+        argv = sys.argv[1:]
+        try:
+            sys.argv[1:] = argv + ["--profile"]
+            self.assertTrue(PilotParams().profile)
+            self.assertTrue(os.path.isfile("PilotParams.pstats"))
+            os.remove("PilotParams.pstats")
+            # but not when --profile is the value of another option
+            sys.argv[1:] = argv + ["--pipInstallOptions", "--profile"]
+            self.assertFalse(PilotParams().profile)
+            self.assertFalse(os.path.exists("PilotParams.pstats"))
+        finally:
+            sys.argv[1:] = argv
+
+        # the profile is sent with the remote logs
+        cwn = CheckWorkerNode(pp)
+        cwn.log = MagicMock(isPilotLoggerOn=True)
+        cwn.execute()
+        lines = cwn.log.sendMessage.call_args[0][0].split("\n")
+        self.assertEqual(lines[0], "BEGIN CheckWorkerNode.pstats (zlib, base64)")
+        with open("CheckWorkerNode.pstats", "rb") as fp:
+            self.assertEqual(zlib.decompress(base64.b64decode("".join(lines[1:-1]))), fp.read())
+
+    def test_checkpoints(self):
+        """Test resuming from the checkpoints of a previous pilot"""
+        with open("pilot.cfg", "w") as fp:
+            fp.write("LocalSite\n{\n}\n")
+        pp = PilotParams()
+        checkpoints = CommandCheckpoints(pp, Logger("Test"))
+        pp.tags = ["WholeNode"]
+        checkpoints.record("CheckWorkerNode")
+        checkpoints.record("InstallDIRAC")
+
+        pp = PilotParams()
+        commands = ["CheckWorkerNode", "ConfigureSite", "InstallDIRAC"]
+        self.assertEqual(CommandCheckpoints(pp, Logger("Test")).resume(commands), 1)
+        self.assertEqual(pp.tags, ["WholeNode"])
+
+        # the configuration was modified after the last checkpoint: nothing is skipped
+        with open("pilot.cfg", "a") as fp:
+            fp.write("Extra\n{\n}\n")
+        self.assertEqual(CommandCheckpoints(pp, Logger("Test")).resume(commands), 0)
+        self.assertFalse(os.path.exists("pilot.checkpoints"))
+
+    def test_daemon(self):
+        """Test a pilot reusing the setup of the pilot daemon"""
+        with open("pilot.cfg", "w") as fp:
+            fp.write("LocalSite\n{\n}\n")
+        commands = [
+            ("FakeInstall", FakeInstall, "testCommands"),
+            ("FakeConfigure", FakeConfigure, "testCommands"),
+            ("FakeBarrier", FakeBarrier, "testCommands"),
+        ]
+        FakeCommand.executed = []
+        pp = PilotParams()
+        pp.tags = ["WholeNode"]
+        pp.rootPath = "/daemon/root"
+        pp.installEnv["DIRAC_TEST_INSTALL"] = "daemon"
+        daemon = PilotDaemon(pp, Logger("Test"))
+        daemon.setup(CommandScheduler(pp, Logger("Test")), commands)
+        # the daemon stops before the commands that must run alone
+        self.assertEqual(len(FakeCommand.executed), 4)
+
+        socketPath = os.path.abspath("pilot-daemon.sock")
+        server = threading.Thread(target=daemon.serve, args=(socketPath,))
+        server.daemon = True
+        server.start()
+        for _ in range(50):
+            if os.path.exists(socketPath):
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(os.stat(socketPath).st_mode & 0o777, 0o600)
+
+        os.remove("pilot.cfg")
+        pp = PilotParams()
+        pp.daemonSocket = socketPath
+        remaining = reuseDaemonSetup(pp, Logger("Test"), commands)
+        self.assertEqual([command[0] for command in remaining], ["FakeConfigure", "FakeBarrier"])
+        self.assertEqual(pp.installEnv["DIRAC_TEST_INSTALL"], "daemon")
+        # only the installation is reused, not the results specific to the daemon pilot
+        self.assertNotEqual(pp.rootPath, "/daemon/root")
+        self.assertEqual(pp.tags, [])
+        self.assertFalse(os.path.exists("pilot.cfg"))
+
+        # the daemon was set up for another CE
+        pp.ceName = "other.example.com"
+        self.assertEqual(reuseDaemonSetup(pp, Logger("Test"), commands), commands)
+
+    def test_deadline(self):
+        """Test the commands deadlines"""
+        pp = PilotParams()
+        command = CheckWorkerNode(pp)
+        command.deadline = time.time() + 1
+        startTime = time.time()
+        retCode, _ = command.executeAndGetOutput("sleep 30")
+        self.assertNotEqual(retCode, 0)
+        self.assertLess(time.time() - startTime, 10)
+
+        # optional commands are skipped near the end of the slot
+        pp.walltime = 60
+        FakeCommand.executed = []
+        commands = [("FakeOptional", FakeOptional, "testCommands"), ("FakeCheck", FakeCheck, "testCommands")]
+        CommandScheduler(pp, Logger("Test")).run(commands)
+        self.assertEqual(FakeCommand.executed, [("start", "FakeCheck"), ("end", "FakeCheck")])
+
+        # unless the reserve of the payload is short enough
+        pp.optionalCommandsReserve = 30
+        FakeCommand.executed = []
+        CommandScheduler(pp, Logger("Test")).run(commands)
+        self.assertEqual(len(FakeCommand.executed), 4)
+
+        # an invalid value is ignored
+        argv = sys.argv[1:]
+        try:
+            sys.argv[1:] = argv + ["--walltime", "1h", "--retries", "many", "--optionalCommandsReserve", "1h"]
+            pp = PilotParams()
+        finally:
+            sys.argv[1:] = argv
+        self.assertEqual((pp.walltime, pp.retries, pp.optionalCommandsReserve), (0, 2, 3600))
+
+    def test_retries(self):
+        """Test the retries of transient failures"""
+        policy = RetryPolicy(attempts=3, backoff=0)
+        self.assertTrue(policy.isRetryable(1, "Could not connect to dips://server:9135"))
+        self.assertFalse(policy.isRetryable(1, "No such file or directory"))
+        self.assertFalse(policy.isRetryable(0, "Could not connect"))
+        self.assertLessEqual(RetryPolicy(backoff=10, maxBackoff=30, jitter=0.5).delay(5), 45)
+
+        command = CheckWorkerNode(PilotParams())
+        cmd = "if [ -f firstAttempt ]; then echo OK; else touch firstAttempt; echo 'Connection refused'; exit 1; fi"
+        retCode, output = command.executeWithRetries(cmd, retryPolicy=policy)
+        self.assertEqual(retCode, 0)
+        self.assertIn("OK", output)
+
+        # the whole command is executed again after a transient failure, not after the definitive one
+        os.remove("firstAttempt")
+        FlakyCommand.attempts = []
+        pp = PilotParams()
+        pp.commandRetries = {"FlakyCommand": 3}
+        pp.pilotLogging = True
+        pp.loggerURL = "https://127.0.0.2/"
+        with patch("time.sleep"), patch("Pilot.pilotTools.sendMessage"), patch(
+            "Pilot.pilotCommands.sendMessage"
+        ) as sendMock:
+            with self.assertRaises(SystemExit) as exc:
+                CommandScheduler(pp, Logger("Test")).run([("FlakyCommand", FlakyCommand, "testCommands")])
+        self.assertEqual(exc.exception.code, 2)
+        self.assertEqual(FlakyCommand.attempts, [1, 2])
+        # the remote logs are finalised by the last attempt only
+        self.assertEqual([args[3] for args, _kwargs in sendMock.call_args_list], ["finaliseLogs"])
+
+    def test_paramsSnapshot(self):
+        """Test the reuse of the parameters resolved by a previous pilot"""
+        nodeCache = tempfile.mkdtemp()
+        argv = sys.argv[1:]
+        try:
+            os.environ["DIRAC_PILOT_CACHE_DIR"] = nodeCache
+            pp = PilotParams()
+            phases = [phase for phase, _start, _end in pp.startupTimes]
+            self.assertIn("initJSON", phases)
+            self.assertEqual(len(os.listdir(nodeCache)), 1)
+
+            configureLogging(pilotUUID="other")
+            snapshotParams = PilotParams()
+            phases = [phase for phase, _start, _end in snapshotParams.startupTimes]
+            self.assertEqual(phases, ["commandLine1", "loadSnapshot"])
+            # the JSON log records have the pilot UUID
+            self.assertEqual(LogSink.pilotUUID, snapshotParams.pilotUUID)
+            self.assertEqual(snapshotParams.commands, pp.commands)
+            self.assertEqual(snapshotParams.commandExtensions, pp.commandExtensions)
+            self.assertEqual(snapshotParams.releaseVersion, pp.releaseVersion)
+            # the JSON file is still available to the commands
+            self.assertEqual(snapshotParams.pilotJSON["DefaultSetup"], "TestSetup")
+
+            # another pilot of the queue: same snapshot, but its own UUID
+            sys.argv[1:] = argv + ["--pilotUUID", "pilot-2"]
+            otherParams = PilotParams()
+            self.assertNotIn("initJSON", [phase for phase, _start, _end in otherParams.startupTimes])
+            self.assertEqual(otherParams.pilotUUID, "pilot-2")
+            self.assertEqual(LogSink.pilotUUID, "pilot-2")
+            sys.argv[1:] = argv
+
+            # the security dirs of the snapshot are checked with a timeout: one that hangs invalidates it
+            wait = directoryProber.wait
+            hanging = []
+
+            def hangOnce(probe, timeout):
+                if not hanging:
+                    hanging.append(probe.directory)
+                    return None
+                return wait(probe, timeout)
+
+            with patch.object(directoryProber, "wait", side_effect=hangOnce):
+                phases = [phase for phase, _start, _end in PilotParams().startupTimes]
+            self.assertIn("initJSON", phases)
+            self.assertEqual(hanging, [os.getcwd()])
+
+            # a modified JSON file invalidates the snapshot, and the unused snapshots are removed
+            oldSnapshot = os.path.join(nodeCache, "params-old.json")
+            with open(oldSnapshot, "w") as fp:
+                fp.write("{}")
+            os.utime(oldSnapshot, (time.time() - 2 * 24 * 3600,) * 2)
+            with open("pilot.json", "a") as fp:
+                fp.write("\n")
+            phases = [phase for phase, _start, _end in PilotParams().startupTimes]
+            self.assertIn("initJSON", phases)
+            self.assertFalse(os.path.exists(oldSnapshot))
+            self.assertEqual(len(os.listdir(nodeCache)), 2)
+        finally:
+            sys.argv[1:] = argv
+            del os.environ["DIRAC_PILOT_CACHE_DIR"]
+            shutil.rmtree(nodeCache)
+
+    def test_discoveryCache(self):
+        """Test the reuse of the security dirs found by a previous pilot of the node"""
+        nodeCache = tempfile.mkdtemp()
+        location = tempfile.mkdtemp()
+        argv = sys.argv[1:]
+        environ = patch.dict(os.environ)
+        environ.start()
+        try:
+            for name in ["certificates", "vomsdir", "vomses"]:
+                os.makedirs(os.path.join(location, "etc/grid-security", name))
+                open(os.path.join(location, "etc/grid-security", name, "file"), "w").close()
+            locations = "%s,%s" % (os.path.join(location, "missing"), location)
+            sys.argv[1:] = ["--CVMFS_locations", locations, "--nodeCache", nodeCache]
+            PilotParams()
+            certificates = os.path.join(location, "etc/grid-security/certificates")
+            self.assertEqual(os.environ["X509_CERT_DIR"], certificates)
+
+            os.environ["X509_CERT_DIR"] = os.getcwd()
+            sys.argv[1:] += ["--debug"]  # not the same parameters snapshot
+            with patch.object(directoryProber, "probe", wraps=directoryProber.probe) as probeMock:
+                PilotParams()
+            # only the directories found by the first pilot are probed, not the other candidates
+            probed = set(call[0][0] for call in probeMock.call_args_list)
+            self.assertIn(certificates, probed)
+            self.assertFalse([directory for directory in probed if "missing" in directory])
+            self.assertEqual(os.environ["X509_CERT_DIR"], certificates)
+
+            # the entries expire, or are ignored if the check fails
+            discovery = NodeDiscoveryCache(nodeCache, ttl=0.1)
+            key = "X509_CERT_DIR %s" % locations
+            self.assertEqual(discovery.get(key, os.path.isdir), certificates)
+            self.assertIsNone(discovery.get(key, lambda _value: False))
+            time.sleep(0.2)
+            self.assertIsNone(discovery.get(key))
+        finally:
+            environ.stop()
+            sys.argv[1:] = argv
+            shutil.rmtree(nodeCache)
+            shutil.rmtree(location)
+
+    def test_lazyJSON(self):
+        """Test the lazy decoding of the pilot JSON file"""
+        with open("pilot.json", "r") as fp:
+            content = json.load(fp)
+        with patch("Pilot.pilotTools.LAZY_JSON_MIN_SIZE", 0):
+            pp = PilotParams()
+        self.assertIsInstance(pp.pilotJSON, LazyJSONObject)
+        self.assertEqual(pp.commandExtensions, ["TestExtension1", "TestExtension2"])
+        self.assertEqual(pp.site, "site.example.com")
+        self.assertEqual(dict(pp.pilotJSON["CEs"]["grid1.example.com"]), content["CEs"]["grid1.example.com"])
+        self.assertEqual(sorted(pp.pilotJSON), sorted(content))
+        self.assertEqual(PilotParams.getOptionForPaths(["/Missing/Pilot"], pp.pilotJSON), {})
+        self.assertRaises(ValueError, LazyJSONObject, b'{"CEs": {"a": 1}')
+        self.assertRaises(ValueError, LazyJSONObject, b'{"CEs": {"a": [1, "]"}')
+
+        # the values are not decoded when indexed, and decoded once when read
+        document = LazyJSONObject(b'{"a": {"b": [1, {"c": "}\\""}], "d": null}, "e": -1.5e3, "f": "\\u00e9"}')
+        with patch("json.loads", side_effect=json.loads) as loadsMock:
+            self.assertIn("b", document["a"])
+            self.assertNotIn("x", document["a"])
+            loadsMock.assert_not_called()
+            self.assertEqual(document["a"]["b"], [1, {"c": '}"'}])
+            self.assertIs(document["a"]["b"], document["a"]["b"])
+            self.assertEqual(loadsMock.call_count, 1)
+        self.assertEqual(dict(document["a"]), {"b": [1, {"c": '}"'}], "d": None})
+        self.assertEqual((document["e"], document["f"]), (-1500.0, u"\u00e9"))
+
     def test_ConfigureSite(self):
         """Test ConfigureSite command"""
         pp = PilotParams()
@@ -134,6 +475,160 @@ class CommandsTestCase(PilotTestCase):
         self.assertEqual(nagios.nagiosPutURL, "https://127.0.0.2/")
 
 
+class FakeCommand(object):
+    """A command recording when it ran"""
+
+    needs = ()
+    produces = ()
+    reusable = False
+    optional = False
+    executed = []
+    lock = threading.Lock()
+
+    def __init__(self, pilotParams):
+        self.pp = pilotParams
+        self.log = Logger(self.__class__.__name__)
+
+    def retryDelay(self, exitCode):
+        return None
+
+    def execute(self):
+        with self.lock:
+            self.executed.append(("start", self.__class__.__name__))
+        time.sleep(0.1)
+        with self.lock:
+            self.executed.append(("end", self.__class__.__name__))
+
+
+class FakeInstall(FakeCommand):
+    produces = ("installEnv",)
+    reusable = True
+
+
+class FakeCheck(FakeCommand):
+    pass
+
+
+class FakeConfigure(FakeCommand):
+    needs = ("installEnv",)
+    produces = ("pilot.cfg",)
+
+
+class FakeLHCbInstall(FakeInstall):
+    produces = ()
+
+
+class FakeRegister(FakeCommand):
+    needs = ("FakeInstall",)
+
+
+class FakeBarrier(FakeCommand):
+    needs = None
+
+
+class FakeOptional(FakeCommand):
+    optional = True
+
+
+class FlakyCommand(CommandBase):
+    """Fails with a transient error at the first attempt, then with a definitive one"""
+
+    needs = ()
+    produces = ()
+    attempts = []
+
+    @logFinalizer
+    def execute(self):
+        FlakyCommand.attempts.append(self.attempt)
+        retCode, _ = self.executeAndGetOutput(
+            "if [ -f firstAttempt ]; then echo 'No space left'; exit 2; fi; "
+            "touch firstAttempt; echo 'Connection refused'; exit 1"
+        )
+        sys.exit(retCode)
+
+
+class FakeParams(object):
+    commandTimeouts = {}
+    commandRetries = {}
+    slotDeadline = None
+
+
+class CommandSchedulerTestCase(unittest.TestCase):
+    """Test the dependencies between commands and their concurrent execution"""
+
+    def test_dependencies(self):
+        commands = [
+            ("FakeInstall", FakeInstall),
+            ("FakeCheck", FakeCheck),
+            ("FakeConfigure", FakeConfigure),
+            ("FakeBarrier", FakeBarrier),
+            ("FakeCheck", FakeCheck),
+        ]
+        self.assertEqual(getCommandDependencies(commands), [set(), set(), {0}, {0, 1, 2}, {3}])
+        # needs are also matched against the names of the base classes
+        self.assertEqual(getCommandDependencies([("X", FakeLHCbInstall), ("Y", FakeRegister)]), [set(), {0}])
+
+    def test_registry(self):
+        moduleDir = tempfile.mkdtemp()
+        with open(os.path.join(moduleDir, "testExtCommands.py"), "w") as fp:
+            fp.write("class Extra(object):\n    def execute(self):\n        pass\n")
+        with open(os.path.join(moduleDir, "testBrokenCommands.py"), "w") as fp:
+            fp.write("raise ValueError('broken')\n")
+        sys.path.insert(0, moduleDir)
+        try:
+            registry = CommandRegistry(["testExt", "testBroken", "testMissing"], Logger("Test"))
+            self.assertEqual(registry.get("Extra")[1], "testExtCommands")
+            # the next modules are imported only when needed
+            self.assertNotIn("testBrokenCommands", sys.modules)
+            self.assertEqual(registry.get("Unknown"), (None, None))
+            self.assertIn("broken", registry.importErrors["testBrokenCommands"])
+            self.assertIn("testMissingCommands", registry.importErrors)
+        finally:
+            sys.path.remove(moduleDir)
+            shutil.rmtree(moduleDir)
+
+    def test_objectLoader(self):
+        moduleDir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(moduleDir, "testPackage"))
+        with open(os.path.join(moduleDir, "testPackage", "__init__.py"), "w") as fp:
+            fp.write("")
+        with open(os.path.join(moduleDir, "testPackage", "testModule.py"), "w") as fp:
+            fp.write("class Test(object):\n    pass\n")
+        sys.path.insert(0, moduleDir)
+        try:
+            testClasses = []
+            for _ in range(2):
+                loader = ObjectLoader([""], Logger("Test"))
+                for _ in range(2):
+                    testClass, _path = loader.loadObject("testPackage", "testModule", "Test")
+                    self.assertEqual(testClass.__name__, "Test")
+                    testClasses.append(testClass)
+            # the module code was executed only once: always the same class
+            self.assertTrue(all(testClass is testClasses[0] for testClass in testClasses))
+            self.assertEqual(loader.loadObject("testPackage", "missingModule", "Test"), (None, None))
+            self.assertIn("testPackage.missingModule", loader.importErrors)
+        finally:
+            sys.path.remove(moduleDir)
+            shutil.rmtree(moduleDir)
+            for name in ("testPackage", "testPackage.testModule", "testPackage.missingModule"):
+                sys.modules.pop(name, None)
+
+    def test_run(self):
+        FakeCommand.executed = []
+        commands = [
+            ("FakeInstall", FakeInstall, "testCommands"),
+            ("FakeCheck", FakeCheck, "testCommands"),
+            ("FakeConfigure", FakeConfigure, "testCommands"),
+        ]
+        CommandScheduler(FakeParams(), Logger("Test"), maxWorkers=4).run(commands)
+        executed = FakeCommand.executed
+        # FakeInstall and FakeCheck are independent: both start before any of them ends
+        self.assertEqual(sorted(executed[:2]), [("start", "FakeCheck"), ("start", "FakeInstall")])
+        # FakeConfigure waits for FakeInstall
+        self.assertLess(executed.index(("end", "FakeInstall")), executed.index(("start", "FakeConfigure")))
+        self.assertEqual(len(executed), 6)
+
+
 #############################################################################
 # Test Suite run
 #############################################################################
@@ -142,6 +637,7 @@ class CommandsTestCase(PilotTestCase):
 if __name__ == "__main__":
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(PilotTestCase)
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(CommandsTestCase))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(CommandSchedulerTestCase))
     testResult = unittest.TextTestRunner(verbosity=2).run(suite)
 
 # EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#EOF#
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+try:
+    from Pilot.pilotBundle import buildBundle
+except ImportError:
+    from pilotBundle import buildBundle
+
+
+class TestPilotBundle(unittest.TestCase):
+    def setUp(self):
+        self.buildDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.buildDir)
+
+    def test_buildBundle(self):
+        extension = os.path.join(self.buildDir, "TestPilotCommands.py")
+        with open(extension, "w") as fp:
+            fp.write("VALUE = 42\n")
+        bundle = os.path.join(self.buildDir, "dirac-pilot.pyz")
+        buildBundle(bundle, sys.executable, [extension])
+
+        with open(bundle, "rb") as fp:
+            self.assertTrue(fp.readline().startswith(b"#!/usr/bin/env python"))
+        names = zipfile.ZipFile(bundle).namelist()
+        for name in ["__main__", "pilotTools", "pilotCommands", "proxyTools", "TestPilotCommands"]:
+            self.assertIn(name + ".py", names)
+            self.assertIn(name + ".pyc", names)
+
+        # the modules are imported from the bundle
+        script = "import sys; sys.path.insert(0, sys.argv[1]); import TestPilotCommands; print(TestPilotCommands.VALUE)"
+        output = subprocess.check_output([sys.executable, "-c", script, bundle])
+        self.assertEqual(output.strip(), b"42")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from Pilot.pilotShards import writeShards
+    from Pilot.pilotTools import PilotParams
+except ImportError:
+    from pilotShards import writeShards
+    from pilotTools import PilotParams
+
+
+class TestPilotShards(unittest.TestCase):
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        basedir = os.path.dirname(__file__)
+        with open(os.path.join(basedir, "../../tests/CI/pilot_newSchema.json"), "r") as fp:
+            self.pilotJSON = json.load(fp)
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def test_writeShards(self):
+        self.assertEqual(writeShards(self.pilotJSON, self.output), len(self.pilotJSON["CEs"]) + 1)
+        with open(os.path.join(self.output, "index.json"), "r") as fp:
+            index = json.load(fp)
+        self.assertEqual(sorted(index["CEs"]), sorted(self.pilotJSON["CEs"]))
+        with open(os.path.join(self.output, index["CEs"]["jenkins.cern.ch"]), "r") as fp:
+            shard = json.load(fp)
+        self.assertEqual(shard["CEs"], {"jenkins.cern.ch": self.pilotJSON["CEs"]["jenkins.cern.ch"]})
+        self.assertEqual(shard["gridpp"], self.pilotJSON["gridpp"])
+        with open(os.path.join(self.output, "default.json"), "r") as fp:
+            self.assertEqual(json.load(fp)["CEs"], {})
+
+        # unchanged shards are not written again, the shards of the removed CEs are deleted
+        del self.pilotJSON["CEs"]["jenkins.cern.ch"]
+        self.assertEqual(writeShards(self.pilotJSON, self.output), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.output, index["CEs"]["jenkins.cern.ch"])))
+
+    def test_pilotParams(self):
+        """The pilot only reads the shard of its CE"""
+        writeShards(self.pilotJSON, self.output)
+        os.environ["X509_CERT_DIR"] = os.getcwd()
+        os.environ["X509_VOMS_DIR"] = os.getcwd()
+        os.environ["X509_VOMSES"] = os.getcwd()
+        os.environ["X509_USER_PROXY"] = os.getcwd()
+        argv = sys.argv[1:]
+        try:
+            sys.argv[1:] = ["--pilotShards", self.output, "--Name", "jenkins-mp-pool.cern.ch", "--wnVO", "gridpp"]
+            pp = PilotParams()
+            self.assertEqual(pp.pilotCFGFile, os.path.join(self.output, "CEs", "jenkins-mp-pool.cern.ch.json"))
+            self.assertEqual(list(pp.pilotJSON["CEs"]), ["jenkins-mp-pool.cern.ch"])
+            self.assertEqual(pp.gridCEType, "TEST-MP")
+            self.assertEqual(pp.ceType, "Pool")
+
+            sys.argv[1:] = ["--pilotShards", "file://" + self.output, "--Name", "unknown.example.com"]
+            pp = PilotParams()
+            self.assertEqual(pp.pilotCFGFile, "pilot-shard.json")
+            self.assertEqual(pp.pilotJSON["CEs"], {})
+        finally:
+            sys.argv[1:] = argv
+            if os.path.exists("pilot-shard.json"):
+                os.remove("pilot-shard.json")
+
+
+if __name__ == "__main__":
+    unittest.main()
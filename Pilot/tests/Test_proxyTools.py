@@ -5,14 +5,16 @@ import shlex
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
 import unittest
 
 ############################
 # python 2 -> 3 "hacks"
 try:
-    from Pilot.proxyTools import getVO, parseASN1
+    from Pilot.proxyTools import getProxyInfo, getVO
 except ImportError:
-    from proxyTools import getVO, parseASN1
+    from proxyTools import getProxyInfo, getVO
 
 try:
     from unittest.mock import patch
@@ -31,55 +33,67 @@ class TestProxyTools(unittest.TestCase):
         os.remove(cert)
         self.assertEqual(vo, "fakevo")
 
-    @patch("Pilot.proxyTools.Popen")
-    def test_getVOPopenFails(self, popenMock):
-        """
-        Check if an exception is raised when Popen return code is not 0.
-
-        """
-        popenMock.return_value.returncode = -1
-        popenMock.return_value.communicate.return_value = ("output", "error")
-        cert = "x509_uFAKE"
-        ret = self.__createFakeProxy(cert)
-        self.assertEqual(ret, 0)
-        msg = "Error when invoking openssl X509"
-        with open(cert, "rb") as fp:
+    @patch("subprocess.Popen")
+    def test_getVOWithoutOpenssl(self, popenMock):
+        """The VO is read without invoking openssl"""
+        popenMock.side_effect = OSError("command not found: openssl")
+        basedir = os.path.dirname(__file__)
+        with open(basedir + "/certs/voms/proxy.pem", "rb") as fp:
             data = fp.read()
-        os.remove(cert)
-        with self.assertRaises(Exception) as exc:
-            getVO(data)
+        self.assertEqual(getVO(data), "fakevo")
+        popenMock.assert_not_called()
 
-        self.assertEqual(str(exc.exception), msg)
+        # without VOMS extension
+        with open(basedir + "/certs/user/usercert.pem", "rb") as fp:
+            with self.assertRaises(NotImplementedError):
+                getVO(fp.read())
 
-        popenMock.reset_mock()
-        # if an underlying command fails, the exception is propagated:
-        msg = "command not found: openssl"
-        popenMock.side_effect = OSError(msg)
-        with self.assertRaises(OSError) as exc:
-            getVO(data)
-        self.assertEqual(str(exc.exception), msg)
-
-    @patch("Pilot.proxyTools.Popen")
-    def test_parseASN1Fails(self, popenMock):
-        """Should raise an exception when Popen return code is !=0"""
-
-        popenMock.return_value.returncode = -1
-        popenMock.return_value.communicate.return_value = ("output", "error")
-        msg = "Error when invoking openssl asn1parse"
-
-        with self.assertRaises(Exception) as exc:
-            parseASN1("Anything")
-
-        self.assertEqual(str(exc.exception), msg)
-
-        popenMock.reset_mock()
+    def test_getVOInvalid(self):
+        """A truncated certificate raises a ValueError"""
+        basedir = os.path.dirname(__file__)
+        with open(basedir + "/certs/voms/proxy.pem", "rb") as fp:
+            data = fp.read()
+        begin, end = b"-----BEGIN CERTIFICATE-----\n", b"\n-----END CERTIFICATE-----"
+        pem = data[data.index(begin) + len(begin) : data.index(end)]
+        with self.assertRaises(ValueError):
+            getVO(begin + pem[: len(pem) // 2].rstrip() + end)
 
-        # if an underlying command fails, the exception is propagated:
-        msg = "command not found: openssl"
-        popenMock.side_effect = OSError(msg)
-        with self.assertRaises(OSError) as exc:
-            parseASN1("Anything")
-        self.assertEqual(str(exc.exception), msg)
+    def test_getProxyInfo(self):
+        """The proxy is decoded again only when it changes"""
+        basedir = os.path.dirname(__file__)
+        cacheDir = tempfile.mkdtemp()
+        proxyFile = os.path.join(cacheDir, "x509up")
+        shutil.copy(basedir + "/certs/voms/proxy.pem", proxyFile)
+        try:
+            info = getProxyInfo(proxyFile, cacheDir)
+            self.assertEqual(info["vo"], "fakevo")
+            self.assertEqual(info["fqans"], ["/fakevo/Role=user/Capability=NULL"])
+            self.assertEqual(info["notAfter"], 1720285905)  # Jul  6 17:11:45 2024 GMT
+            self.assertEqual(len(info["chain"]), 2)
+            self.assertIs(getProxyInfo(proxyFile, cacheDir), info)
+
+            # another process of the node reads it from the cache directory
+            with patch.dict("Pilot.proxyTools._proxyInfoCache", clear=True):
+                with patch("Pilot.proxyTools.parseProxy") as parseMock:
+                    self.assertEqual(getProxyInfo(proxyFile, cacheDir), info)
+                    parseMock.assert_not_called()
+
+            # the cache file of a proxy not used for long is removed when another one is written
+            oldFile = os.path.join(cacheDir, "proxy-0000.json")
+            with open(oldFile, "w") as fp:
+                fp.write("{}")
+            os.utime(oldFile, (time.time() - 2 * 24 * 3600,) * 2)
+
+            # a new proxy
+            with open(basedir + "/certs/user/usercert.pem", "rb") as fp:
+                data = fp.read()
+            with open(proxyFile, "wb") as fp:
+                fp.write(data)
+            self.assertIsNone(getProxyInfo(proxyFile, cacheDir)["vo"])
+            self.assertFalse(os.path.exists(oldFile))
+            self.assertEqual(len([name for name in os.listdir(cacheDir) if name.startswith("proxy-")]), 2)
+        finally:
+            shutil.rmtree(cacheDir)
 
     def test_createFakeProxy(self):
         """Just test if a proxy is created"""
@@ -2,17 +2,55 @@
 
 from __future__ import absolute_import, division, print_function
 
+import gzip
 import json
 import os
 import random
+import shutil
 import string
 import sys
 import tempfile
+import threading
+import time
 
 try:
-    from Pilot.pilotTools import CommandBase, Logger, PilotParams
+    from Pilot.pilotTools import (
+        CommandBase,
+        DirectoryProber,
+        JSONOptionResolver,
+        Logger,
+        LogWriter,
+        PilotParams,
+        Tracer,
+        closeLogSinks,
+        configureLogging,
+        drainLogs,
+        getAllocatedProcessors,
+        getLogSegments,
+        getLogSink,
+        getSSLContext,
+        keptLogs,
+        utcTimestamp,
+    )
 except ImportError:
-    from pilotTools import CommandBase, Logger, PilotParams
+    from pilotTools import (
+        CommandBase,
+        DirectoryProber,
+        JSONOptionResolver,
+        Logger,
+        LogWriter,
+        PilotParams,
+        Tracer,
+        closeLogSinks,
+        configureLogging,
+        drainLogs,
+        getAllocatedProcessors,
+        getLogSegments,
+        getLogSink,
+        getSSLContext,
+        keptLogs,
+        utcTimestamp,
+    )
 
 import unittest
 
@@ -46,6 +84,18 @@ class TestPilotParams(unittest.TestCase):
         self.assertEqual(pp.loggerURL, "dummyURL")
         self.assertTrue(pp.debugFlag)
 
+    def test_getAllocatedProcessors(self):
+        """MJF is read from a local directory without urllib"""
+        jobFeatures = tempfile.mkdtemp()
+        with open(os.path.join(jobFeatures, "allocated_cpu"), "w") as fp:
+            fp.write("8\n")
+        with patch.dict(os.environ, {"JOBFEATURES": jobFeatures}):
+            self.assertEqual(getAllocatedProcessors(), 8)
+        with patch.dict(os.environ, {"JOBFEATURES": os.path.join(jobFeatures, "missing")}):
+            self.assertEqual(getAllocatedProcessors(), 1)
+        os.remove(os.path.join(jobFeatures, "allocated_cpu"))
+        os.rmdir(jobFeatures)
+
     def test_getOptionForPaths(self):
         """Test option preference by path (later paths have higher preference)"""
 
@@ -68,6 +118,25 @@ class TestPilotParams(unittest.TestCase):
         del jsonDict[vo]["Pilot"]["RemoteLogging"]  # remove a vo-specific settings, a default value is False:
         res = PilotParams.getOptionForPaths(paths, jsonDict)
         self.assertEqual(res["RemoteLogging"], "False")
+        # the missing sections are not added
+        self.assertNotIn("DIRAC-Certification", jsonDict)
+
+    def test_optionResolver(self):
+        document = {
+            "Setups": {"Defaults": {"Version": "v1", "Commands": {"Defaults": "a, b"}}, "Test": {"Version": "v2"}},
+            "CEs": {"ce.example.com": {"Site": "site.example.com"}},
+        }
+        resolver = JSONOptionResolver(document)
+        self.assertEqual(resolver.first(["/Setups/Test/Version", "/Setups/Defaults/Version"]), "v2")
+        self.assertEqual(resolver.first(["/Setups/Other/Version", "/Setups/Defaults/Version"]), "v1")
+        self.assertEqual(resolver.first(["/Setups/Other/Version"], "default"), "default")
+        commands = resolver.firstList(["/Setups/Test/Commands/X", "/Setups/Defaults/Commands/Defaults"])
+        self.assertEqual(commands, ["a", "b"])
+        self.assertEqual(resolver.first([("CEs", "ce.example.com", "Site")]), "site.example.com")
+        self.assertEqual(resolver.merged(["/Setups/Defaults", "/Setups/Test", "/Missing"])["Version"], "v2")
+        # nothing is added to the document
+        self.assertEqual(sorted(document["Setups"]), ["Defaults", "Test"])
+        self.assertNotIn("Missing", document)
 
     @patch.object(PilotParams, "_PilotParams__getSearchPaths")
     @patch("sys.argv")
@@ -172,5 +241,267 @@ class TestCommandBase(unittest.TestCase):
             self.stdout_mock.truncate()
             self.stderr_mock.truncate()
 
+    def test_getSSLContext(self):
+        """The SSL context is reused while the credentials do not change"""
+        certs = os.path.join(os.path.dirname(__file__), "certs")
+        context, isHost = getSSLContext(os.path.join(certs, "ca"), os.path.join(certs, "host"))
+        self.assertTrue(isHost)
+        self.assertIs(getSSLContext(os.path.join(certs, "ca"), os.path.join(certs, "host"))[0], context)
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.out = tempfile.NamedTemporaryFile(suffix=".out", delete=False).name
+
+    def tearDown(self):
+        configureLogging(
+            flushPolicy="message", queueSize=0, logFormat="classic", pilotUUID="unknown", maxSize=0, backupCount=5
+        )
+        closeLogSinks()
+        for fileName in (self.out, self.out + ".jsonl"):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def read(self):
+        with open(self.out) as fp:
+            return fp.read()
+
+    def test_utcTimestamp(self):
+        self.assertEqual(utcTimestamp(1715509230.5), "2024-05-12T10:20:30.500000Z")
+        self.assertEqual(utcTimestamp(1715509231.25), "2024-05-12T10:20:31.250000Z")
+        # formatted once per millisecond
+        timestamp = utcTimestamp(1715509231.1234)
+        self.assertEqual(timestamp, "2024-05-12T10:20:31.123000Z")
+        self.assertIs(utcTimestamp(1715509231.1238), timestamp)
+
+    @patch("sys.stdout")
+    def test_logSink(self, stdoutMock):
+        first, second = Logger("First", pilotOutput=self.out), Logger("Second", pilotOutput=self.out)
+        first.info("one\ntwo")
+        second.warn("three", header=False)
+        self.assertIs(getLogSink(self.out), getLogSink(os.path.abspath(self.out)))
+        lines = self.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].endswith(" INFO [First] one"))
+        self.assertTrue(lines[1].endswith(" INFO [First] two"))
+        self.assertEqual(lines[2], "three")
+        self.assertEqual(stdoutMock.write.call_count, 2)
+
+        # flushed only at exit, or for errors
+        configureLogging(flushPolicy="exit")
+        first.info("four")
+        self.assertEqual(len(self.read().splitlines()), 3)
+        first.error("five")
+        self.assertEqual(len(self.read().splitlines()), 5)
+        self.assertRaises(ValueError, configureLogging, flushPolicy="never")
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    def test_asyncLogging(self, stdoutMock, stderrMock):
+        configureLogging(queueSize=10)
+        logger = Logger("Async", pilotOutput=self.out)
+        for i in range(5):
+            logger.info("message %d" % i)
+        drainLogs()
+        lines = self.read().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[4].endswith(" INFO [Async] message 4"))
+        self.assertEqual(stdoutMock.write.call_count, 5)
+
+        # a forked child writes synchronously: it does not wait at exit for a writer thread it does not have
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logger.info("from the child")
+                closeLogSinks()
+            finally:
+                os._exit(0)
+        for _ in range(100):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                break
+            time.sleep(0.1)
+        else:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            self.fail("the forked child is blocked")
+        self.assertTrue(self.read().splitlines()[-1].endswith(" INFO [Async] from the child"))
+
+        # the writer thread is busy and the queue is full: the next messages are dropped
+        writer = LogWriter()
+        writer.start(queueSize=1, overflow="drop")
+        started, release = threading.Event(), threading.Event()
+        writer.submit(lambda: started.set() or release.wait(10))
+        started.wait(10)
+        written = []
+        for i in range(3):
+            writer.submit(written.append, i)
+        self.assertEqual(writer.dropped, 2)
+        release.set()
+        writer.stop()
+        self.assertEqual(written, [0])
+        self.assertIn("2 log messages dropped", stderrMock.write.call_args[0][0])
+        self.assertRaises(ValueError, writer.start, overflow="never")
+
+        # a write which logs, e.g. an error of the remote logger, does not wait for its own full queue
+        writer.start(queueSize=1, overflow="block")
+        written = []
+
+        def reentrant():
+            writer.submit(written.append, 1)
+            writer.submit(written.append, 2)
+
+        writer.submit(reentrant)
+        drainer = threading.Thread(target=writer.drain)
+        drainer.daemon = True
+        drainer.start()
+        drainer.join(10)
+        self.assertFalse(drainer.is_alive(), "the writer thread is blocked")
+        writer.stop()
+        self.assertEqual(written, [1, 2])
+
+    @patch("sys.stdout")
+    def test_jsonLogFormat(self, stdoutMock):
+        configureLogging(logFormat="both", pilotUUID="pilot-1")
+        logger = Logger("ConfigureSite", pilotOutput=self.out)
+        logger.info("one\ntwo")
+        logger.error("three", header=False)
+        self.assertEqual(len(self.read().splitlines()), 3)
+        closeLogSinks()
+        with open(self.out + ".jsonl") as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["message"], "one\ntwo")
+        self.assertEqual(records[0]["command"], "ConfigureSite")
+        self.assertEqual(records[0]["pilotUUID"], "pilot-1")
+        self.assertEqual(records[0]["pid"], os.getpid())
+        self.assertIsNone(records[0]["subprocess"])
+        self.assertEqual(records[1]["level"], "ERROR")
+        self.assertEqual(records[1]["schema"], 1)
+
+        # json only: nothing more in the classic log file
+        configureLogging(logFormat="json")
+        logger.warn("four")
+        closeLogSinks()
+        self.assertEqual(len(self.read().splitlines()), 3)
+        self.assertRaises(ValueError, configureLogging, logFormat="xml")
+
+    @patch("sys.stdout")
+    def test_logRotation(self, stdoutMock):
+        logDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, logDir)
+        out = os.path.join(logDir, "pilot.out")
+        configureLogging(maxSize=1000, backupCount=2)
+        logger = Logger("Rotation", pilotOutput=out)
+        for i in range(100):
+            logger.info("message %d %s" % (i, "x" * 50))
+        logger.error("the end")
+        with keptLogs():
+            logger.info("diagnostics")
+        # waits for the compression of the segments
+        closeLogSinks()
+
+        segments = getLogSegments(out)
+        self.assertEqual(len(segments), 2)
+        self.assertTrue(all(path.endswith(".gz") for _number, path in segments))
+        with gzip.open(segments[-1][1], "rb") as fp:
+            self.assertIn("INFO [Rotation] message", fp.read().decode())
+        self.assertLess(os.path.getsize(out), 1000)
+        with open(out + ".errors") as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith(" ERROR [Rotation] the end"))
+        self.assertTrue(lines[1].endswith(" INFO [Rotation] diagnostics"))
+
+        # the log file is removed meanwhile: the rotation fails, not the logging
+        logger.info("reopened")
+        os.remove(out)
+        for i in range(20):
+            logger.info("message %d %s" % (i, "x" * 50))
+        closeLogSinks()
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.traceFile = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
+
+    def tearDown(self):
+        os.remove(self.traceFile)
+
+    def test_trace(self):
+        tracer = Tracer()
+        # not started: nothing is written
+        with tracer.span("nothing", "command"):
+            pass
+
+        tracer.start(self.traceFile)
+        with tracer.span("ConfigureSite", "command", module="pilotCommands") as args:
+            args["returnCode"] = 0
+            tracer.instant("RemoteLogger flush", "logging", lines=3)
+        tracer.stop()
+
+        with open(self.traceFile) as fp:
+            events = json.load(fp)
+        self.assertEqual([event["ph"] for event in events], ["M", "i", "X"])
+        span = events[2]
+        self.assertEqual(span["name"], "ConfigureSite")
+        self.assertEqual(span["args"], {"module": "pilotCommands", "returnCode": 0})
+        self.assertLessEqual(span["ts"], events[1]["ts"])
+        self.assertGreaterEqual(span["ts"] + span["dur"], events[1]["ts"])
+
+
+class TestDirectoryProber(unittest.TestCase):
+    def setUp(self):
+        self.hang = threading.Event()
+
+    def tearDown(self):
+        self.hang.set()
+
+    def listdir(self, directory):
+        if directory.startswith("/cvmfs/dead"):
+            self.hang.wait()
+        return {"/cvmfs/a.repo/certificates": ["ca.pem"], "/cvmfs/b.repo/certificates": ["cb.pem"]}.get(directory, [])
+
+    def test_probe(self):
+        prober = DirectoryProber(maxWorkers=4, maxStuck=2)
+        with patch("Pilot.pilotTools._listdir", side_effect=self.listdir) as listdirMock:
+            probes = [
+                prober.probe(directory)
+                for directory in [
+                    "/cvmfs/dead.repo/certificates",
+                    "/cvmfs/empty.repo/certificates",
+                    "/cvmfs/a.repo/certificates",
+                    "/cvmfs/b.repo/certificates",
+                ]
+            ]
+            # the first valid directory in priority order, the dead repository does not block the others
+            start = time.time()
+            self.assertIs(prober.firstValid(probes, timeout=0.5), probes[2])
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(listdirMock.call_count, 4)
+
+            # the dead repository is not probed again
+            self.assertIsNone(prober.listdir("/cvmfs/dead.repo/vomsdir", timeout=10))
+            self.assertEqual(listdirMock.call_count, 4)
+            self.assertEqual(prober.listdir("/cvmfs/a.repo/certificates"), ["ca.pem"])
+
+            # at most maxStuck threads are stuck, the other probes fail right away
+            self.assertIsNone(prober.listdir("/cvmfs/dead.repo/", timeout=10))
+            self.assertIsNone(prober.listdir("/cvmfs/dead.repo2/vomses", timeout=0.1))
+            self.assertIsNone(prober.listdir("/cvmfs/dead.repo3/vomses", timeout=0.1))
+            self.assertIsNone(prober.listdir("/cvmfs/a.repo/certificates", timeout=10))
+
+    def test_prewarm(self):
+        prober = DirectoryProber()
+        with patch("Pilot.pilotTools._listdir", side_effect=self.listdir) as listdirMock:
+            prober.prewarm(["/cvmfs/a.repo/certificates", "/cvmfs/dead.repo/certificates"])
+            prober.prewarm(["/cvmfs/a.repo/certificates"])
+            self.assertTrue(prober.waitPrewarm("/cvmfs/a.repo/certificates"))
+            self.assertFalse(prober.waitPrewarm("/cvmfs/dead.repo/certificates", timeout=0.1))
+            self.assertTrue(prober.waitPrewarm("/cvmfs/other.repo"))
+            # the listing done in advance is used by the next probe
+            self.assertEqual(prober.listdir("/cvmfs/a.repo/certificates"), ["ca.pem"])
+            self.assertEqual(listdirMock.call_count, 2)
+
+
 if __name__ == "__main__":
     unittest.main()